@@ -0,0 +1,288 @@
+"""
+NFNET Access Log
+Batched request log for the web server and proxy, and its summary report
+"""
+
+import json
+import threading
+import time
+
+from log import get_logger
+
+log = get_logger("ACCESS")
+
+# One tab separated line per request, "-" for a missing value
+FIELDS = ('time', 'client', 'method', 'path', 'status', 'bytes',
+          'upstream_ms', 'total_ms', 'cache', 'url')
+
+
+def _clean(value):
+    """A field value that cannot break the line format"""
+    if value is None or value == '':
+        return '-'
+    value = str(value)
+    if '\t' in value or '\n' in value or '\r' in value:
+        value = value.replace('\t', '%09').replace('\n', '%0A').replace('\r', '%0D')
+    return value
+
+
+class AccessLog:
+    """Buffers request records and appends them to a file in batches
+
+    record() only appends a tuple to a list; formatting and the write
+    happen on a background thread once access_log_batch records are
+    waiting or access_log_interval seconds have passed. When the writer
+    falls behind, records beyond 64 batches are dropped and counted
+    rather than holding up requests.
+    """
+    
+    def __init__(self, config):
+        self.path = None
+        self.batch = 256
+        self.interval = 1.0
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.file = None
+        self.running = False
+        self.thread = None
+        
+        self.stats = {
+            'records': 0,
+            'written': 0,
+            'dropped': 0,
+            'batches': 0
+        }
+        
+        self.configure(config)
+    
+    def configure(self, config):
+        """Apply access_log, access_log_batch and access_log_interval"""
+        self.path = config.access_log or None
+        self.batch = config.access_log_batch
+        self.interval = config.access_log_interval
+    
+    def start(self):
+        """Start the writer thread"""
+        if self.running:
+            return False
+        
+        self.running = True
+        
+        self.thread = threading.Thread(target=self._run, name="access-log")
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+    
+    def stop(self):
+        """Write what is buffered and stop the writer"""
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(5)
+        return True
+    
+    def record(self, client, method, path, status, size, upstream, total, cache, url):
+        """Queue one request, times in seconds"""
+        if self.path is None:
+            return
+        
+        entry = (time.time(), client, method, path, status, size,
+                 upstream, total, cache, url)
+        
+        with self.lock:
+            if len(self.buffer) >= self.batch * 64:
+                self.stats['dropped'] += 1
+                return
+            self.buffer.append(entry)
+            self.stats['records'] += 1
+            full = len(self.buffer) >= self.batch
+        
+        if full:
+            self.wakeup.set()
+    
+    def _run(self):
+        """Write a batch when one is full or the interval passes"""
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+        
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    
+    def flush(self):
+        """Write the buffered records"""
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+        if not batch:
+            return
+        
+        try:
+            self._write(batch)
+        except (IOError, OSError) as e:
+            self.stats['dropped'] += len(batch)
+            log.error("Write failed: %s", str(e))
+    
+    def _write(self, batch):
+        """Format and append one batch"""
+        if self.file is not None and self.file.name != self.path:
+            self.file.close()
+            self.file = None
+        if self.path is None:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        
+        lines = []
+        for stamp, client, method, path, status, size, upstream, total, cache, url in batch:
+            lines.append('\t'.join((
+                "%.3f" % stamp, _clean(client), _clean(method), _clean(path),
+                _clean(status), str(size),
+                "%.1f" % (upstream * 1000) if upstream is not None else '-',
+                "%.1f" % (total * 1000), _clean(cache), _clean(url))))
+        
+        self.file.write('\n'.join(lines) + '\n')
+        self.file.flush()
+        self.stats['written'] += len(lines)
+        self.stats['batches'] += 1
+    
+    def get_stats(self):
+        """Get access log statistics"""
+        with self.lock:
+            stats = self.stats.copy()
+            stats['buffered'] = len(self.buffer)
+        return stats
+
+
+def read(path):
+    """Yield each record in an access log as a dict"""
+    with open(path, 'r') as f:
+        for line in f:
+            values = line.rstrip('\n').split('\t')
+            if len(values) != len(FIELDS):
+                continue
+            
+            entry = dict(zip(FIELDS, values))
+            try:
+                entry['bytes'] = int(entry['bytes'])
+                entry['total_ms'] = float(entry['total_ms'])
+                if entry['upstream_ms'] != '-':
+                    entry['upstream_ms'] = float(entry['upstream_ms'])
+                else:
+                    entry['upstream_ms'] = None
+            except ValueError:
+                continue
+            yield entry
+
+
+def _host(url):
+    """Host part of an upstream URL"""
+    if '://' in url:
+        url = url.split('://', 1)[1]
+    return url.split('/', 1)[0].split('?', 1)[0] or '-'
+
+
+def summarize(paths, top=10):
+    """Top URLs, slowest origins and bytes per host over some access logs"""
+    urls = {}                    # url or path -> [requests, bytes, total ms]
+    hosts = {}                   # origin -> [requests, bytes, upstream ms list]
+    requests = 0
+    hits = 0
+    statuses = {}
+    
+    for path in paths:
+        for entry in read(path):
+            requests += 1
+            statuses[entry['status']] = statuses.get(entry['status'], 0) + 1
+            if entry['cache'] == 'hit':
+                hits += 1
+            
+            key = entry['url'] if entry['url'] != '-' else entry['path']
+            item = urls.setdefault(key, [0, 0, 0.0])
+            item[0] += 1
+            item[1] += entry['bytes']
+            item[2] += entry['total_ms']
+            
+            if entry['url'] == '-':
+                continue
+            item = hosts.setdefault(_host(entry['url']), [0, 0, []])
+            item[0] += 1
+            item[1] += entry['bytes']
+            if entry['upstream_ms'] is not None:
+                item[2].append(entry['upstream_ms'])
+    
+    origins = []
+    for host, (count, size, times) in hosts.items():
+        times.sort()
+        origins.append({
+            'host': host,
+            'requests': count,
+            'bytes': size,
+            'upstream_avg': sum(times) / len(times) if times else 0.0,
+            'upstream_max': times[-1] if times else 0.0,
+            'upstream_p90': times[int(len(times) * 0.9)] if times else 0.0
+        })
+    
+    top_urls = [{'url': url, 'requests': count, 'bytes': size, 'total_avg': total / count}
+                for url, (count, size, total) in urls.items()]
+    top_urls.sort(key=lambda item: (-item['requests'], item['url']))
+    
+    return {
+        'requests': requests,
+        'cache_hits': hits,
+        'statuses': statuses,
+        'top_urls': top_urls[:top],
+        'slowest_origins': sorted(origins, key=lambda item: -item['upstream_avg'])[:top],
+        'bytes_per_host': sorted(origins, key=lambda item: -item['bytes'])[:top]
+    }
+
+
+def main(argv):
+    """Command line entry point"""
+    from optparse import OptionParser
+    
+    parser = OptionParser(usage="%prog access [options] access.log [more logs]")
+    parser.add_option("-n", "--top", type="int", default=10, help="rows per table")
+    parser.add_option("-o", "--output", help="write JSON results to this file")
+    options, args = parser.parse_args(argv)
+    
+    if not args:
+        parser.error("no access log given")
+    
+    try:
+        report = summarize(args, options.top)
+    except IOError as e:
+        print "Cannot read log: %s" % str(e)
+        return 1
+    
+    print "Access log: %d requests, %d proxy DNS cache hits" % (report['requests'], report['cache_hits'])
+    print "Statuses: %s" % ', '.join("%s=%d" % item for item in sorted(report['statuses'].items()))
+    print "=" * 60
+    
+    print "Top URLs:"
+    print "  %8s %12s %9s  %s" % ("requests", "bytes", "avg ms", "url")
+    for item in report['top_urls']:
+        print "  %8d %12d %9.1f  %s" % (item['requests'], item['bytes'], item['total_avg'], item['url'])
+    
+    print ""
+    print "Slowest origins:"
+    print "  %8s %9s %9s %9s  %s" % ("requests", "avg ms", "p90 ms", "max ms", "host")
+    for item in report['slowest_origins']:
+        print "  %8d %9.1f %9.1f %9.1f  %s" % (item['requests'], item['upstream_avg'],
+                                              item['upstream_p90'], item['upstream_max'], item['host'])
+    
+    print ""
+    print "Bytes per host:"
+    print "  %8s %12s  %s" % ("requests", "bytes", "host")
+    for item in report['bytes_per_host']:
+        print "  %8d %12d  %s" % (item['requests'], item['bytes'], item['host'])
+    
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print "Results saved to %s" % options.output
+    
+    return 0
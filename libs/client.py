@@ -4,10 +4,70 @@ For connecting to NFNET servers
 """
 # -*- coding: utf-8 -*-
 import socket
+import threading
 import time
+from collections import deque
+
+class ClientError(Exception):
+    """Request could not be completed"""
+    pass
+
+class ResponseFuture:
+    """Response to a request that is still in flight"""
+    
+    def __init__(self, packet):
+        self.packet = packet
+        self.sent_at = time.time()
+        self.finished_at = None
+        self.response = None
+        self.error = None
+        self.callbacks = []
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+    
+    def done(self):
+        """True once a response or error arrived"""
+        return self._event.is_set()
+    
+    def result(self, timeout=None):
+        """Wait for the response packet, raises ClientError on failure"""
+        if not self._event.wait(timeout):
+            raise ClientError("Timed out waiting for response to packet %d" % self.packet.id)
+        if self.error is not None:
+            raise self.error
+        return self.response
+    
+    def add_done_callback(self, callback):
+        """Call callback(future) when done, at once if already done"""
+        with self._lock:
+            if not self._event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+    
+    def _finish(self, response=None, error=None):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.response = response
+            self.error = error
+            self.finished_at = time.time()
+            self._event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print "[CLIENT ERROR] Callback failed: %s" % str(e)
 
 class Client:
-    """NFNET protocol client"""
+    """NFNET protocol client
+
+    Many requests can be in flight on one connection. Every packet sent
+    gets an ID unique on this connection and responses are matched back
+    to their request by that ID, in whatever order they arrive.
+    """
     
     def __init__(self, host="127.0.0.1", port=28080):
         self.host = host
@@ -15,71 +75,352 @@ class Client:
         self.socket = None
         self.connected = False
         self.last_ping = 0
+        self.timeout = 5             # Seconds to wait for a response
+        self.connect_timeout = 10
+        self.verbose = True          # Print connection messages
+        
+        # Requests waiting for a response, by packet ID
+        self.pending = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.reader_thread = None
+        
+        # Called with packets that answer no request
+        self.on_unsolicited = None
+        self.unsolicited = 0
         
     def connect(self):
         """Connect to NFNET server"""
         try:
-            print "[CLIENT] Connecting to %s:%s..." % (self.host, self.port)
+            if self.verbose:
+                print "[CLIENT] Connecting to %s:%s..." % (self.host, self.port)
             
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(10)
+            self.socket.settimeout(self.connect_timeout)
             self.socket.connect((self.host, self.port))
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             
             self.connected = True
-            print "[CLIENT] Connected successfully"
+            
+            # Responses are read by a background thread
+            self.reader_thread = threading.Thread(target=self._read_responses, args=(self.socket,))
+            self.reader_thread.daemon = True
+            self.reader_thread.start()
+            
+            if self.verbose:
+                print "[CLIENT] Connected successfully"
             return True
             
         except Exception as e:
-            print "[CLIENT ERROR] Connection failed: %s" % str(e)
+            if self.verbose:
+                print "[CLIENT ERROR] Connection failed: %s" % str(e)
             self.connected = False
             return False
     
     def disconnect(self):
         """Disconnect from server"""
+        self.connected = False
+        
         if self.socket:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
             try:
                 self.socket.close()
             except:
                 pass
         
-        self.connected = False
-        print "[CLIENT] Disconnected"
+        self._fail_pending(ClientError("Disconnected"))
+        if self.verbose:
+            print "[CLIENT] Disconnected"
+    
+    def send_async(self, packet, callback=None):
+        """Send a packet without waiting, returns a ResponseFuture"""
+        future = ResponseFuture(packet)
+        if callback:
+            future.add_done_callback(callback)
+        return self._send(future)
+    
+    def _send(self, future):
+        """Send the packet of a future created elsewhere, returns the future"""
+        if future.done():
+            return future
+        
+        if not self.connected:
+            future._finish(error=ClientError("Not connected"))
+            return future
+        
+        with self.lock:
+            self._register(future)
+        
+        try:
+            data = future.packet.pack()
+            with self.send_lock:
+                self.socket.sendall(data)
+        except Exception as e:
+            with self.lock:
+                self.pending.pop(future.packet.id, None)
+            future._finish(error=ClientError("Send failed: %s" % str(e)))
+        
+        return future
+    
+    def send_large(self, data, content_type="application/octet-stream", fragment_size=None):
+        """Send a payload of any size in fragments, returns a ResponseFuture
+
+        data may be a string or an mmap. A large response comes back in
+        fragments too; it is reassembled and spooled to disk past 1MB, its
+        payload is then an mmap.
+        """
+        from protocol import MessageHandler
+        from fragments import split, FRAGMENT_SIZE
+        
+        packet = MessageHandler.create_data(data, content_type)
+        future = ResponseFuture(packet)
+        
+        if not self.connected:
+            future._finish(error=ClientError("Not connected"))
+            return future
+        
+        with self.lock:
+            self._register(future)
+        
+        try:
+            # Other requests may go out between fragments
+            for fragment in split(packet, fragment_size or FRAGMENT_SIZE):
+                with self.send_lock:
+                    self.socket.sendall(fragment.pack())
+        except Exception as e:
+            with self.lock:
+                self.pending.pop(packet.id, None)
+            future._finish(error=ClientError("Send failed: %s" % str(e)))
+        
+        return future
+    
+    def cancel(self, future, error=None):
+        """Give up on a request, a late response is treated as unsolicited"""
+        with self.lock:
+            if self.pending.get(future.packet.id) is future:
+                del self.pending[future.packet.id]
+        future._finish(error=error or ClientError("Cancelled"))
+    
+    def _register(self, future):
+        """Give the packet an ID unique among requests in flight (lock held)"""
+        while self.next_id in self.pending:
+            self.next_id = self.next_id + 1 if self.next_id < 2147483647 else 1
+        
+        future.packet.id = self.next_id
+        self.next_id = self.next_id + 1 if self.next_id < 2147483647 else 1
+        self.pending[future.packet.id] = future
+    
+    def _send_batch(self, packets):
+        """Send packets with a single write, returns their futures"""
+        futures = []
+        data = []
+        
+        with self.lock:
+            for packet in packets:
+                future = ResponseFuture(packet)
+                self._register(future)
+                futures.append(future)
+        
+        for packet in packets:
+            data.append(packet.pack())
+        
+        try:
+            with self.send_lock:
+                # Round trips start at the write, not at packing; stamped
+                # before it so a quick reply never precedes sent_at
+                now = time.time()
+                for future in futures:
+                    future.sent_at = now
+                self.socket.sendall(''.join(data))
+        except Exception as e:
+            error = ClientError("Send failed: %s" % str(e))
+            with self.lock:
+                for future in futures:
+                    self.pending.pop(future.packet.id, None)
+            for future in futures:
+                future._finish(error=error)
+        
+        return futures
+    
+    def _wait(self, future):
+        """Response for a future, None on error or timeout"""
+        try:
+            return future.result(self.timeout)
+        except ClientError:
+            with self.lock:
+                self.pending.pop(future.packet.id, None)
+            return None
+    
+    def send_many(self, packets, batch_size=256):
+        """Send many packets, yield their responses in send order
+        
+        Packets are coalesced into one write per batch and up to two
+        batches are kept in flight. Failed requests yield None. Nothing
+        is sent until the result is iterated.
+        """
+        if not self.connected:
+            print "[CLIENT] Not connected"
+            for packet in packets:
+                yield None
+            return
+        
+        in_flight = deque()
+        batch = []
+        
+        for packet in packets:
+            batch.append(packet)
+            if len(batch) < batch_size:
+                continue
+            
+            in_flight.extend(self._send_batch(batch))
+            batch = []
+            
+            while len(in_flight) > batch_size:
+                yield self._wait(in_flight.popleft())
+        
+        if batch:
+            in_flight.extend(self._send_batch(batch))
+        
+        while in_flight:
+            yield self._wait(in_flight.popleft())
+    
+    def ping_many(self, count, batch_size=1):
+        """Send count pings, return the round trip time distribution
+        
+        Times are in milliseconds, 'rtts' holds each ping in order
+        (None if it got no PONG). With a batch_size above 1 the pings of
+        a batch are written together and each time includes waiting
+        behind the others, which measures throughput more than latency.
+        """
+        from protocol import MessageHandler
+        from metrics import summarize
+        
+        if not self.connected:
+            print "[CLIENT] Not connected"
+            return None
+        
+        rtts = []
+        for start in range(0, count, batch_size):
+            pings = [MessageHandler.create_ping() for i in range(min(batch_size, count - start))]
+            for future in self._send_batch(pings):
+                response = self._wait(future)
+                if response is not None and response.type == "PONG":
+                    rtts.append(future.finished_at - future.sent_at)
+                else:
+                    rtts.append(None)
+        
+        received = [rtt for rtt in rtts if rtt is not None]
+        if received:
+            self.last_ping = time.time()
+        
+        result = summarize(received)
+        result['sent'] = count
+        result['received'] = len(received)
+        result['lost'] = count - len(received)
+        result['rtts'] = [round(rtt * 1000, 3) if rtt is not None else None for rtt in rtts]
+        return result
     
     def send_packet(self, packet):
-        """Send a packet to the server"""
+        """Send a packet to the server and wait for its response"""
         if not self.connected:
             print "[CLIENT] Not connected"
             return None
         
+        future = self.send_async(packet)
         try:
-            # Send packet
-            data = packet.pack()
-            self.socket.send(data)
+            return future.result(self.timeout)
+        except ClientError as e:
+            # Forget it, a late response is then treated as unsolicited
+            with self.lock:
+                self.pending.pop(packet.id, None)
+            print "[CLIENT ERROR] %s" % str(e)
+        
+        return None
+    
+    def _read_responses(self, sock):
+        """Read packets and hand them to the requests waiting for them"""
+        from protocol import PacketReader
+        from fragments import Reassembler
+        reader = PacketReader()
+        reassembler = Reassembler()
+        error = ClientError("Connection closed by server")
+        
+        while self.connected and sock is self.socket:
+            try:
+                data = sock.recv(65536)
+                if not data:
+                    break
             
-            # Wait for response
-            response_data = self._receive_response()
-            if response_data:
-                from protocol import Packet
-                return Packet.unpack(response_data)
+                for packet in reader.feed(data):
+                    # Keep-alive from the relay, not an answer to a request
+                    if packet.type == "PING":
+                        self._answer_ping(sock, packet)
+                        continue
+                    
+                    # Large responses arrive in fragments
+                    if 'Frag-Seq' in packet.options:
+                        try:
+                            packet = reassembler.add(packet)
+                        except ValueError as e:
+                            with self.lock:
+                                future = self.pending.pop(packet.id, None)
+                            if future is not None:
+                                future._finish(error=ClientError("Bad fragment: %s" % str(e)))
+                            continue
+                        if packet is None:
+                            continue
+                    
+                    with self.lock:
+                        future = self.pending.pop(packet.id, None)
             
-        except Exception as e:
-            print "[CLIENT ERROR] Send failed: %s" % str(e)
+                    if future is not None:
+                        future._finish(response=packet)
+                    else:
+                        self._handle_unsolicited(packet)
+            
+            except socket.timeout:
+                continue
+            except Exception as e:
+                error = ClientError("Receive failed: %s" % str(e))
+                break
         
-        return None
+        reassembler.close()
+        if sock is self.socket:
+            self.connected = False
+            self._fail_pending(error)
     
-    def _receive_response(self):
-        """Receive response from server"""
+    def _answer_ping(self, sock, packet):
+        """Reply to a relay keep-alive so it keeps the connection open"""
+        from protocol import MessageHandler
+        
+        pong = MessageHandler.create_pong()
+        pong.id = packet.id
         try:
-            # Simple receive with timeout
-            self.socket.settimeout(5)
-            data = self.socket.recv(8192)
-            return data
-        except socket.timeout:
-            print "[CLIENT] Receive timeout"
-            return None
-        except Exception as e:
-            print "[CLIENT ERROR] Receive failed: %s" % str(e)
-            return None
+            with self.send_lock:
+                sock.sendall(pong.pack())
+        except socket.error:
+            pass
+    
+    def _handle_unsolicited(self, packet):
+        """Packet that matches no request in flight"""
+        self.unsolicited += 1
+        if self.on_unsolicited:
+            try:
+                self.on_unsolicited(packet)
+            except Exception as e:
+                print "[CLIENT ERROR] Unsolicited handler: %s" % str(e)
+    
+    def _fail_pending(self, error):
+        """Fail every request still waiting"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        
+        for future in pending.values():
+            future._finish(error=error)
     
     def ping(self):
         """Send ping to server"""
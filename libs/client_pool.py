@@ -0,0 +1,271 @@
+"""
+NFNET Client Pool
+Shared, health-checked client connections per relay
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from client import Client, ClientError
+
+
+class _HostPool:
+    """Connections to one host:port"""
+    
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.idle = []               # [(client, released_at)], newest last
+        self.in_use = 0
+        self.failures = 0            # Connect failures in a row
+        self.retry_at = 0            # No connect attempts before this
+    
+    def total(self):
+        return len(self.idle) + self.in_use
+
+
+class ClientPool:
+    """Thread-safe pool of Client connections keyed by host:port
+
+    Checked-out clients must be given back with release(), or use the
+    connection() context manager. A maintenance thread pings idle
+    connections, closes ones idle too long and keeps min_size open.
+    """
+    
+    def __init__(self, min_size=0, max_size=8, idle_timeout=60, health_interval=15,
+                 connect_timeout=5, backoff=0.5, max_backoff=30):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        
+        # Metrics
+        self.stats = {
+            'checkouts': 0,
+            'created': 0,
+            'reused': 0,
+            'connect_failures': 0,
+            'checkout_timeouts': 0,
+            'health_failures': 0,
+            'evicted': 0,
+            'checkout_time': 0.0,
+            'checkout_max': 0.0
+        }
+        
+        self.running = True
+        self.thread = threading.Thread(target=self._maintain)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def get(self, host, port, timeout=5):
+        """Check out a connected client, raises ClientError"""
+        started = time.time()
+        deadline = started + timeout
+        key = "%s:%s" % (host, port)
+        
+        with self.lock:
+            pool = self.hosts.get(key)
+            if pool is None:
+                pool = self.hosts[key] = _HostPool(host, port)
+            
+            while True:
+                # Newest idle connection first, older ones get evicted
+                while pool.idle:
+                    client, released_at = pool.idle.pop()
+                    if client.connected:
+                        pool.in_use += 1
+                        self.stats['reused'] += 1
+                        self._checked_out(started)
+                        return client
+                    self.stats['evicted'] += 1
+                
+                if pool.total() < self.max_size:
+                    if time.time() < pool.retry_at:
+                        raise ClientError("%s unavailable, retrying in %.1fs" % (
+                            key, pool.retry_at - time.time()))
+                    
+                    # Reserve the slot, connect without holding the lock
+                    pool.in_use += 1
+                    break
+                
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stats['checkout_timeouts'] += 1
+                    raise ClientError("No free connection to %s" % key)
+                self.available.wait(remaining)
+        
+        client = self._connect(pool)
+        
+        with self.lock:
+            if client is None:
+                pool.in_use -= 1
+                self.available.notify()
+                raise ClientError("Could not connect to %s" % key)
+            
+            self.stats['created'] += 1
+            self._checked_out(started)
+        
+        return client
+    
+    def release(self, client):
+        """Return a checked-out client to the pool"""
+        key = "%s:%s" % (client.host, client.port)
+        
+        with self.lock:
+            pool = self.hosts.get(key)
+            if pool is None:
+                client.disconnect()
+                return
+            
+            pool.in_use -= 1
+            if client.connected and self.running:
+                pool.idle.append((client, time.time()))
+            else:
+                self.stats['evicted'] += 1
+            self.available.notify()
+        
+        if not client.connected or not self.running:
+            client.disconnect()
+    
+    @contextmanager
+    def connection(self, host, port, timeout=5):
+        """with pool.connection(host, port) as client: ..."""
+        client = self.get(host, port, timeout)
+        try:
+            yield client
+        finally:
+            self.release(client)
+    
+    def close(self):
+        """Close all idle connections and stop maintenance"""
+        with self.lock:
+            self.running = False
+            clients = []
+            for pool in self.hosts.values():
+                clients.extend([client for client, released_at in pool.idle])
+                pool.idle = []
+            self.available.notify_all()
+        
+        for client in clients:
+            client.disconnect()
+    
+    def _checked_out(self, started):
+        """Record checkout latency (lock held)"""
+        elapsed = time.time() - started
+        self.stats['checkouts'] += 1
+        self.stats['checkout_time'] += elapsed
+        if elapsed > self.stats['checkout_max']:
+            self.stats['checkout_max'] = elapsed
+    
+    def _connect(self, pool):
+        """Open a new connection, backing off after failures"""
+        client = Client(pool.host, pool.port)
+        client.verbose = False
+        client.connect_timeout = self.connect_timeout
+        
+        if client.connect():
+            with self.lock:
+                pool.failures = 0
+                pool.retry_at = 0
+            return client
+        
+        with self.lock:
+            self.stats['connect_failures'] += 1
+            pool.failures += 1
+            
+            # Exponential backoff with jitter so callers don't retry in step
+            delay = min(self.max_backoff, self.backoff * (2 ** (pool.failures - 1)))
+            pool.retry_at = time.time() + delay * random.uniform(0.5, 1.0)
+        
+        return None
+    
+    def _maintain(self):
+        """Health checks, idle eviction and minimum size"""
+        while self.running:
+            time.sleep(self.health_interval)
+            
+            # Take idle connections out of the pool while checking them
+            now = time.time()
+            checks = []
+            with self.lock:
+                for pool in self.hosts.values():
+                    for client, released_at in pool.idle:
+                        checks.append((pool, client, released_at))
+                    pool.in_use += len(pool.idle)
+                    pool.idle = []
+            
+            # Ping outside the lock, callers keep using other connections
+            for pool, client, released_at in checks:
+                with self.lock:
+                    evict = now - released_at > self.idle_timeout and pool.total() > self.min_size
+                
+                healthy = not evict and client.ping()
+                
+                with self.lock:
+                    if evict:
+                        self.stats['evicted'] += 1
+                    elif not healthy:
+                        self.stats['health_failures'] += 1
+                
+                if not healthy:
+                    client.disconnect()
+                
+                with self.lock:
+                    pool.in_use -= 1
+                    if healthy:
+                        pool.idle.insert(0, (client, released_at))
+                    self.available.notify()
+            
+            # Top up hosts below the minimum
+            with self.lock:
+                pools = self.hosts.values()
+            
+            for pool in pools:
+                while self.running and pool.total() < self.min_size and time.time() >= pool.retry_at:
+                    with self.lock:
+                        pool.in_use += 1
+                    
+                    client = self._connect(pool)
+                    
+                    with self.lock:
+                        pool.in_use -= 1
+                        if client is not None:
+                            self.stats['created'] += 1
+                            pool.idle.insert(0, (client, time.time()))
+                            self.available.notify()
+                    
+                    if client is None:
+                        break
+    
+    def get_stats(self):
+        """Get pool statistics"""
+        with self.lock:
+            stats = self.stats.copy()
+            hosts = {}
+            for key, pool in self.hosts.items():
+                hosts[key] = {
+                    'idle': len(pool.idle),
+                    'in_use': pool.in_use,
+                    'utilisation': round(float(pool.in_use) / self.max_size, 2),
+                    'failures': pool.failures
+                }
+        
+        if stats['checkouts']:
+            stats['checkout_avg_ms'] = round(stats['checkout_time'] * 1000 / stats['checkouts'], 3)
+        else:
+            stats['checkout_avg_ms'] = 0.0
+        stats['checkout_max_ms'] = round(stats['checkout_max'] * 1000, 3)
+        del stats['checkout_time']
+        del stats['checkout_max']
+        stats['hosts'] = hosts
+        
+        return stats
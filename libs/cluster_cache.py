@@ -0,0 +1,248 @@
+"""
+NFNET Cluster Cache
+Spreads processed responses over the relays of a cluster
+"""
+
+import bisect
+import hashlib
+import socket
+import threading
+from collections import OrderedDict
+
+from client import ClientError
+from protocol import Packet
+
+
+def make_key(payload, content_type):
+    """Key for a processed payload, the same on every relay"""
+    return hashlib.md5("%s\0%s" % (content_type, payload)).hexdigest()
+
+
+def parse_nodes(text):
+    """Parse 'host:port,host:port' into a list of node names"""
+    return [node.strip() for node in str(text).split(',') if node.strip()]
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes
+
+    Each node owns vnodes points on the ring and a key belongs to the
+    first point at or after its hash. Adding or removing a node only
+    moves the keys between its points and their predecessors, about
+    1/N of the keys.
+    """
+    
+    def __init__(self, nodes=(), vnodes=100):
+        self.vnodes = vnodes
+        self.points = []             # Sorted ring positions
+        self.owners = {}             # position -> node
+        self.nodes = set()
+        
+        for node in nodes:
+            self.add(node)
+    
+    def _hash(self, text):
+        return int(hashlib.md5(text).hexdigest()[:16], 16)
+    
+    def add(self, node):
+        """Add a node and its virtual points"""
+        if node in self.nodes:
+            return False
+        
+        self.nodes.add(node)
+        for i in range(self.vnodes):
+            point = self._hash("%s#%d" % (node, i))
+            if point not in self.owners:
+                bisect.insort(self.points, point)
+                self.owners[point] = node
+        return True
+    
+    def remove(self, node):
+        """Remove a node, its keys fall to the next points on the ring"""
+        if node not in self.nodes:
+            return False
+        
+        self.nodes.discard(node)
+        self.points = [point for point in self.points if self.owners[point] != node]
+        for point in [point for point, owner in self.owners.items() if owner == node]:
+            del self.owners[point]
+        return True
+    
+    def owner(self, key):
+        """Node that owns a key, None for an empty ring"""
+        if not self.points:
+            return None
+        
+        index = bisect.bisect(self.points, self._hash(key))
+        if index == len(self.points):
+            index = 0
+        return self.owners[self.points[index]]
+    
+    def __len__(self):
+        return len(self.nodes)
+
+
+class ClusterCache:
+    """Cache layer that keeps each key on the relay that owns it
+
+    Keys owned by this relay live in the relay's own cache. Others are
+    fetched from their owner with a CACHE GET over the peer link and
+    stored there with a CACHE PUT; a small LRU near-cache in front saves
+    the round trip for popular remote keys. An unreachable owner counts
+    as a miss, so the relay just processes the packet itself. The cache
+    is only used once cluster_self names this relay, and CACHE packets
+    are only accepted from the IPs of the configured nodes.
+    """
+    
+    def __init__(self, config, router, local_get, local_put, schedule):
+        self.config = config
+        self.router = router
+        self.local_get = local_get
+        self.local_put = local_put
+        self.schedule = schedule     # schedule(delay, callback), for lookup timeouts
+        self.near = OrderedDict()    # Least recently used first
+        self.lock = threading.Lock()
+        self.ring = HashRing(vnodes=config.cluster_vnodes)
+        self.self_node = config.cluster_self
+        self.peers = set()           # IPs of the other nodes
+        
+        self.stats = {
+            'near_hits': 0,
+            'local_hits': 0,
+            'remote_hits': 0,
+            'misses': 0,
+            'remote_errors': 0,
+            'puts': 0
+        }
+        
+        self.set_nodes(parse_nodes(config.cluster_nodes))
+    
+    def set_nodes(self, nodes):
+        """Change ring membership, only keys of changed nodes move"""
+        nodes = set(nodes)
+        if self.self_node:
+            nodes.add(self.self_node)
+        
+        # CACHE packets are only taken from these addresses
+        peers = set()
+        for node in nodes:
+            host = node.rpartition(':')[0]
+            try:
+                peers.add(socket.gethostbyname(host))
+            except socket.error:
+                peers.add(host)
+        
+        with self.lock:
+            self.peers = peers
+            for node in self.ring.nodes - nodes:
+                self.ring.remove(node)
+            for node in nodes - self.ring.nodes:
+                self.ring.add(node)
+            
+            # Near entries may now belong to this relay, start over
+            self.near.clear()
+    
+    def enabled(self):
+        """True when cluster_cache is on and cluster_self names this relay"""
+        return bool(self.config.cluster_cache and self.self_node)
+    
+    def is_peer(self, ip):
+        """True if ip belongs to a node of the cluster"""
+        return ip in self.peers
+    
+    def get(self, key):
+        """Cached value, None, or a ResponseFuture while the owner is asked
+
+        A remote lookup never blocks; pass the finished future to answer()
+        for the value. It fails after cluster_timeout.
+        """
+        with self.lock:
+            value = self.near.get(key)
+            if value is not None:
+                self.near[key] = self.near.pop(key)
+                self.stats['near_hits'] += 1
+                return value
+            owner = self.ring.owner(key)
+        
+        if owner == self.self_node:
+            value = self.local_get(key)
+            self._count('local_hits' if value is not None else 'misses')
+            return value
+        
+        return self._remote_get(owner, key)
+    
+    def answer(self, future):
+        """Value from a finished remote lookup, None on a miss or any failure"""
+        response = future.response
+        if future.error is not None:
+            self._count('remote_errors')
+        elif response.type == "CACHE" and response.options.get('Status') == "HIT":
+            self._count('remote_hits')
+            self._near_put(future.packet.options['Key'], response.payload)
+            return response.payload
+        
+        self._count('misses')
+        return None
+    
+    def put(self, key, value):
+        """Store a value with its owner"""
+        with self.lock:
+            owner = self.ring.owner(key)
+            self.stats['puts'] += 1
+        
+        if owner == self.self_node:
+            self.local_put(key, value)
+            return
+        
+        self._near_put(key, value)
+        
+        # Fire and forget, the owner's answer is not needed
+        link = self._link(owner)
+        if link is not None:
+            link.send_async(Packet("CACHE", value, {"Command": "PUT", "Key": key}))
+    
+    def _remote_get(self, owner, key):
+        """Ask the owner for a key, returns a ResponseFuture or None"""
+        link = self._link(owner)
+        if link is None:
+            self._count('misses')
+            return None
+        
+        future = link.send_async(Packet("CACHE", "", {"Command": "GET", "Key": key}))
+        if not future.done():
+            self.schedule(self.config.cluster_timeout, lambda: link.cancel(
+                future, ClientError("No answer within %ss" % self.config.cluster_timeout)))
+        return future
+    
+    def _link(self, node):
+        """Peer link to a ring node"""
+        from routing import parse_target
+        try:
+            return self.router.link(parse_target(node), pin=True)
+        except ValueError:
+            self._count('remote_errors')
+            return None
+    
+    def _near_put(self, key, value):
+        """Remember a remote value locally"""
+        with self.lock:
+            self.near.pop(key, None)
+            self.near[key] = value
+            while len(self.near) > self.config.cluster_near_size:
+                self.near.popitem(last=False)
+    
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+    
+    def get_stats(self):
+        """Get cluster cache statistics"""
+        with self.lock:
+            stats = self.stats.copy()
+            stats['nodes'] = sorted(self.ring.nodes)
+            stats['near_size'] = len(self.near)
+        
+        stats['self'] = self.self_node
+        lookups = stats['near_hits'] + stats['local_hits'] + stats['remote_hits'] + stats['misses']
+        stats['hit_rate'] = round(float(lookups - stats['misses']) / lookups, 3) if lookups else 0.0
+        return stats
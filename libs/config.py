@@ -4,6 +4,88 @@ Handles all system settings and preferences
 """
 # -*- coding: utf-8 -*-
 import os
+import threading
+import time
+
+CONFIG_FILE = "nfnet.cfg"
+
+# Settings that only take effect after a restart
+RESTART_SETTINGS = ('listen_ip', 'relay_port', 'control_port', 'intranet_port',
+                    'web_workers', 'web_queue_size', 'cluster_vnodes', 'handoff_socket',
+                    'log_queue_size')
+
+# Allowed ranges for numeric settings
+LIMITS = {
+    'relay_port': (1, 65535),
+    'control_port': (1, 65535),
+    'intranet_port': (1, 65535),
+    'max_clients': (1, 65535),
+    'buffer_size': (512, 16777216),
+    'timeout': (1, 86400),
+    'send_timeout': (0.1, 3600),
+    'http_keep_alive_timeout': (1, 3600),
+    'http_max_requests': (1, 1000000),
+    'web_workers': (1, 1024),
+    'web_queue_size': (1, 65535),
+    'dns_cache_ttl': (0, 86400),
+    'dns_negative_ttl': (0, 86400),
+    'access_log_batch': (1, 1000000),
+    'access_log_interval': (0.01, 3600),
+    'stats_stream_interval': (0.1, 3600),
+    'cache_size': (0, 10000000),
+    'log_level': (0, 3),
+    'log_console_level': (0, 3),
+    'log_max_bytes': (0, 1073741824),
+    'log_backups': (0, 100),
+    'log_rate_limit': (0, 1000000),
+    'log_queue_size': (1, 10000000),
+    'trace_sample_rate': (0, 1),
+    'trace_buffer': (1, 1000000),
+    'config_watch_interval': (0.1, 3600),
+    'route_timeout': (0.1, 3600),
+    'cluster_vnodes': (1, 10000),
+    'cluster_near_size': (0, 1000000),
+    'cluster_timeout': (0.01, 60),
+    'route_max_hops': (1, 64),
+    'peer_heartbeat_interval': (0.1, 3600),
+    'peer_heartbeat_timeout': (0.1, 3600),
+    'peer_reconnect_max': (0.1, 3600),
+    'rate_limit_packets': (0, 10000000),
+    'rate_limit_bytes': (0, 10000000000),
+    'rate_limit_burst': (0.1, 3600),
+    'rate_limit_max_delay': (0, 60),
+    'admission_queue_soft': (1, 10000000),
+    'admission_queue_hard': (1, 10000000),
+    'admission_latency': (0.01, 3600),
+    'admission_max_delay': (0, 60),
+    'lane_weight_control': (1, 1000),
+    'lane_weight_route': (1, 1000),
+    'lane_weight_data': (1, 1000),
+    'handoff_drain_timeout': (1, 3600),
+    'fragment_size': (1024, 16777216),
+    'spool_threshold': (0, 1073741824),
+    'max_transfer': (1, 17179869184),
+    'max_transfers': (1, 65535)
+}
+
+# (lower, upper) settings whose values must stay in that order
+ORDERED = [
+    ('admission_queue_soft', 'admission_queue_hard')
+]
+
+def parse_value(value):
+    """Convert a config file string to int, float or bool"""
+    if value.isdigit():
+        return int(value)
+    elif value.lower() == 'true':
+        return True
+    elif value.lower() == 'false':
+        return False
+    
+    try:
+        return float(value)
+    except ValueError:
+        return value
 
 class Config:
     """Configuration management for NFNET"""
@@ -24,8 +106,22 @@ class Config:
         self.max_clients = 50
         self.buffer_size = 8192      # 8KB buffers
         self.timeout = 45            # Connection timeout in seconds
+        self.send_timeout = 5.0      # Seconds a reply may wait on a client that is not reading
         self.keep_alive = True
         
+        # Intranet web server
+        self.http_keep_alive_timeout = 15  # Idle seconds before closing
+        self.http_max_requests = 100       # Requests per connection
+        self.web_workers = 16              # Worker threads
+        self.web_queue_size = 64           # Connections waiting for a worker
+        self.dns_cache_ttl = 300           # Proxy DNS cache, seconds
+        self.dns_negative_ttl = 30         # Remember failed lookups
+        self.dns_refresh = True            # Refresh busy names early
+        self.access_log = "access.log"     # Request log, empty to turn off
+        self.access_log_batch = 256        # Records written together
+        self.access_log_interval = 1.0     # Longest a record waits (s)
+        self.stats_stream_interval = 1.0   # Seconds between dashboard updates
+
         # Feature flags
         self.enable_cache = True
         self.cache_size = 500        # Max cache entries
@@ -34,9 +130,62 @@ class Config:
         
         # Debug settings
         self.log_level = 2           # 0=Error, 1=Warn, 2=Info, 3=Debug
-        self.log_file = "nfnet.log"
+        self.log_file = "nfnet.log"  # Empty for console only
+        self.log_console_level = 2   # Levels also shown on the console
+        self.log_max_bytes = 10485760  # Rotate the log file past this size
+        self.log_backups = 3         # Rotated files kept, nfnet.log.1 ..
+        self.log_rate_limit = 20     # Repeats of one message per second, 0 = all
+        self.log_queue_size = 10000  # Lines waiting to be written
+        self.trace_sample_rate = 0.0  # Fraction of packets traced
+        self.trace_buffer = 1000      # Traces kept in memory
+        
+        # Live reload
+        self.config_watch = True         # Apply nfnet.cfg edits while running
+        self.config_watch_interval = 2.0 # Seconds between checks
+        
+        # Cluster cache
+        self.cluster_cache = False       # Share the cache across relays
+        self.cluster_nodes = ""          # Other relays, host:port,host:port
+        self.cluster_self = ""           # This relay as the others reach it
+        self.cluster_vnodes = 100        # Ring points per relay
+        self.cluster_near_size = 256     # Remote entries kept locally
+        self.cluster_timeout = 0.25      # Seconds to wait for a remote GET
+        
+        # Routing
+        self.route_timeout = 10.0        # Seconds to wait for an upstream reply
+        self.route_max_hops = 8          # Relays a ROUTE packet may pass
+        self.peer_heartbeat_interval = 5.0  # Seconds between link PINGs
+        self.peer_heartbeat_timeout = 3.0   # Reconnect if no PONG by then
+        self.peer_reconnect_max = 30.0      # Longest reconnect backoff
+        
+        # Rate limiting, per client IP, 0 turns a limit off
+        self.rate_limit_packets = 0      # Packets per second
+        self.rate_limit_bytes = 0        # Bytes per second
+        self.rate_limit_burst = 2.0      # Seconds of traffic allowed at once
+        self.rate_limit_max_delay = 0.5  # Longest throttle before rejecting
+        
+        # Admission control for the message queue
+        self.admission_queue_soft = 1000 # Queue depth where new work is delayed
+        self.admission_queue_hard = 5000 # Queue depth where new work is rejected
+        self.admission_latency = 2.0     # Reject while packets wait longer (s)
+        self.admission_max_delay = 0.05  # Delay just below the hard limit (s)
         
-        # Custom routing
+        # Message scheduling, packets served per turn of each lane
+        self.lane_weight_control = 8     # PING and CONTROL
+        self.lane_weight_route = 4       # ROUTE
+        self.lane_weight_data = 1        # DATA and everything else
+        
+        # Hot restart, see --takeover
+        self.handoff_socket = "nfnet.sock"    # Unix socket a new process connects to
+        self.handoff_drain_timeout = 30.0     # Seconds to finish old connections
+        
+        # Large payloads, sent as fragments
+        self.fragment_size = 262144      # Bytes per fragment streamed back
+        self.spool_threshold = 1048576   # Transfers above this go to a temp file
+        self.max_transfer = 1073741824   # Largest fragmented payload accepted
+        self.max_transfers = 16          # Unfinished transfers per connection
+        
+        # Custom routing, add more with route.<name> = host:port lines
         self.routing_table = {
             "intranet": "127.0.0.1:8080",
             "api": "127.0.0.1:28081",
@@ -48,38 +197,89 @@ class Config:
     
     def _load_config(self):
         """Load configuration from file if present"""
-        config_file = "nfnet.cfg"
-        if os.path.exists(config_file):
+        if os.path.exists(CONFIG_FILE):
             try:
-                print "[CONFIG] Loading settings from %s" % config_file
-                # Simple config parser
-                with open(config_file, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line and not line.startswith('#'):
-                            if '=' in line:
-                                key, value = line.split('=', 1)
-                                key = key.strip()
-                                value = value.strip()
-                                
-                                # Convert types
-                                if value.isdigit():
-                                    value = int(value)
-                                elif value.lower() == 'true':
-                                    value = True
-                                elif value.lower() == 'false':
-                                    value = False
-                                
-                                # Set attribute if it exists
-                                if hasattr(self, key):
-                                    setattr(self, key, value)
-                                    print "[CONFIG] Set %s = %s" % (key, value)
+                print "[CONFIG] Loading settings from %s" % CONFIG_FILE
+                settings = self.read_file()
+                pending = dict(settings)
+                for key, value in settings:
+                    if key.startswith('route.'):
+                        self.routing_table[key[6:]] = str(value)
+                        print "[CONFIG] Route %s -> %s" % (key[6:], value)
+                    
+                    # Set attribute if it exists
+                    elif hasattr(self, key):
+                        value, error = self.validate(key, value, pending)
+                        if error:
+                            print "[CONFIG WARN] %s" % error
+                            continue
+                        setattr(self, key, value)
+                        print "[CONFIG] Set %s = %s" % (key, value)
             except Exception as e:
                 print "[CONFIG ERROR] %s" % str(e)
     
+    def read_file(self, path=CONFIG_FILE):
+        """Parse a config file into [(key, value)] in file order"""
+        settings = []
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#') and '=' in line:
+                    key, value = line.split('=', 1)
+                    settings.append((key.strip(), parse_value(value.strip())))
+        return settings
+    
+    def validate(self, key, value, pending=None):
+        """Check a new value for a setting, returns (value, error)
+
+        pending holds other settings changed together with this one, they
+        are compared by their new value.
+        """
+        if key.startswith('_') or not hasattr(self, key) or callable(getattr(self, key)):
+            return None, "Unknown setting: %s" % key
+        
+        current = getattr(self, key)
+        if isinstance(current, dict):
+            return None, "%s can only be changed in the config file" % key
+        
+        # Values must keep the type of the default
+        if isinstance(current, bool):
+            if not isinstance(value, bool):
+                return None, "%s must be true or false" % key
+        elif isinstance(current, (int, float)):
+            if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+                return None, "%s must be a number" % key
+            if isinstance(current, int):
+                if value != int(value):
+                    return None, "%s must be a whole number" % key
+                value = int(value)
+            else:
+                value = float(value)
+        else:
+            value = str(value)
+        
+        if key in LIMITS:
+            low, high = LIMITS[key]
+            if not low <= value <= high:
+                return None, "%s must be between %s and %s" % (key, low, high)
+        
+        for lower, upper in ORDERED:
+            if key not in (lower, upper):
+                continue
+            other = upper if key == lower else lower
+            limit = (pending or {}).get(other)
+            if isinstance(limit, bool) or not isinstance(limit, (int, long, float)):
+                limit = getattr(self, other)
+            if key == lower and value > limit:
+                return None, "%s must not be above %s" % (lower, upper)
+            if key == upper and value < limit:
+                return None, "%s must not be below %s" % (upper, lower)
+        
+        return value, None
+    
     def save_config(self):
         """Save current settings to file"""
-        config_file = "nfnet.cfg"
+        config_file = CONFIG_FILE
         try:
             with open(config_file, 'w') as f:
                 f.write("# NFNET Configuration File\n")
@@ -92,6 +292,11 @@ class Config:
                         if not isinstance(value, dict):
                             f.write("%s = %s\n" % (attr, value))
                 
+                # Routes as route.<name> lines
+                f.write("\n")
+                for name in sorted(self.routing_table):
+                    f.write("route.%s = %s\n" % (name, self.routing_table[name]))
+                
             print "[CONFIG] Settings saved to %s" % config_file
             return True
         except Exception as e:
@@ -108,4 +313,118 @@ class Config:
             'cache': "Enabled (%s entries)" % self.cache_size if self.enable_cache else "Disabled",
             'compression': "Enabled" if self.enable_compression else "Disabled",
             'ssl': "Enabled" if self.enable_ssl else "Disabled"
-        }
\ No newline at end of file
+        }
+
+class ConfigWatcher:
+    """Polls the config file and hands validated changes to a callback
+
+    Only settings whose value in the file changed since the last read are
+    applied, so 'config set' changes made at the console are not undone
+    by an unrelated edit.
+    """
+    
+    def __init__(self, config, apply, path=CONFIG_FILE):
+        self.config = config
+        self.apply = apply           # Called with {key: value}, returns keys needing a restart
+        self.path = path
+        self.running = False
+        self.thread = None
+        self.stamp = None
+        self.settings = {}
+        self.reloads = 0
+    
+    def start(self):
+        """Start watching"""
+        if self.running:
+            return False
+        
+        self.stamp = self._stamp()
+        self.settings = self._read()
+        self.running = True
+        
+        self.thread = threading.Thread(target=self._watch_loop, name="config-watch")
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+    
+    def stop(self):
+        """Stop watching"""
+        self.running = False
+        return True
+    
+    def _stamp(self):
+        """Modification time and size, None if the file is missing"""
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            return None
+        return (info.st_mtime, info.st_size)
+    
+    def _read(self):
+        """Current file settings as a dict"""
+        try:
+            return dict(self.config.read_file(self.path))
+        except IOError:
+            return {}
+    
+    def _watch_loop(self):
+        """Check the file every config_watch_interval seconds"""
+        while self.running:
+            time.sleep(self.config.config_watch_interval)
+            
+            stamp = self._stamp()
+            if stamp != self.stamp:
+                self.stamp = stamp
+                if stamp:
+                    self.check()
+    
+    def check(self, full=False):
+        """Read the file and apply changed settings, returns the changes
+
+        With full set every setting in the file is compared against the
+        running config instead of against the previous read.
+        """
+        try:
+            settings = dict(self.config.read_file(self.path))
+        except IOError as e:
+            print "[CONFIG ERROR] %s" % str(e)
+            return {}
+        
+        # Settings that changed are validated against each other
+        changed = dict((key, raw) for key, raw in settings.items()
+                       if (full or self.settings.get(key) != raw) and hasattr(self.config, key))
+        
+        changes = {}
+        for key, raw in sorted(changed.items()):
+            value, error = self.config.validate(key, raw, changed)
+            if error:
+                print "[CONFIG WARN] Ignoring change: %s" % error
+                continue
+            if value != getattr(self.config, key):
+                changes[key] = value
+        
+        # route.<name> lines update the routing table as a whole
+        routes = dict((key[6:], str(value)) for key, value in settings.items() if key.startswith('route.'))
+        previous = dict((key[6:], str(value)) for key, value in self.settings.items() if key.startswith('route.'))
+        if full or routes != previous:
+            table = dict(self.config.routing_table)
+            for name in previous:
+                if name not in routes:
+                    table.pop(name, None)
+            table.update(routes)
+            if table != self.config.routing_table:
+                changes['routing_table'] = table
+        
+        self.settings = settings
+        if not changes:
+            return changes
+        
+        self.reloads += 1
+        for key in sorted(changes):
+            print "[CONFIG] Reloaded %s = %s" % (key, changes[key])
+        
+        restart = self.apply(changes)
+        if restart:
+            print "[CONFIG WARN] Restart required for: %s" % ', '.join(sorted(restart))
+        
+        return changes
@@ -9,6 +9,10 @@ import threading
 import webbrowser
 import os
 
+from log import get_stats as get_log_stats
+from metrics import format_bytes
+from scheduler import LANES
+
 class Console:
     """Main console interface"""
     
@@ -37,6 +41,7 @@ class Console:
             'connect': self.cmd_connect,
             'send': self.cmd_send,
             'stats': self.cmd_stats,
+            'top': self.cmd_top,
             'config': self.cmd_config,
             'clear': self.cmd_clear,
             'exit': self.cmd_exit,
@@ -47,12 +52,19 @@ class Console:
             'log': self.cmd_log,
             'web': self.cmd_web,
             'open': self.cmd_open,
-            'logo': self.cmd_logo
+            'logo': self.cmd_logo,
+            'bench': self.cmd_bench,
+            'profile': self.cmd_profile,
+            'trace': self.cmd_trace,
+            'peers': self.cmd_peers
         }
         
         # Test client for internal testing
         self.test_client = None
     
+        # Sampling profiler, created by 'profile start'
+        self.profiler = None
+    
     def run(self):
         """Run the console"""
         self.running = True
@@ -121,14 +133,19 @@ class Console:
         print "  start                   Start relay server"
         print "  stop                    Stop relay server"
         print "  status                  Show system status"
-        print "  ping [host]             Ping a host"
+        print "  ping [host[:port]] [n]  Ping a relay"
         print "  connect [host:port]     Connect to NFNET host"
         print "  send [message]          Send message to connected host"
         print "  stats                   Show relay statistics"
+        print "  top [n]                 Live rates, refreshed every second"
         print "  config [show|set|save]  Configuration management"
-        print "  routes                  Show routing table"
+        print "  routes [lookup name]    Show routing table"
+        print "  peers                   Show links to other relays"
         print "  cache [clear|stats]     Cache management"
         print "  test                    Run system tests"
+        print "  bench [c] [secs] [mix]  Load test the relay"
+        print "  profile [start|stop]    Profile all threads"
+        print "  trace [on|off|slow|client] Per-packet tracing"
         print "  log [level]             Set log level"
         print "  web                     Open web interface"
         print "  open                    Open web in default browser"
@@ -185,34 +202,50 @@ class Console:
         print "  Status: %s" % ("RUNNING" if self.relay.running else "STOPPED")
     
     def cmd_ping(self, args):
-        """Ping a host"""
+        """Ping a relay"""
         if not args:
             host = "127.0.0.1"
         else:
             host = args[0]
         
-        print "Pinging %s..." % host
+        port = self.config.relay_port
+        if ':' in host:
+            host, port = host.rsplit(':', 1)
+            port = int(port)
         
-        # Simple ping using socket
-        import socket
+        count = 4
+        if len(args) > 1 and args[1].isdigit():
+            count = int(args[1])
         
-        try:
-            # Try to connect to relay port
-            start_time = time.time()
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(3)
+        print "Pinging %s:%s with %d NFNET PING packets..." % (host, port, count)
             
-            result = sock.connect_ex((host, self.config.relay_port))
-            end_time = time.time()
+        from client import Client
             
-            if result == 0:
-                print "Reply from %s: time=%.1fms" % (host, (end_time - start_time) * 1000)
-                sock.close()
-            else:
+        client = Client(host, port)
+        client.verbose = False
+        client.connect_timeout = 3
+        
+        if not client.connect():
+            print "Request timed out"
+            return
+        
+        try:
+            result = client.ping_many(count)
+        finally:
+            client.disconnect()
+        
+        for rtt in result['rtts']:
+            if rtt is None:
                 print "Request timed out"
+            else:
+                print "Reply from %s: time=%.1fms" % (host, rtt)
         
-        except Exception as e:
-            print "Ping failed: %s" % str(e)
+        print ""
+        print "Packets: sent = %d, received = %d, lost = %d" % (
+            result['sent'], result['received'], result['lost'])
+        if result['received']:
+            print "RTT: min = %.1fms, mean = %.1fms, p99 = %.1fms" % (
+                result['min'], result['mean'], result['p99'])
     
     def cmd_connect(self, args):
         """Connect to NFNET host"""
@@ -255,6 +288,38 @@ class Console:
                 display_key = key.replace('_', ' ').title()
                 print "  %-20s: %s" % (display_key, value)
         
+        web_stats = self.relay.web_server.get_stats()
+        for section in ('workers', 'dns', 'access_log'):
+            print ""
+            print "Web %s:" % section.replace('_', ' ').title()
+        
+            for key in sorted(web_stats[section]):
+                display_key = key.replace('_', ' ').title()
+                print "  %-20s: %s" % (display_key, web_stats[section][key])
+        
+        log_stats = get_log_stats()
+        print ""
+        print "Logging:"
+        for key in sorted(log_stats):
+            print "  %-20s: %s" % (key.title(), log_stats[key])
+        
+        lanes = self.relay.message_queue.get_stats()
+        print ""
+        print "Message Lanes:"
+        for name in LANES:
+            lane = lanes[name]
+            print "  %-20s: %d queued, %d served, weight %d, wait %.2fms avg %.2fms p99" % (
+                name.title(), lane['depth'], lane['dequeued'], lane['weight'],
+                lane['wait_ms'], lane['wait_p99_ms'])
+        
+        limited = self.relay.limiter.get_stats()['top']
+        if limited:
+            print ""
+            print "Rate Limited Clients:"
+            for client in limited:
+                print "  %-20s: %d throttled, %d rejected" % (
+                    client['ip'], client['throttled'], client['rejected'])
+        
         print ""
         print "Active Clients:"
         
@@ -270,6 +335,71 @@ class Console:
             else:
                 print "  No active connections"
     
+    def cmd_top(self, args):
+        """Show live rates until Ctrl+C, or n refreshes"""
+        if not self.relay.running:
+            print "Relay is not running"
+            return
+        
+        try:
+            count = int(args[0]) if args else 0
+        except ValueError:
+            print "Usage: top [refreshes]"
+            return
+        
+        # Redraw in place on a terminal, print one screen after another otherwise
+        redraw = sys.stdout.isatty()
+        shown = 0
+        last = None
+        
+        try:
+            while self.relay.running and (not count or shown < count):
+                # Draw each sample once, as soon as it is taken
+                rates = self.relay.sampler.rates()
+                if rates is None or rates['time'] == last:
+                    time.sleep(0.05)
+                    continue
+                last = rates['time']
+                
+                lines = self._top_lines(rates)
+                if redraw:
+                    sys.stdout.write("\033[H\033[2J")
+                sys.stdout.write('\n'.join(lines) + '\n')
+                sys.stdout.flush()
+                shown += 1
+        except KeyboardInterrupt:
+            print ""
+    
+    def _top_lines(self, rates):
+        """Format one screen of the top view"""
+        hit_rate = rates['cache_hit_rate']
+        
+        lines = [
+            "NFNET top - %s, %d connections, Ctrl+C to exit" % (
+                time.strftime("%H:%M:%S"), rates['connections']),
+            "=" * 70,
+            "  Packets/sec  : %8.1f in  %8.1f out   Errors/sec: %.1f" % (
+                rates['packets_in'], rates['packets_out'], rates['errors']),
+            "  Bytes/sec    : %8s in  %8s out" % (
+                format_bytes(rates['bytes_in']), format_bytes(rates['bytes_out'])),
+            "  Queue depth  : %8d   %s" % (rates['queue_size'], ', '.join(
+                "%s %d (%.1fms)" % (name, rates['lanes'][name]['depth'], rates['lanes'][name]['wait_ms'])
+                for name in LANES)),
+            "  Cache hits   : %8s" % ("%.1f%%" % hit_rate if hit_rate is not None else "-"),
+            "  Latency      : %8.2f ms p50  %6.2f ms p99" % (rates['p50_ms'], rates['p99_ms']),
+            "",
+            "  %-22s %10s %10s %10s %10s" % ("Client", "pkts/s", "bytes/s", "packets", "bytes"),
+        ]
+        
+        for client in rates['clients']:
+            lines.append("  %-22s %10.1f %10s %10d %10s" % (
+                client['address'], client['packets_per_sec'], format_bytes(client['bytes_per_sec']),
+                client['packets'], format_bytes(client['bytes'])))
+        if not rates['clients']:
+            lines.append("  No active connections")
+        
+        return lines
+    
     def cmd_config(self, args):
         """Configuration management"""
         if not args:
@@ -292,22 +422,21 @@ class Console:
             setting = args[1]
             if '=' in setting:
                 key, value = setting.split('=', 1)
+                key = key.strip()
                 
-                # Convert value type
-                if value.isdigit():
-                    value = int(value)
-                elif value.lower() == 'true':
-                    value = True
-                elif value.lower() == 'false':
-                    value = False
+                # Convert and check the value
+                from config import parse_value
+                value, error = self.config.validate(key, parse_value(value.strip()))
+                if error:
+                    print error
+                    return
                 
-                # Set attribute
-                if hasattr(self.config, key):
-                    old_value = getattr(self.config, key)
-                    setattr(self.config, key, value)
-                    print "Changed %s: %s -> %s" % (key, old_value, value)
-                else:
-                    print "Unknown setting: %s" % key
+                # Apply to the running relay
+                old_value = getattr(self.config, key)
+                restart = self.relay.apply_config({key: value})
+                print "Changed %s: %s -> %s" % (key, old_value, value)
+                if restart:
+                    print "Takes effect after a restart"
             else:
                 print "Usage: config set key=value"
         
@@ -322,14 +451,46 @@ class Console:
     
     def cmd_routes(self, args):
         """Show routing table"""
+        if len(args) >= 2 and args[0].lower() == 'lookup':
+            route, target = self.relay.router.resolve(args[1])
+            if route is None:
+                print "No route to %s" % args[1]
+            else:
+                print "%s -> %s:%s (route %s)" % (args[1], target[0], target[1], route)
+            return
+        
         print "Routing Table:"
         print "=" * 50
         
-        for route, target in self.config.routing_table.items():
-            print "  %-15s -> %s" % (route, target)
+        route_stats = self.relay.router.get_stats()['routes']
+        for route, target in sorted(self.config.routing_table.items()):
+            stats = route_stats.get(route.lower())
+            if stats:
+                print "  %-15s -> %-21s %6d ok %5d err  p50 %.2fms  p99 %.2fms" % (
+                    route, target, stats['forwarded'], stats['errors'], stats['p50'], stats['p99'])
+            else:
+                print "  %-15s -> %s" % (route, target)
         
         print ""
-        print "Custom routes can be added in nfnet.cfg"
+        print "Custom routes can be added in nfnet.cfg as route.<name> = host:port"
+    
+    def cmd_peers(self, args):
+        """Show links to other relays"""
+        peers = self.relay.router.get_stats()['peers']
+        if not peers:
+            print "No peer links open (links open on the first forward to a route)"
+            return
+        
+        print "Peer Links:"
+        print "=" * 50
+        for target in sorted(peers):
+            link = peers[target]
+            print "  %-21s %-10s in flight %-4d rtt p50 %.2fms  sent %d  reconnects %d" % (
+                target, link['state'], link['in_flight'], link['rtt']['p50'],
+                link['sent'], max(0, link['connects'] - 1))
+            if link['heartbeat_failures'] or link['connect_failures']:
+                print "  %-21s missed heartbeats %d, failed connects %d" % (
+                    "", link['heartbeat_failures'], link['connect_failures'])
     
     def cmd_cache(self, args):
         """Cache management"""
@@ -341,7 +502,8 @@ class Console:
         
         if subcmd == 'clear':
             if hasattr(self.relay, 'cache'):
-                self.relay.cache.clear()
+                with self.relay.lock:
+                    self.relay.cache.clear()
                 print "Cache cleared"
             else:
                 print "Cache not available"
@@ -352,7 +514,18 @@ class Console:
                 print "Cache Statistics:"
                 print "  Entries: %s" % size
                 print "  Max Size: %s" % self.config.cache_size
-                print "  Usage: %.1f%%" % ((float(size) / self.config.cache_size) * 100)
+                if self.config.cache_size:
+                    print "  Usage: %.1f%%" % ((float(size) / self.config.cache_size) * 100)
+                
+                if self.relay.cluster.enabled():
+                    cluster = self.relay.cluster.get_stats()
+                    print ""
+                    print "Cluster Cache (%s of %d nodes):" % (cluster['self'], len(cluster['nodes']))
+                    print "  Hits: %d near / %d local / %d remote, %d misses (%.1f%% hit rate)" % (
+                        cluster['near_hits'], cluster['local_hits'], cluster['remote_hits'],
+                        cluster['misses'], cluster['hit_rate'] * 100)
+                    print "  Near cache: %d entries, remote errors: %d" % (
+                        cluster['near_size'], cluster['remote_errors'])
             else:
                 print "Cache not available"
         
@@ -426,6 +599,173 @@ class Console:
         except:
             return False
     
+    def cmd_bench(self, args):
+        """Load test the local relay"""
+        import loadgen
+        
+        if not self.relay.running:
+            print "Relay is not running"
+            return
+        
+        try:
+            clients = int(args[0]) if len(args) > 0 else 10
+            duration = float(args[1]) if len(args) > 1 else 10
+            mix = loadgen.parse_mix(args[2]) if len(args) > 2 else None
+        except ValueError as e:
+            print "Usage: bench [clients] [seconds] [ping=40,html=20,js=20,route=20] [output.json]"
+            print "Error: %s" % str(e)
+            return
+        
+        print "Running load test: %d clients for %ss..." % (clients, duration)
+        print ""
+        
+        generator = loadgen.LoadGenerator("127.0.0.1", self.config.relay_port, clients,
+                                          duration, mix, report=loadgen.print_interval,
+                                          label="build %s" % self.config.build_number)
+        
+        try:
+            results = generator.run()
+        except KeyboardInterrupt:
+            generator.running = False
+            print "^C"
+            return
+        
+        loadgen.print_summary(results)
+        
+        if len(args) > 3:
+            loadgen.save_results(results, args[3])
+            print "Results saved to %s" % args[3]
+    
+    def cmd_profile(self, args):
+        """Sampling profiler control"""
+        from profiler import SamplingProfiler
+        
+        if not args:
+            print "Usage: profile start [seconds] [interval_ms]"
+            print "       profile stop"
+            print "       profile status"
+            return
+        
+        subcmd = args[0].lower()
+        running = self.profiler is not None and self.profiler.running
+        
+        if subcmd == 'start':
+            if running:
+                print "Profiler already running"
+                return
+            
+            try:
+                duration = float(args[1]) if len(args) > 1 else None
+                interval = float(args[2]) / 1000 if len(args) > 2 else 0.01
+            except ValueError:
+                print "Usage: profile start [seconds] [interval_ms]"
+                return
+            
+            self.profiler = SamplingProfiler(interval)
+            self.profiler.start(duration, on_stop=self._profile_done)
+            
+            print "Profiling all threads every %.1fms" % (interval * 1000)
+            if duration:
+                print "Stops automatically after %s seconds" % duration
+            else:
+                print "Type 'profile stop' to finish"
+        
+        elif subcmd == 'stop':
+            if not running:
+                print "Profiler is not running"
+                return
+            self.profiler.stop()
+        
+        elif subcmd == 'status':
+            if self.profiler is None:
+                print "Profiler has not been started"
+                return
+            status = self.profiler.get_status()
+            print "Profiler: %s" % ("RUNNING" if status['running'] else "STOPPED")
+            print "  Samples: %s (%s unique stacks)" % (status['samples'], status['stacks'])
+            print "  Time: %s seconds at %.1fms" % (status['seconds'], status['interval_ms'])
+        
+        else:
+            print "Unknown profile command: %s" % subcmd
+    
+    def _profile_done(self, profiler):
+        """Write profile results once sampling stops"""
+        prefix = "nfnet_profile_%s" % time.strftime("%Y%m%d_%H%M%S")
+        
+        try:
+            prof, folded = profiler.save(prefix)
+        except Exception as e:
+            print "Could not save profile: %s" % str(e)
+            return
+        
+        status = profiler.get_status()
+        print ""
+        print "Profile finished: %s samples over %s seconds" % (status['samples'], status['seconds'])
+        print "  pstats:    %s  (python -m pstats %s)" % (prof, prof)
+        print "  flamegraph: %s  (flamegraph.pl %s > profile.svg)" % (folded, folded)
+    
+    def cmd_trace(self, args):
+        """Per-packet tracing"""
+        tracer = self.relay.tracer
+        
+        if not args:
+            stats = tracer.get_stats()
+            print "Packet tracing: %s" % ("ON (%.1f%% sampled)" % (stats['sample_rate'] * 100)
+                                          if stats['sample_rate'] else "OFF")
+            print "  Stored: %s of %s traces (%s sampled)" % (
+                stats['stored'], stats['capacity'], stats['sampled'])
+            print ""
+            print "Usage: trace on [rate]          Trace a fraction of packets (default 1.0)"
+            print "       trace off                Stop tracing"
+            print "       trace slow [n]           Show the n slowest traces"
+            print "       trace client ip[:port] [n]  Show traces for one client"
+            print "       trace clear              Drop stored traces"
+            return
+        
+        subcmd = args[0].lower()
+        
+        try:
+            if subcmd == 'on':
+                rate = float(args[1]) if len(args) > 1 else 1.0
+                tracer.set_rate(rate)
+                print "Tracing %.1f%% of packets" % (tracer.sample_rate * 100)
+            
+            elif subcmd == 'off':
+                tracer.set_rate(0)
+                print "Tracing off"
+            
+            elif subcmd == 'clear':
+                tracer.clear()
+                print "Traces cleared"
+            
+            elif subcmd == 'slow':
+                count = int(args[1]) if len(args) > 1 else 10
+                self._print_traces(tracer.slowest(count))
+            
+            elif subcmd == 'client' and len(args) > 1:
+                host = args[1]
+                port = None
+                if ':' in host:
+                    host, port = host.rsplit(':', 1)
+                    port = int(port)
+                count = int(args[2]) if len(args) > 2 else 10
+                self._print_traces(tracer.for_client(host, port, count))
+            
+            else:
+                print "Unknown trace command: %s" % subcmd
+        
+        except ValueError:
+            print "Invalid number: %s" % ' '.join(args[1:])
+    
+    def _print_traces(self, traces):
+        """Print trace timelines"""
+        if not traces:
+            print "No traces stored (turn tracing on with 'trace on')"
+            return
+        
+        for trace in traces:
+            print trace.format()
+    
     def cmd_log(self, args):
         """Set log level"""
         if not args:
@@ -436,7 +776,8 @@ class Console:
         try:
             level = int(args[0])
             if 0 <= level <= 3:
-                self.config.log_level = level
+                # Through the relay so the running logger picks it up
+                self.relay.apply_config({'log_level': level})
                 print "Log level set to %s" % level
             else:
                 print "Log level must be 0-3"
@@ -456,6 +797,9 @@ class Console:
         print "  - Network statistics"
         print "  - Protocol information"
         print ""
+        print "Stats API: http://127.0.0.1:%s/api/stats" % self.config.intranet_port
+        print "Live feed: http://127.0.0.1:%s/api/stats/stream" % self.config.intranet_port
+        print ""
         print "Type 'open' to launch in default browser"
         print "Make sure logo.png is in resources/ folder"
     
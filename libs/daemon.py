@@ -0,0 +1,161 @@
+"""
+NFNET Daemon
+Headless service mode for running under a process supervisor
+"""
+
+import os
+import signal
+import sys
+import time
+
+
+class Daemon:
+    """Runs the relay without the console
+
+    SIGTERM and SIGINT stop the relay gracefully, SIGHUP reloads nfnet.cfg
+    at once instead of waiting for the config watcher.
+    READY is printed only once the relay and web sockets are bound.
+    
+    With takeover set, the listening sockets are taken from the daemon
+    already running, which then drains its connections and exits.
+    """
+    
+    def __init__(self, pidfile=None, started=None, takeover=False):
+        self.pidfile = pidfile
+        self.started = started or time.time()
+        self.takeover = takeover
+        self.running = False
+        self.reload_requested = False
+        self.config = None
+        self.relay = None
+        self.handoff = None
+    
+    def run(self):
+        """Start the relay and block until stopped, returns the exit code"""
+        import config
+        import relay
+        from handoff import HandoffServer, HandoffError, take_over, ready
+        
+        if self.pidfile and not self._write_pidfile():
+            return 1
+        
+        try:
+            self.config = config.Config()
+            self.relay = relay.RelayServer(self.config)
+            
+            signal.signal(signal.SIGTERM, self._on_stop)
+            signal.signal(signal.SIGINT, self._on_stop)
+            if hasattr(signal, 'SIGHUP'):
+                signal.signal(signal.SIGHUP, self._on_reload)
+            
+            # Everything is built before taking over, so the sockets go
+            # unserved only for as long as start() takes
+            listeners = None
+            if self.takeover:
+                try:
+                    conn, listeners = take_over(self.config.handoff_socket)
+                except HandoffError as e:
+                    print "[DAEMON ERROR] %s" % str(e)
+                    return 1
+            
+            if not self.relay.start(listeners):
+                print "[DAEMON ERROR] Relay failed to start"
+                return 1
+            
+            if listeners is not None:
+                ready(conn)
+            
+            self.handoff = HandoffServer(self.relay, self.config.handoff_socket)
+            self.handoff.start()
+            
+            self.running = True
+            startup_ms = (time.time() - self.started) * 1000
+            self.relay.stats['startup_ms'] = round(startup_ms, 1)
+            print "[DAEMON] READY pid=%d relay=%s web=%s startup=%.1fms" % (
+                os.getpid(), self.config.relay_port,
+                self.config.intranet_port if self.relay.web_server.running else "-",
+                startup_ms)
+            sys.stdout.flush()
+            
+            self._wait()
+            
+            self.handoff.stop()
+            if self.handoff.handed_off:
+                self.relay.drain(self.config.handoff_drain_timeout)
+            self.relay.stop()
+            print "[DAEMON] Stopped"
+            return 0
+        finally:
+            self._remove_pidfile()
+    
+    def _wait(self):
+        """Sleep until a signal asks us to stop"""
+        reported = False
+        
+        while self.running:
+            # A caught signal ends the sleep early, so stop is immediate
+            time.sleep(0.25)
+            
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            
+            if self.handoff.handed_off:
+                print "[DAEMON] Handed over to a new process, draining"
+                break
+            
+            first_accept = self.relay.first_accept
+            if first_accept and not reported:
+                reported = True
+                print "[DAEMON] First connection %.1fms after launch" % (
+                    (first_accept - self.started) * 1000)
+                sys.stdout.flush()
+    
+    def _on_stop(self, signum, frame):
+        """SIGTERM/SIGINT handler"""
+        print "[DAEMON] Signal %d received, stopping" % signum
+        self.running = False
+    
+    def _on_reload(self, signum, frame):
+        """SIGHUP handler, the reload itself runs outside the handler"""
+        self.reload_requested = True
+    
+    def reload(self):
+        """Re-read nfnet.cfg and apply it to the running relay"""
+        print "[DAEMON] Reloading configuration"
+        if not self.relay.config_watcher.check(full=True):
+            print "[DAEMON] No settings changed"
+        sys.stdout.flush()
+    
+    def _write_pidfile(self):
+        """Write our pid, refuse to start over a live process"""
+        # The process we take over from exits once drained
+        if os.path.exists(self.pidfile) and not self.takeover:
+            try:
+                with open(self.pidfile) as f:
+                    pid = int(f.read().strip())
+                os.kill(pid, 0)
+                print "[DAEMON ERROR] Already running with pid %d (%s)" % (pid, self.pidfile)
+                return False
+            except (ValueError, OSError):
+                print "[DAEMON] Removing stale pid file %s" % self.pidfile
+        
+        try:
+            with open(self.pidfile, 'w') as f:
+                f.write("%d\n" % os.getpid())
+        except IOError as e:
+            print "[DAEMON ERROR] Could not write pid file: %s" % str(e)
+            self.pidfile = None
+            return False
+        return True
+    
+    def _remove_pidfile(self):
+        """Remove the pid file if it is still ours"""
+        if not self.pidfile:
+            return
+        try:
+            with open(self.pidfile) as f:
+                if int(f.read().strip()) == os.getpid():
+                    os.remove(self.pidfile)
+        except (IOError, OSError, ValueError):
+            pass
@@ -0,0 +1,250 @@
+"""
+NFNET DNS Cache
+Caches upstream host lookups for the web proxy
+"""
+
+import socket
+import threading
+import time
+import httplib
+import urllib2
+
+from log import get_logger
+
+log = get_logger("DNS")
+
+
+def system_resolver(host, port):
+    """Resolve through the system resolver, which does not report a TTL"""
+    return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM), None
+
+
+class DNSCache:
+    """Thread-safe TTL cache in front of a resolver
+
+    resolver(host, port) must return (addrinfo_list, ttl) where ttl may be
+    None to use the default, or raise socket.gaierror. Failures are cached
+    for negative_ttl seconds. With refresh enabled, names that keep being
+    used are resolved again in the background shortly before they expire.
+    """
+    
+    def __init__(self, resolver=None, ttl=300, negative_ttl=30, max_entries=1024,
+                 refresh=False, refresh_interval=5, hot_hits=3):
+        self.resolver = resolver or system_resolver
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.refresh_interval = refresh_interval
+        self.hot_hits = hot_hits
+        
+        # (host, port) -> [addresses or None, error, expires, hits]
+        self.entries = {}
+        self.pending = {}            # Lookups in progress
+        self.lock = threading.Lock()
+        
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'negative_hits': 0,
+            'refreshes': 0,
+            'failures': 0
+        }
+        
+        self.running = False
+        if refresh:
+            self.start_refresh()
+    
+    def resolve(self, host, port):
+        """Return addrinfo list for host:port, raises socket.gaierror"""
+        key = (host, port)
+        
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry[2] > time.time():
+                    entry[3] += 1
+                    if entry[1] is not None:
+                        self.stats['negative_hits'] += 1
+                        raise entry[1]
+                    self.stats['hits'] += 1
+                    return entry[0]
+                
+                # Only one thread resolves a name, the others wait for it
+                event = self.pending.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self.pending[key] = event
+                    self.stats['misses'] += 1
+                    break
+            
+            event.wait(30)
+        
+        try:
+            return self._lookup(key, 0)
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+    
+    def _lookup(self, key, hits):
+        """Call the resolver and store the result"""
+        try:
+            addresses, ttl = self.resolver(key[0], key[1])
+        except socket.gaierror as e:
+            with self.lock:
+                self.stats['failures'] += 1
+                self._store(key, [None, e, time.time() + self.negative_ttl, hits])
+            raise
+        
+        if ttl is None:
+            ttl = self.ttl
+        
+        with self.lock:
+            self._store(key, [addresses, None, time.time() + ttl, hits])
+        
+        return addresses
+    
+    def _store(self, key, entry):
+        """Add entry, dropping expired ones when full (lock held)"""
+        if key not in self.entries and len(self.entries) >= self.max_entries:
+            now = time.time()
+            for old_key in [k for k, e in self.entries.items() if e[2] <= now]:
+                del self.entries[old_key]
+            
+            # Still full - drop the least used name
+            if len(self.entries) >= self.max_entries:
+                coldest = min(self.entries, key=lambda k: self.entries[k][3])
+                del self.entries[coldest]
+        
+        self.entries[key] = entry
+    
+    def cached(self, host, port):
+        """True if host:port would be answered without a lookup"""
+        with self.lock:
+            entry = self.entries.get((host, port))
+            return entry is not None and entry[2] > time.time()
+    
+    def invalidate(self, host, port=None):
+        """Forget a host, for all ports if port is None"""
+        with self.lock:
+            for key in self.entries.keys():
+                if key[0] == host and (port is None or key[1] == port):
+                    del self.entries[key]
+    
+    def clear(self):
+        """Forget all names"""
+        with self.lock:
+            self.entries.clear()
+    
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                          source_address=None):
+        """socket.create_connection() using cached addresses"""
+        host, port = address
+        error = None
+        
+        for family, socktype, proto, canonname, sockaddr in self.resolve(host, port):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except socket.error as e:
+                error = e
+                if sock is not None:
+                    sock.close()
+        
+        # Every cached address failed - the record is probably stale
+        self.invalidate(host, port)
+        
+        if error is not None:
+            raise error
+        raise socket.error("getaddrinfo returns an empty list")
+    
+    def start_refresh(self):
+        """Start refreshing hot names in the background"""
+        if self.running:
+            return False
+        
+        self.running = True
+        thread = threading.Thread(target=self._refresh_loop)
+        thread.daemon = True
+        thread.start()
+        return True
+    
+    def stop_refresh(self):
+        """Stop the refresh thread"""
+        self.running = False
+    
+    def _refresh_loop(self):
+        """Re-resolve hot names before they expire"""
+        while self.running:
+            time.sleep(self.refresh_interval)
+            
+            horizon = time.time() + self.refresh_interval * 2
+            with self.lock:
+                due = [key for key, entry in self.entries.items()
+                       if entry[1] is None and entry[2] <= horizon and entry[3] >= self.hot_hits]
+            
+            for key in due:
+                try:
+                    # Hits restart at zero so names that went cold expire
+                    self._lookup(key, 0)
+                    with self.lock:
+                        self.stats['refreshes'] += 1
+                except socket.gaierror:
+                    pass
+                except Exception as e:
+                    log.error("Refresh %s: %s", key[0], str(e))
+    
+    def get_stats(self):
+        """Get cache statistics"""
+        with self.lock:
+            stats = self.stats.copy()
+            stats['entries'] = len(self.entries)
+        
+        return stats
+
+
+class DNSCacheHTTPHandler(urllib2.HTTPHandler):
+    """urllib2 HTTP handler that connects through a DNSCache"""
+    
+    def __init__(self, dns_cache):
+        urllib2.HTTPHandler.__init__(self)
+        self.dns_cache = dns_cache
+    
+    def http_open(self, req):
+        return self.do_open(self._connection, req)
+    
+    def _connection(self, host, **kwargs):
+        conn = httplib.HTTPConnection(host, **kwargs)
+        conn._create_connection = self.dns_cache.create_connection
+        return conn
+
+
+class DNSCacheHTTPSHandler(urllib2.HTTPSHandler):
+    """urllib2 HTTPS handler that connects through a DNSCache"""
+    
+    def __init__(self, dns_cache):
+        urllib2.HTTPSHandler.__init__(self)
+        self.dns_cache = dns_cache
+    
+    def https_open(self, req):
+        if getattr(self, '_context', None) is not None:
+            return self.do_open(self._connection, req, context=self._context)
+        return self.do_open(self._connection, req)
+    
+    def _connection(self, host, **kwargs):
+        # Certificates are still checked against the host name
+        conn = httplib.HTTPSConnection(host, **kwargs)
+        conn._create_connection = self.dns_cache.create_connection
+        return conn
+
+
+def build_opener(dns_cache):
+    """Build a urllib2 opener that resolves hosts through dns_cache"""
+    return urllib2.build_opener(DNSCacheHTTPHandler(dns_cache),
+                                DNSCacheHTTPSHandler(dns_cache))
@@ -0,0 +1,165 @@
+"""
+NFNET Fragments
+Splits large payloads into sequenced packets and reassembles them
+"""
+
+import mmap
+import tempfile
+
+from protocol import Packet
+
+FRAGMENT_SIZE = 262144           # Payload bytes per fragment
+SPOOL_THRESHOLD = 1048576        # Larger transfers are spooled to disk
+MAX_TRANSFER = 1073741824        # Largest payload accepted in fragments
+MAX_TRANSFERS = 16               # Unfinished transfers per connection
+
+
+def split(packet, size=FRAGMENT_SIZE):
+    """Yield the fragments of a packet, each carrying its ID
+
+    Frag-Seq numbers the fragments from 0 and Frag-Total is the length of
+    the whole payload, so the receiver knows when it is complete. The
+    payload may be an mmap, only one fragment is copied out at a time.
+    """
+    payload = packet.payload
+    total = len(payload)
+    
+    for seq in xrange(max(1, (total + size - 1) // size)):
+        options = dict(packet.options)
+        options['Frag-Seq'] = str(seq)
+        options['Frag-Total'] = str(total)
+        
+        fragment = Packet(packet.type, payload[seq * size:(seq + 1) * size], options)
+        fragment.id = packet.id
+        yield fragment
+
+
+class Spool:
+    """Payload being reassembled
+
+    Kept in memory up to threshold bytes, written to an unlinked temp file
+    beyond that and handed out as a read-only mmap, so a large payload
+    costs page cache rather than heap.
+    """
+    
+    def __init__(self, total, threshold=SPOOL_THRESHOLD):
+        self.total = total
+        self.size = 0
+        self.parts = []
+        self.file = None
+        if total > threshold:
+            self.file = tempfile.TemporaryFile(prefix="nfnet-")
+    
+    def write(self, data):
+        """Append a fragment's payload"""
+        if self.file is not None:
+            self.file.write(data)
+        else:
+            self.parts.append(data)
+        self.size += len(data)
+    
+    def view(self):
+        """The whole payload, an mmap when spooled"""
+        if self.file is None:
+            return ''.join(self.parts)
+        
+        self.file.flush()
+        if not self.size:
+            return ''
+        # The mapping outlives the file, its space is freed with the mmap
+        return mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+    
+    def close(self):
+        """Drop the payload"""
+        self.parts = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Reassembler:
+    """Collects the fragments of packets arriving on one connection
+
+    Transfers are keyed by packet ID and fragments must arrive in order,
+    which a single TCP connection guarantees. At most max_transfers may be
+    unfinished at once, and together the ones kept in memory never take
+    more than threshold bytes; a transfer that does not fit is spooled.
+    """
+    
+    def __init__(self, threshold=SPOOL_THRESHOLD, max_transfer=MAX_TRANSFER, max_transfers=MAX_TRANSFERS):
+        self.threshold = threshold
+        self.max_transfer = max_transfer
+        self.max_transfers = max_transfers
+        self.transfers = {}          # packet id -> [spool, next seq]
+        self.in_memory = 0           # Bytes reserved by transfers kept in memory
+        self.spooled = 0             # Transfers that went to disk
+    
+    def add(self, fragment):
+        """Add a fragment, returns the whole packet once it is complete
+
+        Raises ValueError for a fragment that is malformed, out of
+        sequence, part of a transfer over max_transfer bytes or one
+        transfer more than max_transfers.
+        """
+        try:
+            seq = int(fragment.options['Frag-Seq'])
+            total = int(fragment.options['Frag-Total'])
+        except (KeyError, ValueError):
+            raise ValueError("Bad fragment options")
+        
+        transfer = self.transfers.get(fragment.id)
+        if transfer is None:
+            if seq != 0:
+                raise ValueError("Fragment %d of unknown transfer %d" % (seq, fragment.id))
+            if total < 0 or total > self.max_transfer:
+                raise ValueError("Transfer too large (%d bytes)" % total)
+            if len(self.transfers) >= self.max_transfers:
+                raise ValueError("Too many transfers in progress (%d)" % len(self.transfers))
+            
+            # Memory left to this connection decides where it goes
+            spool = Spool(total, self.threshold - self.in_memory)
+            if spool.file is not None:
+                self.spooled += 1
+            else:
+                self.in_memory += total
+            transfer = self.transfers[fragment.id] = [spool, 0]
+        
+        spool = transfer[0]
+        if seq != transfer[1] or spool.size + len(fragment.payload) > spool.total:
+            self.discard(fragment.id)
+            raise ValueError("Fragment %d of transfer %d out of sequence" % (seq, fragment.id))
+        
+        spool.write(fragment.payload)
+        transfer[1] += 1
+        if spool.size < spool.total:
+            return None
+        
+        self.discard(fragment.id, close=False)
+        options = dict((key, value) for key, value in fragment.options.items()
+                       if not key.startswith('Frag-'))
+        
+        packet = Packet(fragment.type, spool.view(), options)
+        packet.id = fragment.id
+        packet.timestamp = fragment.timestamp
+        packet.fragmented = True
+        spool.close()
+        return packet
+    
+    def discard(self, packet_id, close=True):
+        """Abandon a transfer"""
+        transfer = self.transfers.pop(packet_id, None)
+        if transfer is None:
+            return
+        if transfer[0].file is None:
+            self.in_memory -= transfer[0].total
+        if close:
+            transfer[0].close()
+    
+    def close(self):
+        """Abandon every transfer, the connection is gone"""
+        for packet_id in self.transfers.keys():
+            self.discard(packet_id)
+    
+    def pending_bytes(self):
+        """Bytes received for transfers not yet complete"""
+        return sum(transfer[0].size for transfer in self.transfers.values())
@@ -0,0 +1,206 @@
+"""
+NFNET Handoff
+Passes listening sockets to a new relay process for zero-downtime restarts
+"""
+
+import os
+import select
+import socket
+import threading
+
+from log import get_logger
+
+log = get_logger("HANDOFF")
+
+try:
+    # SCM_RIGHTS file descriptor passing, Unix only
+    from _multiprocessing import sendfd, recvfd
+except ImportError:
+    sendfd = recvfd = None
+
+HANDOFF_TIMEOUT = 10.0
+
+
+class HandoffError(Exception):
+    """The takeover could not be completed"""
+    pass
+
+
+def _read_line(conn):
+    """Read one line a byte at a time, the descriptors follow it"""
+    line = []
+    while True:
+        char = conn.recv(1)
+        if not char:
+            raise HandoffError("Connection closed during handoff")
+        if char == "\n":
+            return ''.join(line)
+        line.append(char)
+
+
+class HandoffServer:
+    """Hands this relay's listening sockets to a process taking over
+
+    The new process connects to the Unix socket at path and asks for
+    TAKEOVER. We stop accepting, pass the relay and web listening sockets
+    with SCM_RIGHTS and wait for READY; from then on the kernel queues new
+    connections for the new process while we drain ours. The sockets never
+    close, so no connection is refused during the switch.
+    """
+    
+    def __init__(self, relay, path):
+        self.relay = relay
+        self.path = path
+        self.sock = None
+        self.running = False
+        self.handed_off = False
+    
+    def start(self):
+        """Listen for a takeover"""
+        if sendfd is None:
+            log.info("Socket handoff is not supported on this platform")
+            return False
+        
+        try:
+            self._listen()
+        except socket.error as e:
+            log.error("Cannot listen on %s: %s", self.path, str(e))
+            return False
+        
+        self.running = True
+        
+        thread = threading.Thread(target=self._serve, name="handoff")
+        thread.daemon = True
+        thread.start()
+        return True
+    
+    def stop(self):
+        """Stop listening"""
+        self.running = False
+        self._unlisten()
+        return True
+    
+    def _listen(self):
+        """Bind the Unix socket, replacing one left by a dead process"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(1)
+        self.sock = sock
+    
+    def _unlisten(self):
+        """Close the Unix socket so the new process can bind the path"""
+        sock, self.sock = self.sock, None
+        if sock is None:
+            return
+        
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+    
+    def _serve(self):
+        """Wait for a process to take over"""
+        while self.running:
+            sock = self.sock
+            if sock is None:
+                break
+            try:
+                conn, address = sock.accept()
+            except socket.error:
+                break
+            
+            if self._hand_off(conn):
+                self.handed_off = True
+                return
+    
+    def _hand_off(self, conn):
+        """Pass the listening sockets, returns True once the taker is serving"""
+        conn.settimeout(HANDOFF_TIMEOUT)
+        paused = False
+        
+        try:
+            if _read_line(conn) != "TAKEOVER":
+                return False
+            
+            # One taker at a time, and it binds our path once it is up
+            self._unlisten()
+            self.relay.pause_accepting()
+            paused = True
+            
+            listeners = self.relay.listeners()
+            names = sorted(listeners)
+            conn.sendall("SOCKETS %s\n" % ' '.join(names))
+            for name in names:
+                sendfd(conn.fileno(), listeners[name].fileno())
+            
+            if _read_line(conn) == "READY":
+                log.info("New process is serving on %s", ', '.join(names))
+                return True
+        except (socket.error, OSError, HandoffError) as e:
+            log.warn("Takeover failed: %s", str(e))
+        finally:
+            conn.close()
+        
+        # The taker died before it was ready, carry on serving
+        if paused:
+            log.info("Resuming service")
+            self.relay.resume_accepting()
+            try:
+                self._listen()
+            except socket.error as e:
+                log.error("Cannot listen on %s: %s", self.path, str(e))
+                self.running = False
+        return False
+
+
+def take_over(path, timeout=HANDOFF_TIMEOUT):
+    """Get the listening sockets of the relay serving at path
+
+    Returns the connection and a {name: socket} dict; call ready() on the
+    connection once the sockets are being accepted on.
+    """
+    if recvfd is None:
+        raise HandoffError("Socket handoff is not supported on this platform")
+    
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    listeners = {}
+    
+    try:
+        conn.connect(path)
+        conn.sendall("TAKEOVER\n")
+        
+        line = _read_line(conn)
+        if not line.startswith("SOCKETS"):
+            raise HandoffError("Unexpected reply %r" % line)
+        
+        for name in line.split()[1:]:
+            if not select.select([conn], [], [], timeout)[0]:
+                raise HandoffError("Timed out waiting for the %s socket" % name)
+            fd = recvfd(conn.fileno())
+            listeners[name] = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+            os.close(fd)
+    except (socket.error, OSError, HandoffError) as e:
+        conn.close()
+        for sock in listeners.values():
+            sock.close()
+        raise HandoffError("Cannot take over from %s: %s" % (path, str(e)))
+    
+    return conn, listeners
+
+
+def ready(conn):
+    """Tell the old process we are accepting, it starts draining"""
+    try:
+        conn.sendall("READY\n")
+    except socket.error as e:
+        log.warn("Could not confirm takeover: %s", str(e))
+    conn.close()
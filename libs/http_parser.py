@@ -0,0 +1,132 @@
+"""
+NFNET HTTP Request Parser
+Incremental HTTP/1.x parser for the intranet web server
+"""
+
+# Limits
+MAX_HEADER_SIZE = 16384      # Request line + headers
+MAX_BODY_SIZE = 1048576      # 1MB request bodies
+
+
+class HTTPError(Exception):
+    """Request can not be parsed - answer with status and close"""
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+class HTTPRequest:
+    """A single parsed HTTP request"""
+
+    def __init__(self, method, path, version, headers, body=""):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers       # Lower-case names
+        self.body = body
+
+        # HTTP/1.1 is persistent unless told otherwise, 1.0 only on request
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            self.keep_alive = 'keep-alive' in connection
+        else:
+            self.keep_alive = 'close' not in connection
+
+        # Filled in while answering, for the access log
+        self.status = None
+        self.sent = 0                # Response body bytes
+        self.url = None              # Upstream URL of a proxied request
+        self.upstream = None         # Seconds spent fetching it
+        self.cache = None            # Proxy DNS cache 'hit' or 'miss'
+        self.detached = False        # Socket handed to the stats stream
+    
+    def __str__(self):
+        return "%s %s %s" % (self.method, self.path, self.version)
+
+
+class HTTPRequestParser:
+    """Feed raw bytes in, get complete requests out
+
+    Handles requests split across packets, several pipelined requests
+    in one packet and Content-Length bodies.
+    """
+
+    def __init__(self, max_header_size=MAX_HEADER_SIZE, max_body_size=MAX_BODY_SIZE):
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.buffer = ""
+        self._pending = None         # Request waiting for its body
+        self._body_length = 0
+
+    def feed(self, data):
+        """Add received data, return list of completed requests"""
+        self.buffer += data
+        requests = []
+
+        while True:
+            if self._pending is None:
+                end = self.buffer.find('\r\n\r\n')
+                if end < 0:
+                    if len(self.buffer) > self.max_header_size:
+                        raise HTTPError(431, "Request header fields too large")
+                    break
+
+                if end > self.max_header_size:
+                    raise HTTPError(431, "Request header fields too large")
+
+                head = self.buffer[:end]
+                self.buffer = self.buffer[end + 4:]
+                self._pending = self._parse_head(head)
+
+            # Wait for the whole body
+            if len(self.buffer) < self._body_length:
+                break
+
+            request = self._pending
+            request.body = self.buffer[:self._body_length]
+            self.buffer = self.buffer[self._body_length:]
+            self._pending = None
+            self._body_length = 0
+            requests.append(request)
+
+        return requests
+
+    def _parse_head(self, head):
+        """Parse request line and headers"""
+        lines = head.split('\r\n')
+
+        # Tolerate blank lines between pipelined requests
+        while lines and not lines[0]:
+            lines.pop(0)
+        if not lines:
+            raise HTTPError(400, "Empty request")
+
+        parts = lines[0].split()
+        if len(parts) == 2:
+            parts.append('HTTP/1.0')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise HTTPError(400, "Bad request line")
+
+        method, path, version = parts
+
+        headers = {}
+        for line in lines[1:]:
+            if ':' not in line:
+                raise HTTPError(400, "Bad header line")
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise HTTPError(501, "Chunked request bodies not supported")
+
+        length = headers.get('content-length', '0')
+        if not length.isdigit():
+            raise HTTPError(400, "Bad Content-Length")
+
+        self._body_length = int(length)
+        if self._body_length > self.max_body_size:
+            raise HTTPError(413, "Request body too large")
+
+        return HTTPRequest(method.upper(), path, version, headers)
@@ -0,0 +1,303 @@
+"""
+NFNET Load Generator
+Drives concurrent clients against a running relay
+"""
+
+import json
+import random
+import threading
+import time
+from collections import deque
+
+from client import Client, ClientError
+from protocol import MessageHandler
+from metrics import Reservoir, summarize
+
+# Default packet mix, weights
+DEFAULT_MIX = {'ping': 40, 'html': 20, 'js': 20, 'route': 20}
+
+SAMPLE_HTML = '''<html>
+<head><title>NFNET load test</title></head>
+<body>
+<h1>Load test page %s</h1>
+''' + '<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n' * 30 + '''</body>
+</html>'''
+
+SAMPLE_JS = '''// NFNET load test script %s
+function add(a, b) {
+    // add two numbers
+    return a + b;
+}
+''' + 'var total = add(total || 0, 1); // count\n' * 40
+
+
+def parse_mix(text):
+    """Parse 'ping=40,html=20,js=20,route=20' into a weight dict"""
+    mix = {}
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        name, weight = part.split('=', 1)
+        name = name.strip().lower()
+        if name not in DEFAULT_MIX:
+            raise ValueError("Unknown packet kind: %s" % name)
+        mix[name] = int(weight)
+    
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError("Packet mix is empty")
+    return mix
+
+
+class LoadGenerator:
+    """Run N clients against a relay and collect latency per interval"""
+    
+    def __init__(self, host="127.0.0.1", port=28080, clients=10, duration=10,
+                 mix=None, window=1, unique=0.0, interval=1.0, report=None, label="",
+                 destination=None):
+        self.host = host
+        self.port = port
+        self.clients = clients
+        self.duration = duration
+        self.mix = mix or DEFAULT_MIX
+        self.window = window         # Requests in flight per client
+        self.unique = unique         # Fraction of DATA payloads made unique
+        self.interval = interval
+        self.report = report         # Called with each interval's results
+        self.label = label           # Build or run name saved with results
+        self.destination = destination  # Route name to forward every packet to
+        self.running = False
+        
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.connect_failures = 0
+        self.intervals = []
+        self.all_latencies = Reservoir()  # Whole run, bounded
+        self.total_errors = 0
+        
+        # Cumulative weights for picking packet kinds
+        self.kinds = []
+        total = 0
+        for name in sorted(self.mix):
+            total += self.mix[name]
+            self.kinds.append((total, name))
+        self.total_weight = total
+    
+    def run(self):
+        """Run the test, returns the results dict"""
+        self.running = True
+        self.started = time.time()
+        deadline = self.started + self.duration
+        
+        threads = []
+        for i in range(self.clients):
+            thread = threading.Thread(target=self._client_loop, args=(i, deadline))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        
+        # Collect one sample per interval until the deadline
+        next_tick = self.started + self.interval
+        while time.time() < deadline:
+            time.sleep(max(0, min(next_tick, deadline) - time.time()))
+            self._collect()
+            next_tick += self.interval
+        
+        self.running = False
+        for thread in threads:
+            thread.join(10)
+        self._collect(final=True)
+        
+        return self.results()
+    
+    def _make_packet(self, rng, client_id):
+        """Pick a packet kind according to the mix"""
+        packet = self._make_inner(rng, client_id)
+        if self.destination:
+            return MessageHandler.create_forward(self.destination, packet)
+        return packet
+    
+    def _make_inner(self, rng, client_id):
+        """Packet of a kind picked according to the mix"""
+        pick = rng.uniform(0, self.total_weight)
+        kind = self.kinds[-1][1]
+        for limit, name in self.kinds:
+            if pick < limit:
+                kind = name
+                break
+        
+        tag = "%d-%d" % (client_id, rng.randint(0, 1 << 30)) if rng.random() < self.unique else "static"
+        
+        if kind == 'ping':
+            return MessageHandler.create_ping()
+        elif kind == 'html':
+            return MessageHandler.create_data(SAMPLE_HTML % tag, "text/html")
+        elif kind == 'js':
+            return MessageHandler.create_data(SAMPLE_JS % tag, "application/javascript")
+        else:
+            return MessageHandler.create_route_command("lookup", "relay")
+    
+    def _client_loop(self, client_id, deadline):
+        """One client: keep window requests in flight until the deadline"""
+        rng = random.Random(client_id)
+        client = Client(self.host, self.port)
+        client.verbose = False
+        
+        if not client.connect():
+            with self.lock:
+                self.connect_failures += 1
+            return
+        
+        in_flight = deque()
+        try:
+            while self.running and time.time() < deadline and client.connected:
+                while len(in_flight) < self.window:
+                    in_flight.append(client.send_async(self._make_packet(rng, client_id)))
+                self._finish(in_flight.popleft())
+            
+            while in_flight:
+                self._finish(in_flight.popleft())
+        finally:
+            client.disconnect()
+    
+    def _finish(self, future):
+        """Wait for one request and record it"""
+        try:
+            response = future.result(5)
+            ok = response is not None and response.type != "ERROR"
+        except ClientError:
+            ok = False
+        
+        with self.lock:
+            if ok:
+                self.latencies.append(future.finished_at - future.sent_at)
+            else:
+                self.errors += 1
+    
+    def _collect(self, final=False):
+        """Close the current interval"""
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            errors, self.errors = self.errors, 0
+        
+        # Requests drained after the deadline only count in the summary
+        if final:
+            self.all_latencies.extend(latencies)
+            self.total_errors += errors
+            return
+        
+        elapsed = time.time() - self.started
+        if self.intervals:
+            span = elapsed - self.intervals[-1]['time']
+        else:
+            span = elapsed
+        if span <= 0:
+            return
+        
+        total = len(latencies) + errors
+        sample = summarize(latencies)
+        sample['time'] = round(elapsed, 2)
+        sample['throughput'] = round(len(latencies) / span, 1)
+        sample['errors'] = errors
+        sample['error_rate'] = round(float(errors) / total, 4) if total else 0.0
+        
+        self.intervals.append(sample)
+        self.all_latencies.extend(latencies)
+        self.total_errors += errors
+        
+        if self.report:
+            self.report(sample)
+    
+    def results(self):
+        """Summary of the whole run"""
+        elapsed = time.time() - self.started
+        total = self.all_latencies.count + self.total_errors
+        
+        summary = self.all_latencies.summary()
+        summary['requests'] = total
+        summary['errors'] = self.total_errors
+        summary['error_rate'] = round(float(self.total_errors) / total, 4) if total else 0.0
+        summary['throughput'] = round(self.all_latencies.count / elapsed, 1) if elapsed else 0.0
+        summary['connect_failures'] = self.connect_failures
+        
+        return {
+            'label': self.label,
+            'target': "%s:%s" % (self.host, self.port),
+            'clients': self.clients,
+            'duration': self.duration,
+            'window': self.window,
+            'unique': self.unique,
+            'mix': self.mix,
+            'destination': self.destination,
+            'started': self.started,
+            'summary': summary,
+            'intervals': self.intervals
+        }
+
+
+def print_interval(sample):
+    """Print one interval line"""
+    print "  %6.1fs %9.1f req/s  err %5.2f%%  p50 %7.2fms  p90 %7.2fms  p99 %7.2fms" % (
+        sample['time'], sample['throughput'], sample['error_rate'] * 100,
+        sample['p50'], sample['p90'], sample['p99'])
+
+
+def print_summary(results):
+    """Print the summary of a run"""
+    summary = results['summary']
+    print ""
+    print "Load Test Results (%s, %d clients, %ss)" % (
+        results['target'], results['clients'], results['duration'])
+    print "=" * 50
+    print "  Requests:     %d (%d errors, %.2f%%)" % (
+        summary['requests'], summary['errors'], summary['error_rate'] * 100)
+    print "  Throughput:   %.1f req/s" % summary['throughput']
+    print "  Latency:      min %.2f / mean %.2f / p50 %.2f / p90 %.2f / p99 %.2f / max %.2f ms" % (
+        summary['min'], summary['mean'], summary['p50'], summary['p90'],
+        summary['p99'], summary['max'])
+    if summary['connect_failures']:
+        print "  Connect failures: %d" % summary['connect_failures']
+
+
+def save_results(results, path):
+    """Write results as JSON for comparing runs"""
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def main(argv):
+    """Command line entry point"""
+    from optparse import OptionParser
+    
+    parser = OptionParser(usage="%prog load [options]")
+    parser.add_option("-H", "--host", default="127.0.0.1", help="relay host")
+    parser.add_option("-p", "--port", type="int", default=28080, help="relay port")
+    parser.add_option("-c", "--clients", type="int", default=10, help="concurrent clients")
+    parser.add_option("-d", "--duration", type="float", default=10, help="seconds to run")
+    parser.add_option("-m", "--mix", default="ping=40,html=20,js=20,route=20",
+                      help="packet mix, e.g. ping=40,html=20,js=20,route=20")
+    parser.add_option("-w", "--window", type="int", default=1, help="requests in flight per client")
+    parser.add_option("-u", "--unique", type="float", default=0.0,
+                      help="fraction of DATA payloads made unique (cache misses)")
+    parser.add_option("-D", "--destination", help="forward every packet to this route name")
+    parser.add_option("-l", "--label", default="", help="build or run name saved with the results")
+    parser.add_option("-o", "--output", help="write JSON results to this file")
+    options, args = parser.parse_args(argv)
+    
+    try:
+        mix = parse_mix(options.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    print "Running load test against %s:%s for %ss..." % (options.host, options.port, options.duration)
+    generator = LoadGenerator(options.host, options.port, options.clients, options.duration,
+                              mix, options.window, options.unique, report=print_interval,
+                              label=options.label, destination=options.destination)
+    results = generator.run()
+    print_summary(results)
+    
+    if options.output:
+        save_results(results, options.output)
+        print "Results saved to %s" % options.output
+    
+    return 0 if results['summary']['requests'] else 1
@@ -0,0 +1,277 @@
+"""
+NFNET Logging
+Leveled logging written by a background thread
+"""
+
+import os
+import sys
+import threading
+import time
+import Queue
+
+ERROR, WARN, INFO, DEBUG = 0, 1, 2, 3
+
+# Suffix after the tag, "[RELAY WARN] ..." as the relay always printed
+LABELS = {ERROR: " ERROR", WARN: " WARN", INFO: "", DEBUG: " DEBUG"}
+
+
+class Logger:
+    """Messages for one tag
+
+    Arguments are only formatted into the message when its level is
+    enabled, so a disabled debug() costs a method call and a comparison.
+    """
+    
+    def __init__(self, name, writer):
+        self.name = name
+        self.writer = writer
+    
+    def error(self, message, *args):
+        if self.writer.level >= ERROR:
+            self.writer.emit(ERROR, self.name, message, args)
+    
+    def warn(self, message, *args):
+        if self.writer.level >= WARN:
+            self.writer.emit(WARN, self.name, message, args)
+    
+    def info(self, message, *args):
+        if self.writer.level >= INFO:
+            self.writer.emit(INFO, self.name, message, args)
+    
+    def debug(self, message, *args):
+        if self.writer.level >= DEBUG:
+            self.writer.emit(DEBUG, self.name, message, args)
+    
+    def enabled(self, level):
+        """True if messages at level are recorded"""
+        return self.writer.level >= level
+
+
+class LogWriter:
+    """Queues log lines and writes them to log_file and the console
+
+    Callers never wait on I/O: lines go into a bounded queue and are
+    dropped, and counted, when it is full. Each message template may log
+    log_rate_limit times a second, repeats beyond that are summed up in a
+    single line once the second is over. The file is rotated to
+    log_file.1 .. log_file.N when it passes log_max_bytes.
+
+    Until configure() is called, and again after stop(), lines are
+    printed directly, so tools that never start a relay behave as before.
+    """
+    
+    def __init__(self):
+        self.level = INFO
+        self.console_level = INFO
+        self.path = None
+        self.max_bytes = 10485760
+        self.backups = 3
+        self.rate_limit = 20
+        self.queue = None
+        self.thread = None
+        self.file = None
+        self.recent = {}             # (tag, template) -> [window start, count, suppressed]
+        
+        self.stats = {
+            'written': 0,
+            'dropped': 0,
+            'suppressed': 0,
+            'rotations': 0
+        }
+    
+    def configure(self, config):
+        """Apply the log settings, starting the writer on first use"""
+        self.level = config.log_level
+        self.console_level = config.log_console_level
+        self.max_bytes = config.log_max_bytes
+        self.backups = config.log_backups
+        self.rate_limit = config.log_rate_limit
+        
+        path = config.log_file or None
+        if self.queue is None:
+            self.path = path
+            self.queue = Queue.Queue(config.log_queue_size)
+            self.thread = threading.Thread(target=self._run, args=(self.queue,), name="log-writer")
+            self.thread.daemon = True
+            self.thread.start()
+        elif path != self.path:
+            # The writer thread reopens the file on its next batch
+            self.path = path
+    
+    def emit(self, level, name, message, args):
+        """Rate limit, format and queue one message"""
+        if self.rate_limit:
+            # Races between threads only blur the counts, no lock needed
+            now = time.time()
+            key = (name, message)
+            window = self.recent.get(key)
+            if window is None or now - window[0] >= 1.0:
+                if window is not None and window[2]:
+                    self._queue(level, self._summary(key, window[2]))
+                self.recent[key] = [now, 1, 0]
+            else:
+                window[1] += 1
+                if window[1] > self.rate_limit:
+                    window[2] += 1
+                    self.stats['suppressed'] += 1
+                    return
+        
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = "%s %r" % (message, args)
+        
+        self._queue(level, "[%s%s] %s" % (name, LABELS[level], message))
+    
+    def _summary(self, key, count):
+        return "[%s] %d more like: %s" % (key[0], count, key[1])
+    
+    def _queue(self, level, line):
+        """Hand a line to the writer thread"""
+        if self.queue is None:
+            print line
+            return
+        
+        try:
+            self.queue.put_nowait((time.time(), level, line))
+        except Queue.Full:
+            self.stats['dropped'] += 1
+    
+    def _run(self, queue):
+        """Write queued lines in batches until stop() queues None"""
+        running = True
+        while running:
+            try:
+                batch = [queue.get(timeout=1.0)]
+            except Queue.Empty:
+                self._sweep()
+                continue
+            
+            while len(batch) < 512 and batch[-1] is not None:
+                try:
+                    batch.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            
+            if batch[-1] is None:
+                running = False
+            
+            try:
+                self._write([item for item in batch if item is not None])
+            except Exception as e:
+                print "[LOG ERROR] Write failed: %s" % str(e)
+            finally:
+                for item in batch:
+                    queue.task_done()
+        
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    
+    def _write(self, batch):
+        """Write one batch to the console and the log file"""
+        console = [line for stamp, level, line in batch if level <= self.console_level]
+        if console:
+            sys.stdout.write('\n'.join(console) + '\n')
+            sys.stdout.flush()
+        
+        if self.file is not None and self.file.name != self.path:
+            self.file.close()
+            self.file = None
+        if self.path is None:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        
+        lines = []
+        for stamp, level, line in batch:
+            lines.append("%s %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stamp)), line))
+        self.file.write(''.join(lines))
+        self.file.flush()
+        self.stats['written'] += len(lines)
+        
+        if self.max_bytes and self.file.tell() > self.max_bytes:
+            self._rotate()
+    
+    def _rotate(self):
+        """Move log_file to log_file.1, shifting older copies up"""
+        self.file.close()
+        self.file = None
+        
+        for i in range(self.backups - 1, 0, -1):
+            older = "%s.%d" % (self.path, i)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.stats['rotations'] += 1
+    
+    def _sweep(self):
+        """Report suppressed repeats once things go quiet, forget old templates"""
+        now = time.time()
+        for key, window in self.recent.items():
+            if now - window[0] < 1.0:
+                continue
+            if window[2]:
+                self._queue(INFO, self._summary(key, window[2]))
+                window[2] = 0
+            if now - window[0] > 60:
+                self.recent.pop(key, None)
+    
+    def flush(self, timeout=1.0):
+        """Wait for queued lines to be written"""
+        deadline = time.time() + timeout
+        while self.queue is not None and self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+    
+    def stop(self, timeout=1.0):
+        """Write the queued lines and end the writer thread"""
+        queue, self.queue = self.queue, None
+        if queue is None:
+            return False
+        
+        # Lines logged from here on are printed directly
+        try:
+            queue.put(None, timeout=timeout)
+        except Queue.Full:
+            pass
+        self.thread.join(timeout)
+        self.thread = None
+        return True
+    
+    def get_stats(self):
+        """Get logging statistics"""
+        stats = self.stats.copy()
+        stats['queued'] = self.queue.qsize() if self.queue is not None else 0
+        return stats
+
+
+_writer = LogWriter()
+
+
+def get_logger(name):
+    """Logger that tags its messages [name]"""
+    return Logger(name, _writer)
+
+
+def configure(config):
+    """Apply log_level, log_file and the other log settings"""
+    _writer.configure(config)
+
+
+def flush(timeout=1.0):
+    """Wait for queued lines to be written"""
+    _writer.flush(timeout)
+
+
+def stop(timeout=1.0):
+    """Write queued lines and stop the writer thread"""
+    return _writer.stop(timeout)
+
+
+def get_stats():
+    """Get logging statistics"""
+    return _writer.get_stats()
@@ -0,0 +1,126 @@
+"""
+NFNET Metrics
+Helpers for latency distributions
+"""
+
+import bisect
+import random
+
+# Histogram bucket upper bounds in seconds, 25% apart from 0.1ms to ~50s
+LATENCY_BOUNDS = [0.0001 * 1.25 ** i for i in range(60)]
+
+
+def percentile(values, pct):
+    """Value at percentile pct (0-100) of an already sorted list"""
+    if not values:
+        return 0.0
+    index = int(round((len(values) - 1) * pct / 100.0))
+    return values[index]
+
+
+def summarize(values, scale=1000.0):
+    """min/mean/p50/p90/p99/max of a list of seconds, in milliseconds"""
+    if not values:
+        return {'count': 0, 'min': 0.0, 'mean': 0.0, 'p50': 0.0,
+                'p90': 0.0, 'p99': 0.0, 'max': 0.0}
+    
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'min': round(values[0] * scale, 3),
+        'mean': round(sum(values) * scale / len(values), 3),
+        'p50': round(percentile(values, 50) * scale, 3),
+        'p90': round(percentile(values, 90) * scale, 3),
+        'p99': round(percentile(values, 99) * scale, 3),
+        'max': round(values[-1] * scale, 3)
+    }
+
+
+def format_bytes(count):
+    """Byte count or rate as 512B, 1.5K, 12.0M"""
+    for unit in ('B', 'K', 'M'):
+        if abs(count) < 1024:
+            return ("%d%s" if unit == 'B' else "%.1f%s") % (count, unit)
+        count /= 1024.0
+    return "%.1fG" % count
+
+
+class Histogram:
+    """Counts of values falling in fixed buckets
+
+    add() is a bisect and an increment, cheap enough for every packet.
+    Percentiles over an interval come from the difference of two
+    snapshots, see histogram_percentile().
+    """
+    
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+    
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    
+    def snapshot(self):
+        """Current bucket counts"""
+        return list(self.counts)
+
+
+class Reservoir:
+    """Uniform sample of at most size values out of any number added
+
+    Count, mean, min and max stay exact; percentiles come from the sample
+    (algorithm R), so memory does not grow with the length of a run.
+    """
+    
+    def __init__(self, size=10000):
+        self.size = size
+        self.values = []
+        self.count = 0
+        self.total = 0.0
+        self.low = None
+        self.high = None
+        self.rng = random.Random()
+    
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.low is None or value < self.low:
+            self.low = value
+        if self.high is None or value > self.high:
+            self.high = value
+        
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            slot = self.rng.randint(0, self.count - 1)
+            if slot < self.size:
+                self.values[slot] = value
+    
+    def extend(self, values):
+        for value in values:
+            self.add(value)
+    
+    def summary(self, scale=1000.0):
+        """summarize() of everything added, percentiles from the sample"""
+        summary = summarize(self.values, scale)
+        if self.count:
+            summary['count'] = self.count
+            summary['min'] = round(self.low * scale, 3)
+            summary['mean'] = round(self.total * scale / self.count, 3)
+            summary['max'] = round(self.high * scale, 3)
+        return summary
+
+
+def histogram_percentile(bounds, counts, pct):
+    """Upper bound of the bucket holding percentile pct of counts"""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    
+    rank = total * pct / 100.0
+    seen = 0
+    for i, count in enumerate(counts):
+        seen += count
+        if seen >= rank:
+            return bounds[min(i, len(bounds) - 1)]
+    return bounds[-1]
@@ -0,0 +1,225 @@
+"""
+NFNET Microbenchmarks
+Repeatable timings of protocol and processing hot paths
+"""
+
+import json
+import os
+import platform
+import sys
+import time
+
+from protocol import Packet, MessageHandler
+import log
+
+PAYLOAD_SIZES = [64, 1024, 16384, 262144]
+
+SAMPLE_PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<title>Example Domain</title>
+<link rel="stylesheet" href="/css/site.css">
+<script src="/js/jquery.min.js"></script>
+<script src="http://cdn.example.com/js/analytics.js"></script>
+</head>
+<body>
+<div id="header"><a href="/"><img src="/images/logo.png" alt="Example"></a></div>
+<ul id="nav">
+''' + ''.join('<li><a href="/section/%d/index.html">Section %d</a></li>\n' % (i, i) for i in range(40)) + '''</ul>
+<div id="content">
+''' + ''.join('<p>Paragraph %d with a <a href="http://www.example.org/page%d">link</a> and an '
+              '<img src="/images/photo%d.jpg"> image.</p>\n' % (i, i, i) for i in range(200)) + '''</div>
+</body>
+</html>'''
+
+SAMPLE_JS = ''.join('''// Module %d
+function handler%d(event) {
+    // handle the event
+    var target = event.target;
+    if (target) { target.className = "active"; }
+    return false;
+}
+
+''' % (i, i) for i in range(150))
+
+
+class _Quiet:
+    """Swallow prints and log lines from the code under test"""
+    
+    def __enter__(self):
+        log.flush()
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    
+    def __exit__(self, *args):
+        log.flush()
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def build_benchmarks():
+    """Return [(name, func)] for every benchmark"""
+    import config
+    import relay
+    
+    with _Quiet():
+        cfg = config.Config()
+        cfg.log_file = ""
+        server = relay.RelayServer(cfg)
+    cfg.enable_cache = True
+    
+    benchmarks = []
+    
+    # Packet encoding across payload sizes
+    for size in PAYLOAD_SIZES:
+        packet = MessageHandler.create_data('x' * size, "text/plain")
+        packed = packet.pack()
+        benchmarks.append(("packet.pack %d" % size, packet.pack))
+        benchmarks.append(("packet.unpack %d" % size, lambda packed=packed: Packet.unpack(packed)))
+        benchmarks.append(("packet.checksum %d" % size, packet.calculate_checksum))
+    
+    # Relay packet handling per content type, cache hits and misses
+    samples = [
+        ('plain', "text/plain", "hello world " * 100),
+        ('html', "text/html", SAMPLE_PAGE),
+        ('js', "application/javascript", SAMPLE_JS),
+        ('image', "image/png", '\x89PNG' + 'x' * 16384)
+    ]
+    for name, content_type, payload in samples:
+        packet = MessageHandler.create_data(payload, content_type)
+        
+        def hit(packet=packet):
+            server._handle_packet(packet)
+        
+        def miss(packet=packet):
+            server.cache.clear()
+            server._handle_packet(packet)
+        
+        benchmarks.append(("relay.handle %s hit" % name, hit))
+        benchmarks.append(("relay.handle %s miss" % name, miss))
+    
+    ping = MessageHandler.create_ping()
+    benchmarks.append(("relay.handle ping", lambda: server._handle_packet(ping)))
+    
+    # Content processors
+    benchmarks.append(("relay.process_javascript", lambda: server._process_javascript(SAMPLE_JS)))
+    benchmarks.append(("web.process_html", lambda: server.web_server._process_html(
+        SAMPLE_PAGE, "http://www.example.com/index.html")))
+    
+    return benchmarks
+
+
+def time_function(func, repeat=5, min_time=0.2):
+    """Best time per call in microseconds"""
+    # Find a loop count that runs for at least min_time
+    loops = 1
+    while True:
+        started = time.time()
+        for i in xrange(loops):
+            func()
+        elapsed = time.time() - started
+        if elapsed >= min_time or loops >= 1000000:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    
+    best = elapsed
+    for i in range(repeat - 1):
+        started = time.time()
+        for i in xrange(loops):
+            func()
+        best = min(best, time.time() - started)
+    
+    return best * 1000000 / loops
+
+
+def run(name_filter=None, repeat=5, min_time=0.2, report=None):
+    """Run the suite, returns {name: microseconds per call}"""
+    results = {}
+    benchmarks = build_benchmarks()
+    
+    for name, func in benchmarks:
+        if name_filter and name_filter not in name:
+            continue
+        
+        with _Quiet():
+            usec = time_function(func, repeat, min_time)
+        results[name] = round(usec, 3)
+        
+        if report:
+            report(name, usec)
+    
+    return results
+
+
+def save_baseline(results, path, label=""):
+    """Write results to a baseline file"""
+    data = {
+        'label': label,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.time(),
+        'results': results
+    }
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def compare(results, baseline, threshold):
+    """Return [(name, old, new, change%)] slower than threshold percent"""
+    regressions = []
+    for name in sorted(results):
+        old = baseline.get(name)
+        if not old:
+            continue
+        change = (results[name] - old) * 100.0 / old
+        if change > threshold:
+            regressions.append((name, old, results[name], change))
+    return regressions
+
+
+def main(argv):
+    """Command line entry point"""
+    from optparse import OptionParser
+    
+    parser = OptionParser(usage="%prog micro [options]")
+    parser.add_option("-s", "--save", help="save results as a baseline file")
+    parser.add_option("-c", "--compare", help="compare against a baseline file")
+    parser.add_option("-t", "--threshold", type="float", default=10.0,
+                      help="percent slowdown that counts as a regression")
+    parser.add_option("-f", "--filter", help="only run benchmarks containing this text")
+    parser.add_option("-r", "--repeat", type="int", default=5, help="timing runs per benchmark")
+    parser.add_option("-l", "--label", default="", help="build or run name saved with a baseline")
+    options, args = parser.parse_args(argv)
+    
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+    
+    def report(name, usec):
+        line = "  %-32s %12.3f us" % (name, usec)
+        if name in baseline and baseline[name]:
+            line += "  %+7.1f%%" % ((usec - baseline[name]) * 100.0 / baseline[name])
+        print line
+        sys.stdout.flush()
+    
+    print "NFNET microbenchmarks (best of %d)" % options.repeat
+    print "=" * 60
+    results = run(options.filter, options.repeat, report=report)
+    
+    if options.save:
+        save_baseline(results, options.save, options.label)
+        print ""
+        print "Baseline saved to %s" % options.save
+    
+    if options.compare:
+        regressions = compare(results, baseline, options.threshold)
+        print ""
+        if regressions:
+            print "REGRESSIONS (slower than %.1f%%):" % options.threshold
+            for name, old, new, change in regressions:
+                print "  %-32s %10.3f -> %10.3f us  %+7.1f%%" % (name, old, new, change)
+            return 1
+        print "No regressions over %.1f%%" % options.threshold
+    
+    return 0
@@ -0,0 +1,138 @@
+"""
+NFNET Peer Benchmark
+Measures the cost of forwarding through a second relay
+"""
+
+import json
+import socket
+import sys
+
+from loadgen import LoadGenerator, parse_mix
+from microbench import _Quiet
+
+
+def free_port():
+    """A TCP port nothing is listening on right now"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_relays():
+    """Start relays A and B on free ports, A routes 'peer' to B"""
+    import config
+    import relay
+    
+    relays = []
+    for i in range(2):
+        cfg = config.Config()
+        cfg.listen_ip = "127.0.0.1"
+        cfg.relay_port = free_port()
+        cfg.intranet_port = free_port()
+        cfg.config_watch = False
+        cfg.log_file = ""
+        cfg.max_clients = 1000
+        relays.append(relay.RelayServer(cfg))
+    
+    a, b = relays
+    a.config.routing_table = {'peer': "127.0.0.1:%s" % b.config.relay_port}
+    a.router.load(a.config.routing_table)
+    
+    for server in relays:
+        if not server.start():
+            raise RuntimeError("Relay failed to start on port %s" % server.config.relay_port)
+    return a, b
+
+
+def run(clients=10, duration=5, mix=None, window=1, unique=0.0):
+    """Load B directly, then through A, returns both results"""
+    with _Quiet():
+        a, b = start_relays()
+    
+    try:
+        with _Quiet():
+            # Open the peer link before timing anything
+            warmup = LoadGenerator("127.0.0.1", a.config.relay_port, 1, 0.2, mix,
+                                   destination="peer")
+            warmup.run()
+            
+            direct = LoadGenerator("127.0.0.1", b.config.relay_port, clients, duration,
+                                   mix, window, unique, label="direct").run()
+            forwarded = LoadGenerator("127.0.0.1", a.config.relay_port, clients, duration,
+                                      mix, window, unique, label="forwarded",
+                                      destination="peer").run()
+            peer = a.router.get_stats()['peers']
+    finally:
+        with _Quiet():
+            a.stop()
+            b.stop()
+    
+    return {
+        'direct': direct,
+        'forwarded': forwarded,
+        'overhead': overhead(direct['summary'], forwarded['summary']),
+        'peer_link': peer
+    }
+
+
+def overhead(direct, forwarded):
+    """Added latency in ms and throughput ratio of the forwarded run"""
+    result = {}
+    for key in ('p50', 'p90', 'p99', 'mean'):
+        result[key] = round(forwarded[key] - direct[key], 3)
+    if direct['throughput']:
+        result['throughput_ratio'] = round(forwarded['throughput'] / direct['throughput'], 3)
+    else:
+        result['throughput_ratio'] = 0.0
+    return result
+
+
+def main(argv):
+    """Command line entry point"""
+    from optparse import OptionParser
+    
+    parser = OptionParser(usage="%prog peer [options]")
+    parser.add_option("-c", "--clients", type="int", default=10, help="concurrent clients")
+    parser.add_option("-d", "--duration", type="float", default=5, help="seconds per run")
+    parser.add_option("-m", "--mix", default="ping=50,html=25,js=25",
+                      help="packet mix, e.g. ping=50,html=25,js=25")
+    parser.add_option("-w", "--window", type="int", default=1, help="requests in flight per client")
+    parser.add_option("-u", "--unique", type="float", default=0.0,
+                      help="fraction of DATA payloads made unique (cache misses)")
+    parser.add_option("-o", "--output", help="write JSON results to this file")
+    options, args = parser.parse_args(argv)
+    
+    try:
+        mix = parse_mix(options.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    print "Two-relay benchmark: %d clients, %ss per run, window %d" % (
+        options.clients, options.duration, options.window)
+    print "=" * 60
+    sys.stdout.flush()
+    
+    results = run(options.clients, options.duration, mix, options.window, options.unique)
+    
+    print "  %-10s %10s %9s %9s %9s %9s" % ("", "req/s", "p50 ms", "p90 ms", "p99 ms", "errors")
+    for name in ('direct', 'forwarded'):
+        summary = results[name]['summary']
+        print "  %-10s %10.1f %9.2f %9.2f %9.2f %9d" % (
+            name, summary['throughput'], summary['p50'], summary['p90'],
+            summary['p99'], summary['errors'])
+    
+    extra = results['overhead']
+    print ""
+    print "  Forwarding adds p50 %+.2fms, p99 %+.2fms; throughput x%.2f" % (
+        extra['p50'], extra['p99'], extra['throughput_ratio'])
+    for target, link in results['peer_link'].items():
+        print "  Peer link %s: %d connects, %d packets sent" % (target, link['connects'], link['sent'])
+    
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print "Results saved to %s" % options.output
+    
+    return 0
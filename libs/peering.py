@@ -0,0 +1,221 @@
+"""
+NFNET Peering
+Long-lived, multiplexed links between relays
+"""
+
+import random
+import threading
+import time
+from collections import deque
+
+from client import Client, ClientError, ResponseFuture
+from metrics import summarize
+from protocol import MessageHandler
+from log import get_logger
+
+log = get_logger("PEER")
+
+
+class PeerLink:
+    """One persistent connection to another relay
+
+    Every forwarded packet travels over the same TCP connection, tagged by
+    packet ID, so no connection is opened per request. A background thread
+    PINGs the peer every heartbeat_interval and reconnects with jittered
+    exponential backoff when the link drops or a heartbeat goes unanswered.
+    Packets sent while the link is connecting wait for the connect and
+    fail with it; no caller ever blocks on the connect itself.
+    """
+    
+    def __init__(self, host, port, heartbeat_interval=5.0, heartbeat_timeout=3.0,
+                 connect_timeout=5.0, backoff=0.5, max_backoff=30.0):
+        self.host = host
+        self.port = port
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        
+        self.client = None
+        self.state = "down"          # down, connecting, up
+        self.running = False
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.waiting = []            # Futures sent while connecting
+        self.failures = 0            # Connect failures in a row
+        self.up_since = 0
+        self.rtts = deque(maxlen=100)
+        
+        self.stats = {
+            'connects': 0,
+            'connect_failures': 0,
+            'disconnects': 0,
+            'heartbeats': 0,
+            'heartbeat_failures': 0,
+            'sent': 0,
+            'queued': 0,
+            'rejected': 0
+        }
+    
+    def start(self):
+        """Connect and keep the link up in the background, returns at once"""
+        if self.running:
+            return False
+        
+        self.running = True
+        self.state = "connecting"
+        
+        self.thread = threading.Thread(target=self._run, name="peer-%s:%s" % (self.host, self.port))
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+    
+    def stop(self):
+        """Close the link, failing requests still in flight"""
+        self.running = False
+        self.wakeup.set()
+        
+        with self.lock:
+            client, self.client = self.client, None
+            self.state = "down"
+        if client:
+            client.disconnect()
+        self._fail_waiting("Peer %s:%s link closed" % (self.host, self.port))
+        return True
+    
+    def send_async(self, packet, callback=None):
+        """Send over the link, returns a ResponseFuture"""
+        future = ResponseFuture(packet)
+        if callback:
+            future.add_done_callback(callback)
+        
+        with self.lock:
+            client = self.client
+            if client is None and self.running and self.state == "connecting":
+                self.stats['queued'] += 1
+                self.waiting.append(future)
+                return future
+        
+        if client is None or not client.connected:
+            self.stats['rejected'] += 1
+            future._finish(error=ClientError("Peer %s:%s is down" % (self.host, self.port)))
+            return future
+        
+        self.stats['sent'] += 1
+        return client._send(future)
+    
+    def cancel(self, future, error=None):
+        """Give up waiting for a response"""
+        with self.lock:
+            if future in self.waiting:
+                self.waiting.remove(future)
+        
+        client = self.client
+        if client is not None:
+            client.cancel(future, error)
+        else:
+            future._finish(error=error or ClientError("Cancelled"))
+    
+    def _connect(self):
+        """Open the connection, returns True when the link is up"""
+        self.state = "connecting"
+        client = Client(self.host, self.port)
+        client.verbose = False
+        client.connect_timeout = self.connect_timeout
+        
+        if not client.connect():
+            self.failures += 1
+            self.stats['connect_failures'] += 1
+            with self.lock:
+                self.state = "down"
+            self._fail_waiting("Cannot reach peer %s:%s" % (self.host, self.port))
+            if self.failures == 1:
+                log.info("Cannot reach %s:%s, retrying in the background", self.host, self.port)
+            return False
+        
+        with self.lock:
+            if not self.running:
+                client.disconnect()
+                return False
+            
+            self.client = client
+            self.failures = 0
+            self.up_since = time.time()
+            self.stats['connects'] += 1
+            self.state = "up"
+            waiting, self.waiting = self.waiting, []
+        
+        # Packets queued during the connect go out in the order sent
+        for future in waiting:
+            self.stats['sent'] += 1
+            client._send(future)
+        
+        log.info("Link to %s:%s up", self.host, self.port)
+        return True
+    
+    def _fail_waiting(self, reason):
+        """Fail the packets queued while connecting"""
+        with self.lock:
+            waiting, self.waiting = self.waiting, []
+        for future in waiting:
+            self.stats['rejected'] += 1
+            future._finish(error=ClientError(reason))
+    
+    def _run(self):
+        """Heartbeat while up, reconnect while down"""
+        while self.running:
+            client = self.client
+            
+            if client is None or not client.connected:
+                if client is not None:
+                    with self.lock:
+                        self.client = None
+                        self.state = "down"
+                    self.stats['disconnects'] += 1
+                    log.info("Link to %s:%s down", self.host, self.port)
+                
+                if not self._connect():
+                    # Back off so a dead peer is not hammered
+                    delay = min(self.max_backoff, self.backoff * (2 ** min(self.failures - 1, 16)))
+                    self.wakeup.wait(delay * random.uniform(0.5, 1.0))
+                    self.wakeup.clear()
+                continue
+            
+            self.wakeup.wait(self.heartbeat_interval)
+            self.wakeup.clear()
+            
+            if self.running and client.connected:
+                self._heartbeat(client)
+    
+    def _heartbeat(self, client):
+        """PING the peer, drop the link if no PONG comes back in time"""
+        self.stats['heartbeats'] += 1
+        future = client.send_async(MessageHandler.create_ping())
+        
+        try:
+            response = future.result(self.heartbeat_timeout)
+        except ClientError:
+            client.cancel(future)
+            response = None
+        
+        if response is not None and response.type == "PONG":
+            self.rtts.append(future.finished_at - future.sent_at)
+            return True
+        
+        self.stats['heartbeat_failures'] += 1
+        log.info("%s:%s missed a heartbeat, reconnecting", self.host, self.port)
+        client.disconnect()
+        return False
+    
+    def get_stats(self):
+        """Link state, counters and heartbeat round trip in milliseconds"""
+        stats = self.stats.copy()
+        client = self.client
+        
+        stats['state'] = self.state
+        stats['in_flight'] = len(client.pending) if client else len(self.waiting)
+        stats['up_for'] = round(time.time() - self.up_since, 1) if self.state == "up" else 0
+        stats['rtt'] = summarize(list(self.rtts))
+        return stats
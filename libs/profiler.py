@@ -0,0 +1,162 @@
+"""
+NFNET Profiler
+Low-overhead sampling profiler covering every thread
+"""
+
+import marshal
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads at a fixed interval
+
+    Nothing is hooked into the profiled code, so the relay and web
+    threads run at full speed; the cost is one walk of
+    sys._current_frames() per interval in the sampler thread.
+    """
+    
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.running = False
+        self.thread = None
+        self.timer = None
+        self.on_stop = None
+        self.started = 0
+        self.stopped = 0
+        self.samples = 0
+        self.stacks = {}             # (thread, frame...) -> count
+    
+    def start(self, duration=None, on_stop=None):
+        """Start sampling, stop by itself after duration seconds"""
+        if self.running:
+            return False
+        
+        self.running = True
+        self.started = time.time()
+        self.samples = 0
+        self.stacks = {}
+        self.on_stop = on_stop
+        
+        self.thread = threading.Thread(target=self._sample_loop, name="profiler")
+        self.thread.daemon = True
+        self.thread.start()
+        
+        if duration:
+            self.timer = threading.Timer(duration, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+        
+        return True
+    
+    def stop(self):
+        """Stop sampling"""
+        if not self.running:
+            return False
+        
+        self.running = False
+        self.stopped = time.time()
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.thread is not threading.current_thread():
+            self.thread.join(1)
+        
+        if self.on_stop:
+            self.on_stop(self)
+        return True
+    
+    def _sample_loop(self):
+        """Record the stack of every other thread each interval"""
+        own = threading.current_thread().ident
+        
+        while self.running:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread-%s" % ident))
+                stack.reverse()
+                
+                key = tuple(stack)
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            
+            self.samples += 1
+            time.sleep(self.interval)
+    
+    def write_collapsed(self, path):
+        """Write stacks in collapsed format for flame graph tools"""
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                frames = [stack[0].replace(';', '_')]
+                for filename, lineno, name in stack[1:]:
+                    frames.append("%s (%s:%d)" % (name, filename.replace('\\', '/').split('/')[-1], lineno))
+                f.write("%s %d\n" % (';'.join(frames), count))
+    
+    def write_pstats(self, path):
+        """Write samples as a pstats file, load with pstats.Stats(path)
+
+        Call counts are sample counts and times are samples multiplied by
+        the measured time between samples.
+        """
+        stats = {}
+        
+        # Walking the stacks stretches the interval a little
+        end = self.stopped if not self.running else time.time()
+        period = (end - self.started) / self.samples if self.samples else self.interval
+        
+        for stack, count in self.stacks.items():
+            frames = stack[1:]
+            seconds = count * period
+            seen = set()
+            
+            for i, func in enumerate(frames):
+                cc, nc, tt, ct, callers = stats.get(func, (0, 0, 0.0, 0.0, {}))
+                
+                # Inclusive time counts once per stack, even when recursive
+                if func not in seen:
+                    seen.add(func)
+                    cc += count
+                    ct += seconds
+                nc += count
+                if i == len(frames) - 1:
+                    tt += seconds
+                
+                if i > 0:
+                    caller = frames[i - 1]
+                    c_cc, c_nc, c_tt, c_ct = callers.get(caller, (0, 0, 0.0, 0.0))
+                    callers[caller] = (c_cc + count, c_nc + count,
+                                       c_tt + (seconds if i == len(frames) - 1 else 0.0),
+                                       c_ct + seconds)
+                
+                stats[func] = (cc, nc, tt, ct, callers)
+        
+        with open(path, 'wb') as f:
+            marshal.dump(stats, f)
+    
+    def save(self, prefix):
+        """Write prefix.prof and prefix.folded, returns the paths"""
+        prof = prefix + ".prof"
+        folded = prefix + ".folded"
+        self.write_pstats(prof)
+        self.write_collapsed(folded)
+        return prof, folded
+    
+    def get_status(self):
+        """Summary of the current or last run"""
+        end = time.time() if self.running else self.stopped
+        return {
+            'running': self.running,
+            'interval_ms': self.interval * 1000,
+            'samples': self.samples,
+            'stacks': len(self.stacks),
+            'seconds': round(end - self.started, 1) if self.started else 0
+        }
@@ -3,6 +3,11 @@ NFNET Protocol Implementation
 Custom protocol for network communication
 """
 
+import mmap
+
+# Largest payload accepted from the network, larger ones come in fragments
+MAX_PAYLOAD = 16777216       # 16MB
+
 class Packet:
     """Base packet structure for NFNET protocol"""
     
@@ -14,6 +19,7 @@ class Packet:
         self.payload = payload
         self.options = options or {}
         self.checksum = 0
+        self.fragmented = False  # Reassembled from fragments
     
     def _generate_id(self):
         """Generate a packet ID"""
@@ -25,26 +31,32 @@ class Packet:
         import time
         return int(time.time())
     
+    def _payload_bytes(self):
+        """Payload as a string, spooled payloads are mmaps"""
+        if isinstance(self.payload, mmap.mmap):
+            return self.payload[:]
+        return str(self.payload)
+    
     def calculate_checksum(self):
         """Calculate simple checksum for integrity"""
-        data = str(self.type) + str(self.id) + str(self.payload)
-        checksum = 0
-        for char in data:
-            checksum = (checksum + ord(char)) % 256
-        self.checksum = checksum
-        return checksum
+        # Sum of the byte values mod 256, summed in C rather than per character
+        data = str(self.type) + str(self.id) + self._payload_bytes()
+        self.checksum = sum(bytearray(data)) % 256
+        return self.checksum
     
     def pack(self):
         """Convert packet to bytes for transmission"""
         self.calculate_checksum()
+        payload = self._payload_bytes()
         
-        # Create header
-        header = "NFNET/%d %s ID:%d TIME:%d CHK:%d\n" % (
+        # Create header, LEN lets the receiver frame the payload
+        header = "NFNET/%d %s ID:%d TIME:%d CHK:%d LEN:%d\n" % (
             self.version,
             self.type,
             self.id,
             self.timestamp,
-            self.checksum
+            self.checksum,
+            len(payload)
         )
         
         # Add options if any
@@ -58,19 +70,17 @@ class Packet:
         header += "\n"
         
         # Combine header and payload
-        return header + str(self.payload)
+        return header + payload
     
     @classmethod
     def unpack(cls, data):
         """Parse bytes back into a Packet object"""
-        lines = data.split('\n')
-        
-        if len(lines) < 2:
-            return None
+        head, sep, payload = data.partition('\n\n')
+        lines = head.split('\n')
         
         # Parse first line (mandatory header)
         first_line = lines[0].strip().split()
-        if len(first_line) < 6:
+        if len(first_line) < 5 or not first_line[0].startswith('NFNET'):
             return None
         
         version_str = first_line[0]  # NFNET/1
@@ -81,20 +91,25 @@ class Packet:
         packet_id = 0
         timestamp = 0
         checksum = 0
+        length = None
         
-        for field in first_line[2:]:
-            if ':' in field:
-                key, value = field.split(':', 1)
-                if key == 'ID':
-                    packet_id = int(value)
-                elif key == 'TIME':
-                    timestamp = int(value)
-                elif key == 'CHK':
-                    checksum = int(value)
+        try:
+            for field in first_line[2:]:
+                if ':' in field:
+                    key, value = field.split(':', 1)
+                    if key == 'ID':
+                        packet_id = int(value)
+                    elif key == 'TIME':
+                        timestamp = int(value)
+                    elif key == 'CHK':
+                        checksum = int(value)
+                    elif key == 'LEN':
+                        length = int(value)
+        except ValueError:
+            return None
         
         # Parse options if present
         options = {}
-        payload_start = 1  # After first line
         
         if len(lines) > 1 and lines[1].startswith('OPTIONS:'):
             options_line = lines[1][8:].strip()
@@ -104,10 +119,10 @@ class Packet:
                     if '=' in part:
                         key, value = part.split('=', 1)
                         options[key.strip()] = value.strip()
-            payload_start = 2
         
-        # Get payload (everything after header)
-        payload = '\n'.join(lines[payload_start:])
+        # Get payload (everything after header, or LEN bytes)
+        if length is not None:
+            payload = payload[:length]
         
         # Create packet
         packet = cls(packet_type, payload, options)
@@ -128,6 +143,99 @@ class Packet:
                                      self.payload[:50] + "..." if len(str(self.payload)) > 50 else self.payload)
 
 
+class PacketReader:
+    """Frame packets out of a byte stream
+    
+    Data may arrive in any number of pieces, feed() returns the packets
+    completed so far. Packets without a LEN field (older peers) take the
+    payload up to the next packet header or the end of the data received.
+    A payload of known length is collected as a list of reads and joined
+    once, so framing costs the same per byte for any packet size.
+    """
+    
+    def __init__(self, max_payload=MAX_PAYLOAD):
+        self.max_payload = max_payload
+        self.buffer = ""
+        self._header = None          # Header waiting for its payload
+        self._length = 0
+        self._parts = None           # Reads of a payload still arriving
+        self._size = 0
+    
+    def feed(self, data):
+        """Add received data, return list of complete packets"""
+        packets = []
+        
+        if self._parts is not None:
+            self._parts.append(data)
+            self._size += len(data)
+            if self._size < self._length:
+                return packets
+            
+            self.buffer = ''.join(self._parts)
+            self._parts = None
+        else:
+            self.buffer += data
+        
+        # Packets are cut out at an offset, the buffer is trimmed once
+        offset = 0
+        while True:
+            if self._header is None:
+                end = self.buffer.find('\n\n', offset)
+                if end < 0:
+                    if len(self.buffer) - offset > 4096:
+                        raise ValueError("Packet header too large")
+                    break
+                
+                self._header = self.buffer[offset:end + 2]
+                offset = end + 2
+                self._length = self._payload_length(self._header)
+            
+            if self._length is None:
+                # Legacy packet, no length given
+                end = self.buffer.find('\nNFNET/', offset)
+                if end < 0:
+                    end = len(self.buffer)
+                payload = self.buffer[offset:end]
+                offset = end
+                if self.buffer.startswith('\n', offset):
+                    offset += 1
+            else:
+                if len(self.buffer) - offset < self._length:
+                    # Wait for the rest without copying what came so far
+                    self._parts = [self.buffer[offset:]]
+                    self._size = len(self._parts[0])
+                    self.buffer = ""
+                    return packets
+                
+                payload = self.buffer[offset:offset + self._length]
+                offset += self._length
+            
+            packet = Packet.unpack(self._header + payload)
+            self._header = None
+            
+            if packet:
+                packets.append(packet)
+            
+            if offset >= len(self.buffer):
+                break
+        
+        self.buffer = self.buffer[offset:]
+        return packets
+    
+    def _payload_length(self, header):
+        """Read the LEN field of a header"""
+        for field in header.split('\n', 1)[0].split():
+            if field.startswith('LEN:'):
+                try:
+                    length = int(field[4:])
+                except ValueError:
+                    raise ValueError("Bad packet length")
+                if length < 0 or length > self.max_payload:
+                    raise ValueError("Packet too large (%s bytes)" % length)
+                return length
+        return None
+
+
 class MessageHandler:
     """Handle different message types"""
     
@@ -151,6 +259,11 @@ class MessageHandler:
         """Create a routing command packet"""
         return Packet("ROUTE", str(params), {"Command": command})
     
+    @staticmethod
+    def create_forward(destination, packet):
+        """Create a routing command that forwards packet to destination"""
+        return Packet("ROUTE", packet.pack(), {"Command": "forward", "Destination": destination})
+    
     @staticmethod
     def create_error(code, message):
         """Create an error packet"""
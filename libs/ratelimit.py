@@ -0,0 +1,169 @@
+"""
+NFNET Rate Limiting
+Per-client token buckets and global admission control
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """Tokens refill at rate per second up to burst
+
+    take() always deducts, so the bucket can go into debt; the debt
+    divided by the rate is how long the caller should wait.
+    """
+    
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.time()
+    
+    def take(self, amount, now):
+        """Take tokens, returns seconds until the bucket is out of debt"""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        
+        # Debt is capped at one burst so a long flood is not owed forever
+        self.tokens = max(-self.burst, self.tokens - amount)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+    
+    def give(self, amount):
+        """Return tokens for work that was refused"""
+        self.tokens = min(self.burst, self.tokens + amount)
+
+
+class RateLimiter:
+    """Packet and byte buckets per client IP
+
+    Rates are read from the config on every check, so 'config set' and
+    nfnet.cfg edits apply to existing clients at once. A rate of 0 turns
+    that limit off.
+    """
+    
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.clients = {}            # ip -> counters and buckets
+        self.last_prune = time.time()
+    
+    def _client(self, ip, now):
+        """Buckets for an IP (lock held)"""
+        client = self.clients.get(ip)
+        if client is None:
+            client = self.clients[ip] = {
+                'packets': None,
+                'bytes': None,
+                'last_seen': now,
+                'throttled': 0,
+                'rejected': 0
+            }
+        client['last_seen'] = now
+        
+        # Forget clients idle for a minute
+        if now - self.last_prune > 60:
+            self.last_prune = now
+            for key in [key for key, value in self.clients.items() if now - value['last_seen'] > 60]:
+                if key != ip:
+                    del self.clients[key]
+        
+        return client
+    
+    def _bucket(self, client, name, rate):
+        """Bucket kept in step with the configured rate (lock held)"""
+        burst = max(1.0, rate * self.config.rate_limit_burst)
+        bucket = client[name]
+        if bucket is None:
+            bucket = client[name] = TokenBucket(rate, burst)
+        elif bucket.rate != rate:
+            bucket.rate = float(rate)
+            bucket.burst = burst
+        return bucket
+    
+    def check_bytes(self, ip, size):
+        """Seconds to hold off reading after size bytes, 0 when within limits"""
+        rate = self.config.rate_limit_bytes
+        if not rate:
+            return 0.0
+        
+        now = time.time()
+        with self.lock:
+            client = self._client(ip, now)
+            delay = self._bucket(client, 'bytes', rate).take(size, now)
+            if delay:
+                client['throttled'] += 1
+        return min(delay, self.config.rate_limit_max_delay)
+    
+    def check_packet(self, ip):
+        """Seconds to wait before the packet, None if it must be rejected"""
+        rate = self.config.rate_limit_packets
+        if not rate:
+            return 0.0
+        
+        now = time.time()
+        with self.lock:
+            client = self._client(ip, now)
+            bucket = self._bucket(client, 'packets', rate)
+            delay = bucket.take(1, now)
+            
+            if delay > self.config.rate_limit_max_delay:
+                bucket.give(1)
+                client['rejected'] += 1
+                return None
+            if delay:
+                client['throttled'] += 1
+        return delay
+    
+    def get_stats(self, top=5):
+        """Tracked clients and the ones limited most"""
+        with self.lock:
+            clients = [(ip, value['throttled'], value['rejected']) for ip, value in self.clients.items()]
+        
+        clients.sort(key=lambda item: item[1] + item[2], reverse=True)
+        return {
+            'clients': len(clients),
+            'top': [{'ip': ip, 'throttled': throttled, 'rejected': rejected}
+                    for ip, throttled, rejected in clients[:top] if throttled or rejected]
+        }
+
+
+class AdmissionController:
+    """Decides whether new work enters the message queue
+
+    Work is delayed once the queue passes admission_queue_soft, longer the
+    closer it gets to admission_queue_hard, and rejected at the hard limit
+    or while queued packets wait longer than admission_latency seconds.
+    """
+    
+    def __init__(self, config):
+        self.config = config
+        self.wait = 0.0              # Smoothed seconds packets spend queued
+    
+    def observe(self, waited):
+        """Record how long a packet sat in the queue"""
+        self.wait += (waited - self.wait) * 0.1
+    
+    def admit(self, depth):
+        """Seconds to delay new work, None if it must be rejected"""
+        soft = self.config.admission_queue_soft
+        hard = self.config.admission_queue_hard
+        
+        if depth >= hard:
+            return None
+        
+        # An empty queue means the backlog has cleared whatever the average says
+        if depth == 0:
+            self.wait = 0.0
+        elif self.wait > self.config.admission_latency:
+            return None
+        
+        if depth > soft:
+            return self.config.admission_max_delay * (depth - soft) / max(1, hard - soft)
+        return 0.0
+    
+    def get_stats(self):
+        """Get admission statistics"""
+        return {'queue_wait_ms': round(self.wait * 1000, 2)}
@@ -3,55 +3,123 @@ NFNET Relay Server
 Handles network connections and routing
 """
 
+import select
 import socket
+import struct
+import sys
 import threading
 import time
-import Queue
+import mmap
+from collections import OrderedDict
+
+from client import ResponseFuture
+from cluster_cache import ClusterCache, make_key, parse_nodes
+from fragments import Reassembler, split
+from metrics import Histogram
+from sampler import StatsSampler
+from ratelimit import RateLimiter, AdmissionController
+from scheduler import Scheduler, lane_of
+from timer_wheel import TimerWheel
+from log import get_logger, configure as configure_log, flush as flush_log, stop as stop_log
+
+log = get_logger("RELAY")
 
 class RelayServer:
     """Main relay server for NFNET protocol"""
     
     def __init__(self, config):
         self.config = config
+        configure_log(config)
         self.running = False
         self.sockets = []
         self.clients = {}
-        self.message_queue = Queue.Queue()
-        self.cache = {}
+        self.message_queue = Scheduler(config)    # Lanes by packet type, see scheduler.py
+        self.cache = OrderedDict()    # Oldest entry first
         self.lock = threading.Lock()
+        self.first_accept = 0        # When the first client was accepted
+        self.accepting = True        # Off while handing sockets to a new process
+        
+        # Sampled per-packet tracing, off unless trace_sample_rate is set
+        from tracing import Tracer
+        self.tracer = Tracer(config.trace_buffer, config.trace_sample_rate)
         
         # Web server
         from web_server import WebServer
-        self.web_server = WebServer(config)
+        self.web_server = WebServer(config, self.api_stats)
+        
+        # Forwards ROUTE packets through the routing table
+        from routing import Router
+        self.router = Router(config)
+        
+        # Closes idle connections and sends keep-alive PINGs
+        self.wheel = TimerWheel()
+        
+        # Shares the cache with other relays when cluster_cache is on
+        self.cluster = ClusterCache(config, self.router, self.cache.get, self._store, self.wheel.schedule)
+        self._check_cluster()
+        
+        # Keeps one noisy client from flooding the message queue
+        self.limiter = RateLimiter(config)
+        self.admission = AdmissionController(config)
+        
+        # Queue-to-reply latency and the per-second rates shown by 'top'
+        self.latency = Histogram()
+        self.sampler = StatsSampler(self)
+        
+        # Applies nfnet.cfg edits while running
+        from config import ConfigWatcher
+        self.config_watcher = ConfigWatcher(config, self.apply_config)
         
         # Statistics
         self.stats = {
             'connections': 0,
             'packets_sent': 0,
             'packets_received': 0,
+            'bytes_sent': 0,
+            'bytes_received': 0,
+            'cache_hits': 0,
+            'cache_misses': 0,
             'errors': 0,
+            'throttled': 0,
+            'rate_limited': 0,
+            'admission_delayed': 0,
+            'admission_rejected': 0,
+            'keep_alives': 0,
+            'idle_closed': 0,
+            'fragments_received': 0,
+            'fragments_sent': 0,
             'start_time': 0
         }
         
-        print "[RELAY] Initialized on port %s" % config.relay_port
+        log.info("Initialized on port %s", config.relay_port)
     
-    def start(self):
-        """Start the relay server and web interface"""
+    def start(self, listeners=None):
+        """Start the relay server and web interface
+
+        listeners maps 'relay' and 'web' to already listening sockets,
+        handed over by the process this one replaces.
+        """
+        listeners = listeners or {}
         if self.running:
-            print "[RELAY] Server already running"
+            log.info("Server already running")
             return False
         
-        print "[RELAY] Starting server..."
+        # The log writer stops with the server, restart it
+        configure_log(self.config)
+        log.info("Starting server...")
         
         try:
             # Start web server first
-            if not self.web_server.start():
-                print "[RELAY WARN] Could not start web interface"
+            if not self.web_server.start(listeners.get('web')):
+                log.warn("Could not start web interface")
             
-            # Create main socket
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.config.listen_ip, self.config.relay_port))
+            # Create main socket, or adopt the one handed over
+            if 'relay' in listeners:
+                self.server_socket = listeners['relay']
+            else:
+                self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.server_socket.bind((self.config.listen_ip, self.config.relay_port))
             self.server_socket.listen(self.config.max_clients)
             
             self.running = True
@@ -66,18 +134,30 @@ class RelayServer:
             self.process_thread.daemon = True
             self.process_thread.start()
             
-            print "[RELAY] Server started successfully on port %s" % self.config.relay_port
-            print "[RELAY] Web interface: http://127.0.0.1:%s" % self.config.intranet_port
+            self.router.start()
+            self.wheel.start()
+            self.sampler.start()
+            
+            if self.config.config_watch:
+                self.config_watcher.start()
+            
+            log.info("Server started successfully on port %s", self.config.relay_port)
+            log.info("Web interface: http://127.0.0.1:%s", self.config.intranet_port)
             return True
             
         except Exception as e:
-            print "[RELAY ERROR] Failed to start: %s" % str(e)
+            log.error("Failed to start: %s", str(e))
             return False
     
     def stop(self):
         """Stop the relay server and web interface"""
-        print "[RELAY] Stopping server..."
+        log.info("Stopping server...")
         self.running = False
+        self.message_queue.put(None)
+        self.config_watcher.stop()
+        self.router.stop()
+        self.sampler.stop()
+        self.wheel.stop()
         
         # Stop web server
         self.web_server.stop()
@@ -95,54 +175,99 @@ class RelayServer:
             except:
                 pass
         
-        print "[RELAY] Server stopped"
+        log.info("Server stopped")
+        flush_log()
+        stop_log()
         return True
     
     def _accept_connections(self):
         """Accept incoming connections"""
-        print "[RELAY] Waiting for connections..."
+        log.info("Waiting for connections...")
         
         while self.running:
             try:
+                # The listening socket may be shared with the process taking
+                # over, so wait in select instead of blocking in accept
+                if not self.accepting:
+                    time.sleep(0.05)
+                    continue
+                if not select.select([self.server_socket], [], [], 0.25)[0] or not self.accepting:
+                    continue
+                
                 client_socket, address = self.server_socket.accept()
-                client_socket.settimeout(self.config.timeout)
+                now = time.time()
+                if not self.first_accept:
+                    self.first_accept = now
+                
+                # Idle clients are closed by the timer wheel, so reads
+                # block instead of waking up on a socket timeout; writes
+                # give up after send_timeout
+                client_socket.settimeout(None)
+                self._set_send_timeout(client_socket)
+                
+                # Replies are small and pipelined, Nagle would hold them
+                # back behind the client's delayed ACK
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 
                 # Check if we have capacity
                 with self.lock:
                     if len(self.clients) >= self.config.max_clients:
-                        print "[RELAY] Connection limit reached, rejecting %s" % str(address)
+                        log.info("Connection limit reached, rejecting %s", str(address))
                         client_socket.close()
                         continue
                 
+                    info = self.clients[address] = {
+                        'socket': client_socket,
+                        'thread': None,
+                        'connected_at': now,
+                        'last_activity': now,
+                        'pinged': 0,          # When the last keep-alive went out
+                        'timer': None,
+                        'send_lock': threading.Lock(),
+                        'received': 0,        # Written by the reader thread only
+                        'answered': 0,        # Written under self.lock
+                        'packets': 0,         # Replies, written under self.lock
+                        'bytes_in': 0,        # Written by the reader thread only
+                        'bytes_out': 0        # Written under self.lock
+                    }
+                    self.stats['connections'] += 1
+                
+                self._watch_idle(address, info)
+                
                 # Handle client
                 client_thread = threading.Thread(
                     target=self._handle_client,
                     args=(client_socket, address)
                 )
                 client_thread.daemon = True
+                info['thread'] = client_thread
                 client_thread.start()
                 
-                with self.lock:
-                    self.clients[address] = {
-                        'socket': client_socket,
-                        'thread': client_thread,
-                        'connected_at': time.time(),
-                        'packets': 0
-                    }
-                    self.stats['connections'] += 1
-                
-                print "[RELAY] New connection from %s:%s" % (address[0], address[1])
+                log.info("New connection from %s:%s", address[0], address[1])
                 
             except socket.timeout:
                 continue
             except Exception as e:
                 if self.running:  # Only print if we're supposed to be running
-                    print "[RELAY ERROR] Accept failed: %s" % str(e)
+                    log.error("Accept failed: %s", str(e))
                 break
     
     def _handle_client(self, client_socket, address):
         """Handle communication with a client"""
-        buffer = ""
+        from protocol import PacketReader
+        reader = PacketReader()
+        reassembler = Reassembler(self.config.spool_threshold, self.config.max_transfer,
+                                  self.config.max_transfers)
+        tracer = self.tracer
+        limiter = self.limiter
+        accepted_at = time.time()
+        ip = address[0]
+        
+        with self.lock:
+            info = self.clients[address]
+        
+        # Forwarded replies and keep-alives are written from other threads
+        send_lock = info['send_lock']
         
         while self.running:
             try:
@@ -150,30 +275,108 @@ class RelayServer:
                 data = client_socket.recv(self.config.buffer_size)
                 if not data:
                     break
+                info['last_activity'] = time.time()
+                info['bytes_in'] += len(data)
+                self.stats['bytes_received'] += len(data)
                 
-                buffer += data
-                self.stats['packets_received'] += 1
+                # Over the byte rate, stop reading so TCP pushes back on the client
+                delay = limiter.check_bytes(ip, len(data))
+                if delay:
+                    self.stats['throttled'] += 1
+                    time.sleep(delay)
+                received_at = time.time() if tracer.sample_rate else 0
                 
-                # Process complete messages (delimited by newlines)
-                while '\n\n' in buffer:
-                    message, buffer = buffer.split('\n\n', 1)
+                # Process complete packets, which may span several reads
+                for packet in reader.feed(data):
+                    self.stats['packets_received'] += 1
                     
-                    # Parse packet
-                    from protocol import Packet
-                    packet = Packet.unpack(message + '\n\n')
+                    trace = tracer.start(address, accepted_at, received_at) if tracer.sample_rate else None
+                    if trace:
+                        trace.packet_id = packet.id
+                        trace.packet_type = packet.type
+                        trace.mark('parsed')
                     
                     if packet:
                         if packet.verify():
-                            # Add to processing queue
-                            self.message_queue.put({
+                            # Answer to a keep-alive, the read already
+                            # counted as activity
+                            if packet.type == "PONG":
+                                continue
+                            
+                            if trace:
+                                trace.mark('verified')
+                            
+                            message = {
                                 'client': address,
                                 'socket': client_socket,
-                                'packet': packet
-                            })
+                                'send_lock': send_lock,
+                                'packet': packet,
+                                'trace': trace
+                            }
+                            
+                            # Pieces of a large payload are processed once whole
+                            if 'Frag-Seq' in packet.options:
+                                self.stats['fragments_received'] += 1
+                                try:
+                                    packet = reassembler.add(packet)
+                                except ValueError as e:
+                                    packet = None
+                                    info['received'] += 1
+                                    self.stats['errors'] += 1
+                                    self._reject(message, 400, "Bad fragment: %s" % str(e))
+                                if packet is None:
+                                    continue
+                                message['packet'] = packet
+                            
+                            # Every path below ends in _send_response
+                            info['received'] += 1
+                            
+                            delay = limiter.check_packet(ip)
+                            if delay is None:
+                                self.stats['rate_limited'] += 1
+                                self._reject(message, 429, "Rate limit exceeded")
+                                continue
+                            if delay:
+                                self.stats['throttled'] += 1
+                                time.sleep(delay)
+                            
+                            # Cluster cache lookups are answered here, a relay
+                            # waiting on our GET may be holding up its queue.
+                            # Only cluster nodes may read or fill the cache.
+                            if packet.type == "CACHE":
+                                if not self.cluster.is_peer(ip):
+                                    self.stats['errors'] += 1
+                                    self._reject(message, 403, "CACHE is only accepted from cluster nodes")
+                                    continue
+                                self._send_response(message, self._handle_packet(packet, trace))
+                                continue
+                            
+                            # PING and CONTROL are always admitted so peer
+                            # heartbeats survive an overload
+                            if lane_of(packet) != 'control':
+                                delay = self.admission.admit(self.message_queue.qsize())
+                                if delay is None:
+                                    self.stats['admission_rejected'] += 1
+                                    self._reject(message, 503, "Server busy")
+                                    continue
+                                if delay:
+                                    self.stats['admission_delayed'] += 1
+                                    time.sleep(delay)
+                            
+                            # Add to processing queue
+                            message['queued_at'] = time.time()
+                            self.message_queue.put(message)
+                            
+                            if trace:
+                                trace.mark('enqueued')
                         else:
-                            print "[RELAY] Invalid checksum from %s" % str(address)
+                            log.info("Invalid checksum from %s", str(address))
                             self.stats['errors'] += 1
                 
+                            if trace:
+                                trace.mark('rejected')
+                                tracer.finish(trace)
+                
                 # Send queued responses
                 # This would handle outgoing messages
                 
@@ -181,8 +384,12 @@ class RelayServer:
                 continue
             except socket.error:
                 break
+            except ValueError as e:
+                log.info("Bad packet from %s: %s", str(address), str(e))
+                self.stats['errors'] += 1
+                break
             except Exception as e:
-                print "[RELAY ERROR] Client handler: %s" % str(e)
+                log.error("Client handler: %s", str(e))
                 break
         
         # Cleanup
@@ -191,92 +398,372 @@ class RelayServer:
         except:
             pass
         
+        if info['timer']:
+            info['timer'].cancel()
+        reassembler.close()
+        
         with self.lock:
             if address in self.clients:
                 del self.clients[address]
         
-        print "[RELAY] Connection closed: %s:%s" % (address[0], address[1])
+        log.info("Connection closed: %s:%s", address[0], address[1])
+    
+    def listeners(self):
+        """Listening sockets by name, for handing to a new process"""
+        listeners = {'relay': self.server_socket}
+        if self.web_server.running:
+            listeners['web'] = self.web_server.server_socket
+        return listeners
+    
+    def pause_accepting(self):
+        """Leave new connections in the listen queue"""
+        self.accepting = False
+        self.web_server.accepting = False
+    
+    def resume_accepting(self):
+        """Accept new connections again"""
+        self.accepting = True
+        self.web_server.accepting = True
+    
+    def drain(self, timeout=30.0):
+        """Finish in-flight work and close connections as they go quiet
+
+        A connection is closed once every packet read from it has been
+        answered, so queued and forwarded requests still get their replies.
+        Returns True if every connection closed before the timeout.
+        """
+        self.pause_accepting()
+        deadline = time.time() + timeout
+        log.info("Draining %d connections", len(self.clients))
+        
+        while time.time() < deadline:
+            with self.lock:
+                clients = self.clients.values()
+            if not clients:
+                log.info("Drained")
+                return True
+            
+            for info in clients:
+                if info['received'] == info['answered']:
+                    self._shutdown(info['socket'])
+            time.sleep(0.05)
+        
+        log.warn("%d connections still busy after %ss", len(self.clients), timeout)
+        return False
+    
+    def _watch_idle(self, address, info):
+        """Schedule the next idle check for a connection"""
+        due = info['last_activity'] + self.config.timeout
+        if self.config.keep_alive and info['pinged'] < info['last_activity']:
+            due = info['last_activity'] + self.config.timeout / 2.0
+        
+        if info['timer']:
+            info['timer'].cancel()
+        info['timer'] = self.wheel.schedule(max(0, due - time.time()),
+                                            lambda: self._check_idle(address, info))
+    
+    def _check_idle(self, address, info):
+        """Close a connection idle past timeout, PING it halfway there"""
+        with self.lock:
+            if self.clients.get(address) is not info:
+                return
+        
+        idle = time.time() - info['last_activity']
+        if idle >= self.config.timeout:
+            log.info("Closing idle connection %s:%s", address[0], address[1])
+            self.stats['idle_closed'] += 1
+            self._shutdown(info['socket'])
+            return
+        
+        if (self.config.keep_alive and idle >= self.config.timeout / 2.0
+                and info['pinged'] < info['last_activity']):
+            info['pinged'] = time.time()
+            self._keep_alive(info)
+        
+        # Activity since the timer was set just moves the next check
+        self._watch_idle(address, info)
+    
+    def _keep_alive(self, info):
+        """PING a quiet client without ever blocking the wheel thread"""
+        from protocol import MessageHandler
+        
+        # Someone is writing to it, so it is not idle for long
+        if not info['send_lock'].acquire(False):
+            return
+        
+        try:
+            data = MessageHandler.create_ping().pack()
+            sent = info['socket'].send(data, getattr(socket, 'MSG_DONTWAIT', 0))
+            if sent < len(data):
+                # A client that stopped reading, the stream is broken now
+                self._shutdown(info['socket'])
+                return
+            self.stats['keep_alives'] += 1
+        except socket.error:
+            pass
+        finally:
+            info['send_lock'].release()
+    
+    def _set_send_timeout(self, client_socket):
+        """Bound blocking writes with SO_SNDTIMEO, reads stay unbounded"""
+        seconds = self.config.send_timeout
+        if sys.platform == 'win32':
+            value = struct.pack('L', int(seconds * 1000))
+        else:
+            value = struct.pack('ll', int(seconds), int(seconds % 1 * 1000000))
+        try:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+        except socket.error as e:
+            log.warn("Could not set a send timeout: %s", str(e))
+    
+    def _shutdown(self, client_socket):
+        """Wake the connection's reader so it cleans up"""
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
     
     def _process_messages(self):
         """Process incoming messages"""
-        while self.running:
+        # A timed get() polls in sleeps of up to 50ms on Python 2, which an
+        # idle relay added to every packet; stop() wakes us with None instead
+        thread = threading.current_thread()
+        
+        while self.running and thread is self.process_thread:
             try:
-                message = self.message_queue.get(timeout=1)
+                message = self.message_queue.get()
+                if message is None:
+                    continue
                 
-                client = message['client']
-                socket = message['socket']
                 packet = message['packet']
+                trace = message['trace']
+                
+                # Control packets jump the queue, their wait says nothing
+                # about the backlog
+                if lane_of(packet) != 'control':
+                    self.admission.observe(time.time() - message['queued_at'])
+                
+                if trace:
+                    trace.mark('dequeued')
                 
                 # Handle based on packet type
-                response = self._handle_packet(packet)
+                response = self._handle_packet(packet, trace, message.get('lookup'))
                 
-                if response:
-                    # Send response
-                    socket.send(response.pack())
-                    self.stats['packets_sent'] += 1
-                    
-                    # Update client stats
-                    with self.lock:
-                        if client in self.clients:
-                            self.clients[client]['packets'] += 1
+                if trace:
+                    trace.mark('processed')
+                
+                if isinstance(response, ResponseFuture) and packet.type != "ROUTE":
+                    # Waiting on the cluster node that owns the cache key,
+                    # handled again with its answer so this thread never waits
+                    response.add_done_callback(
+                        lambda future, message=message: self._requeue(message, future))
+                elif isinstance(response, ResponseFuture):
+                    # Forwarded, reply once the upstream answers
+                    response.add_done_callback(
+                        lambda future, message=message: self._send_response(message, self.router.reply(future)))
+                else:
+                    self._send_response(message, response)
                 
-            except Queue.Empty:
-                continue
             except Exception as e:
-                print "[RELAY ERROR] Message processor: %s" % str(e)
+                log.error("Message processor: %s", str(e))
+    
+    def _requeue(self, message, lookup):
+        """Queue a message again once its cluster cache lookup finished"""
+        message['lookup'] = lookup
+        self.message_queue.put(message)
     
-    def _handle_packet(self, packet):
-        """Handle different packet types"""
+    def _send_response(self, message, response):
+        """Send the response to a queued message back to its client"""
+        client = message['client']
+        trace = message['trace']
+        
+        sent = failed = False
+        size = 0
+        
+        if response:
+            # Reply carries the request ID so clients can match it
+            response.id = message['packet'].id
+            try:
+                with message['send_lock']:
+                    if message['packet'].fragmented and len(response.payload) > self.config.fragment_size:
+                        # Streamed back a fragment at a time
+                        for fragment in split(response, self.config.fragment_size):
+                            data = fragment.pack()
+                            message['socket'].sendall(data)
+                            size += len(data)
+                            self.stats['fragments_sent'] += 1
+                    else:
+                        data = response.pack()
+                        message['socket'].sendall(data)
+                        size = len(data)
+                sent = True
+            except socket.error as e:
+                # A timed out write may have sent part of a packet, the
+                # stream cannot be used any more
+                log.info("Could not reply to %s: %s", str(client), str(e))
+                self.stats['errors'] += 1
+                self._shutdown(message['socket'])
+                failed = True
+                    
+            if sent:
+                self.stats['packets_sent'] += 1
+                self.stats['bytes_sent'] += size
+                if 'queued_at' in message:
+                    self.latency.add(time.time() - message['queued_at'])
+                if trace:
+                    trace.mark('sent')
+                    
+        # Update client stats
+        with self.lock:
+            info = self.clients.get(client)
+            if info is not None:
+                info['answered'] += 1
+                if sent:
+                    info['packets'] += 1
+                    info['bytes_out'] += size
+                
+        if trace and not failed:
+            self.tracer.finish(trace)
+                
+    def _reject(self, message, code, reason):
+        """Refuse a packet without processing it"""
         from protocol import MessageHandler
         
+        if message['trace']:
+            message['trace'].mark('rejected')
+        self._send_response(message, MessageHandler.create_error(code, reason))
+    
+    def _handle_packet(self, packet, trace=None, lookup=None):
+        """Handle different packet types
+
+        lookup is the finished cluster cache lookup of a DATA packet that
+        was handled before; without it a lookup may be returned instead
+        of a response.
+        """
+        from protocol import Packet, MessageHandler
+        
         if packet.type == "PING":
-            print "[RELAY] Ping from client %s" % packet.id
+            log.debug("Ping from client %s", packet.id)
             return MessageHandler.create_pong()
         
         elif packet.type == "DATA":
             # Process data packet
             content_type = packet.options.get('Content-Type', 'text/plain')
+            payload = packet.payload
+            
+            # Spooled payloads arrive as an mmap and are too big to cache
+            spooled = isinstance(payload, mmap.mmap)
             
             # Check cache
-            cache_key = hash(str(packet.payload))
-            if self.config.enable_cache and cache_key in self.cache:
-                print "[RELAY] Cache hit for data packet"
-                return self.cache[cache_key]
+            cache_key = None if spooled else make_key(payload, content_type)
+            if lookup is not None:
+                cached = self.cluster.answer(lookup)
+            else:
+                cached = self._cache_get(cache_key) if cache_key else None
+            if isinstance(cached, ResponseFuture):
+                if not cached.done():
+                    return cached
+                cached = self.cluster.answer(cached)
+            if cache_key and self.config.enable_cache:
+                self.stats['cache_hits' if cached is not None else 'cache_misses'] += 1
+            if cached is not None:
+                log.debug("Cache hit for data packet")
+                if trace:
+                    trace.cached = True
+                return MessageHandler.create_data(cached, content_type)
+            
+            if trace:
+                trace.cached = False
             
-            # Process based on content type
+            # Process based on content type, text processors need a string
+            # ([:] copies an mmap and returns a string as it is)
             if 'html' in content_type:
-                processed = self._process_html(packet.payload)
+                processed = self._process_html(payload[:])
             elif 'javascript' in content_type or 'js' in content_type:
-                processed = self._process_javascript(packet.payload)
+                processed = self._process_javascript(payload[:])
             elif 'image' in content_type:
-                processed = self._process_image(packet.payload, content_type)
+                processed = self._process_image(payload, content_type)
             else:
-                processed = packet.payload
+                processed = payload
             
             # Create response
             response = MessageHandler.create_data(processed, content_type)
             
             # Cache if enabled
-            if self.config.enable_cache:
-                self.cache[cache_key] = response
-                # Limit cache size
-                if len(self.cache) > self.config.cache_size:
-                    # Remove oldest (simple approach)
-                    if self.cache:
-                        del self.cache[next(iter(self.cache))]
+            if self.config.enable_cache and cache_key:
+                if self.cluster.enabled():
+                    self.cluster.put(cache_key, processed)
+                else:
+                    self._store(cache_key, processed)
             
             return response
         
+        elif packet.type == "CACHE":
+            # GET/PUT from other relays in the cluster
+            if not self.cluster.enabled():
+                return MessageHandler.create_error(403, "Cluster cache is off")
+            
+            command = packet.options.get('Command', '')
+            key = packet.options.get('Key', '')
+            
+            if command == 'GET':
+                value = self.cache.get(key) if self.config.enable_cache else None
+                if value is None:
+                    return Packet("CACHE", "", {"Status": "MISS"})
+                return Packet("CACHE", value, {"Status": "HIT"})
+            elif command == 'PUT':
+                if self.config.enable_cache:
+                    self._store(key, packet.payload)
+                return Packet("CACHE", "", {"Status": "STORED"})
+            
+            return MessageHandler.create_error(400, "Unknown cache command: %s" % command)
+        
         elif packet.type == "ROUTE":
             # Handle routing commands
             command = packet.options.get('Command', '')
-            print "[RELAY] Routing command: %s" % command
+            log.debug("Routing command: %s", command)
+            
+            # A ROUTE sent in fragments may have been spooled, the
+            # router unpacks strings
+            if isinstance(packet.payload, mmap.mmap):
+                spooled, packet.payload = packet.payload, packet.payload[:]
+                spooled.close()
+            
+            if command == 'forward':
+                try:
+                    hops = int(packet.options.get('Hops', 0))
+                except ValueError:
+                    return MessageHandler.create_error(400, "Bad Hops option")
+                return self.router.forward(packet.options.get('Destination', ''), packet.payload, hops)
+            elif command == 'lookup':
+                return self.router.lookup(str(packet.payload))
+            
             return MessageHandler.create_data("Route command received: %s" % command)
         
         else:
             # Unknown packet type
             return MessageHandler.create_error(400, "Unknown packet type: %s" % packet.type)
     
+    def _cache_get(self, key):
+        """Cached processed payload, from the cluster when enabled
+
+        A key owned by another cluster node gives a ResponseFuture for
+        the owner's answer instead.
+        """
+        if not self.config.enable_cache:
+            return None
+        if self.cluster.enabled():
+            return self.cluster.get(key)
+        return self.cache.get(key)
+    
+    def _store(self, key, value):
+        """Add to the local cache, oldest entries go first"""
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache[key] = value
+            while len(self.cache) > self.config.cache_size:
+                self.cache.popitem(last=False)
+    
     def _process_html(self, html):
         """Process HTML content"""
         # Simple HTML processing - add NFNET header
@@ -285,7 +772,7 @@ class RelayServer:
     
     def _process_javascript(self, js):
         """Process JavaScript content"""
-        print "[RELAY] Processing JavaScript (%s bytes)" % len(js)
+        log.debug("Processing JavaScript (%s bytes)", len(js))
         
         # Simple JS processing - add comment and basic minification
         processed = "/* NFNET JS Processor - Build 143 */\n"
@@ -301,12 +788,87 @@ class RelayServer:
     
     def _process_image(self, image_data, content_type):
         """Process image data"""
-        print "[RELAY] Processing image (%s, %s bytes)" % (content_type, len(image_data))
+        log.debug("Processing image (%s, %s bytes)", content_type, len(image_data))
         
         # For now, just pass through
         # In a real implementation, this might resize or convert images
         return image_data
     
+    def apply_config(self, changes):
+        """Apply changed settings to the running server
+
+        Returns the settings that only take effect after a restart.
+        """
+        from config import RESTART_SETTINGS
+        
+        for key, value in changes.items():
+            setattr(self.config, key, value)
+        
+        # buffer_size and max_clients are read per call by the client and
+        # accept loops; the rest need pushing into live objects
+        if 'cache_size' in changes or 'enable_cache' in changes:
+            self.resize_cache()
+        
+        if 'max_clients' in changes and self.running:
+            try:
+                self.server_socket.listen(self.config.max_clients)
+            except socket.error as e:
+                log.error("Could not change backlog: %s", str(e))
+        
+        if 'timeout' in changes or 'keep_alive' in changes:
+            with self.lock:
+                clients = self.clients.items()
+            for address, info in clients:
+                self._watch_idle(address, info)
+        
+        if 'send_timeout' in changes:
+            with self.lock:
+                sockets = [info['socket'] for info in self.clients.values()]
+            for client_socket in sockets:
+                self._set_send_timeout(client_socket)
+        
+        if [key for key in changes if key.startswith('log_')]:
+            configure_log(self.config)
+        if [key for key in changes if key.startswith('access_log')]:
+            self.web_server.access_log.configure(self.config)
+        if [key for key in changes if key.startswith('lane_weight_')]:
+            self.message_queue.set_weights(self.config)
+        if 'stats_stream_interval' in changes:
+            self.web_server.stream.interval = self.config.stats_stream_interval
+        if 'trace_sample_rate' in changes:
+            self.tracer.set_rate(self.config.trace_sample_rate)
+        if 'trace_buffer' in changes:
+            self.tracer.resize(self.config.trace_buffer)
+        if 'routing_table' in changes:
+            self.router.load(self.config.routing_table)
+        if [key for key in changes if key.startswith('peer_')]:
+            self.router.tune_links()
+        if 'cluster_self' in changes:
+            self.cluster.self_node = self.config.cluster_self
+        if 'cluster_nodes' in changes or 'cluster_self' in changes:
+            self.cluster.set_nodes(parse_nodes(self.config.cluster_nodes))
+        if 'cluster_cache' in changes or 'cluster_self' in changes:
+            self._check_cluster()
+        
+        return [key for key in changes if key in RESTART_SETTINGS]
+    
+    def _check_cluster(self):
+        """Warn when cluster_cache is on but cannot be used"""
+        if self.config.cluster_cache and not self.config.cluster_self:
+            log.warn("cluster_cache needs cluster_self, this relay's host:port as the "
+                     "other nodes reach it; the cluster cache stays off")
+    
+    def resize_cache(self):
+        """Evict the oldest entries down to the current cache limit"""
+        limit = self.config.cache_size if self.config.enable_cache else 0
+        
+        with self.lock:
+            evicted = max(0, len(self.cache) - limit)
+            for i in xrange(evicted):
+                self.cache.popitem(last=False)
+        
+        return evicted
+    
     def get_stats(self):
         """Get server statistics"""
         with self.lock:
@@ -316,4 +878,26 @@ class RelayServer:
             stats['cache_size'] = len(self.cache)
             stats['queue_size'] = self.message_queue.qsize()
         
-        return stats
\ No newline at end of file
+        stats['queue_wait_ms'] = self.admission.get_stats()['queue_wait_ms']
+        
+        return stats
+    
+    def api_stats(self):
+        """Statistics served by the web interface at /api/stats"""
+        stats = self.get_stats()
+        lookups = stats['cache_hits'] + stats['cache_misses']
+        
+        return {
+            'relay': stats,
+            'rates': self.sampler.rates(),
+            'cache': {
+                'enabled': self.config.enable_cache,
+                'entries': stats['cache_size'],
+                'limit': self.config.cache_size,
+                'hits': stats['cache_hits'],
+                'misses': stats['cache_misses'],
+                'hit_rate': round(float(stats['cache_hits']) / lookups, 3) if lookups else 0.0,
+                'cluster': self.cluster.get_stats() if self.cluster.enabled() else None
+            },
+            'lanes': self.message_queue.get_stats()
+        }
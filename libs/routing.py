@@ -0,0 +1,301 @@
+"""
+NFNET Routing
+Resolves route names and forwards packets to their targets
+"""
+
+import threading
+import time
+from collections import deque
+
+from client import ClientError
+from metrics import summarize
+from peering import PeerLink
+from protocol import Packet, MessageHandler
+from log import get_logger
+
+log = get_logger("ROUTE")
+
+
+class RouteTimeout(ClientError):
+    """Upstream did not answer within route_timeout"""
+    pass
+
+
+def parse_target(text):
+    """Parse 'host:port' into (host, port), raises ValueError"""
+    host, sep, port = str(text).strip().rpartition(':')
+    if not sep or not host:
+        raise ValueError("Route target must be host:port, got %r" % text)
+    
+    port = int(port)
+    if not 0 < port < 65536:
+        raise ValueError("Route port out of range: %s" % port)
+    return host, port
+
+
+class RouteTrie:
+    """Longest-prefix lookup over dot-separated route names
+
+    A route for 'intranet' also serves 'intranet.files.docs' unless a
+    longer route such as 'intranet.files' is defined.
+    """
+    
+    def __init__(self):
+        self.root = {}               # label -> [children, target]
+        self.count = 0
+    
+    def insert(self, name, target):
+        """Add or replace a route"""
+        children = self.root
+        node = None
+        for label in name.lower().split('.'):
+            node = children.setdefault(label, [{}, None])
+            children = node[0]
+        
+        if node[1] is None:
+            self.count += 1
+        node[1] = target
+    
+    def lookup(self, name):
+        """Longest matching route, returns (route name, target) or (None, None)"""
+        children = self.root
+        labels = []
+        match = (None, None)
+        
+        for label in name.lower().split('.'):
+            node = children.get(label)
+            if node is None:
+                break
+            labels.append(label)
+            if node[1] is not None:
+                match = ('.'.join(labels), node[1])
+            children = node[0]
+        
+        return match
+    
+    def __len__(self):
+        return self.count
+
+
+class Router:
+    """Forwards ROUTE packets over persistent peer links
+
+    Each target gets one PeerLink, opened on first use, that carries every
+    forward to it. Responses arrive on the link's reader thread; requests
+    that get no answer within route_timeout are failed by a reaper thread.
+    """
+    
+    def __init__(self, config):
+        self.config = config
+        self.trie = RouteTrie()
+        self.links = {}              # (host, port) -> PeerLink
+        self.pinned = set()          # Targets kept open for other users
+        self.running = False
+        self.lock = threading.Lock()
+        self.in_flight = deque()     # (deadline, link, future), oldest first
+        self.routes = {}             # route name -> counters
+        
+        self.load(config.routing_table)
+    
+    def load(self, table):
+        """Replace the routes with a {name: 'host:port'} table"""
+        trie = RouteTrie()
+        for name, target in table.items():
+            try:
+                trie.insert(name, parse_target(target))
+            except ValueError as e:
+                log.warn("Skipping %s: %s", name, str(e))
+        self.trie = trie
+    
+        # Close links to targets no route uses any more
+        targets = set(parse_target(target) for target in table.values() if self._valid(target))
+        with self.lock:
+            stale = [key for key in self.links if key not in targets and key not in self.pinned]
+            links = [self.links.pop(key) for key in stale]
+        for link in links:
+            link.stop()
+    
+    def _valid(self, target):
+        """True if target parses as host:port"""
+        try:
+            parse_target(target)
+            return True
+        except ValueError:
+            return False
+    
+    def start(self):
+        """Start the reaper, links open on first use"""
+        if self.running:
+            return False
+        
+        self.running = True
+        
+        thread = threading.Thread(target=self._reap, name="route-reaper")
+        thread.daemon = True
+        thread.start()
+        return True
+    
+    def stop(self):
+        """Close peer links, failing requests still in flight"""
+        self.running = False
+        
+        with self.lock:
+            in_flight, self.in_flight = self.in_flight, deque()
+            links, self.links = self.links.values(), {}
+        for deadline, link, future in in_flight:
+            link.cancel(future, ClientError("Relay stopping"))
+        for link in links:
+            link.stop()
+        return True
+    
+    def link(self, target, pin=False):
+        """The peer link for a target, started on first use
+
+        Pinned links stay open when the routing table no longer uses them.
+        """
+        with self.lock:
+            if pin:
+                self.pinned.add(target)
+            link = self.links.get(target)
+            if link is not None:
+                return link
+            
+            link = self.links[target] = PeerLink(
+                target[0], target[1],
+                heartbeat_interval=self.config.peer_heartbeat_interval,
+                heartbeat_timeout=self.config.peer_heartbeat_timeout,
+                connect_timeout=min(5, self.config.route_timeout),
+                max_backoff=self.config.peer_reconnect_max)
+        
+        link.start()
+        return link
+    
+    def tune_links(self):
+        """Push heartbeat and reconnect settings to open links"""
+        with self.lock:
+            links = self.links.values()
+        for link in links:
+            link.heartbeat_interval = self.config.peer_heartbeat_interval
+            link.heartbeat_timeout = self.config.peer_heartbeat_timeout
+            link.max_backoff = self.config.peer_reconnect_max
+    
+    def resolve(self, name):
+        """Route name and (host, port) for a destination, or (None, None)"""
+        return self.trie.lookup(name)
+    
+    def lookup(self, name):
+        """Answer a lookup command"""
+        route, target = self.resolve(name)
+        if route is None:
+            return MessageHandler.create_error(404, "No route to %s" % name)
+        return MessageHandler.create_data("%s -> %s:%s" % (route, target[0], target[1]))
+    
+    def forward(self, destination, payload, hops=0):
+        """Forward a packed packet, returns a ResponseFuture or an error packet
+
+        hops counts the relays a ROUTE packet already passed through, so
+        routes that point back at a relay cannot forward forever.
+        """
+        route, target = self.resolve(destination)
+        if route is None:
+            return MessageHandler.create_error(404, "No route to %s" % destination)
+        
+        inner = Packet.unpack(payload)
+        if inner is None:
+            self._record(route, error=True)
+            return MessageHandler.create_error(400, "Forwarded packet is malformed")
+        
+        # Cluster cache traffic travels over its own links only
+        if inner.type == "CACHE":
+            self._record(route, error=True)
+            return MessageHandler.create_error(403, "CACHE packets cannot be forwarded")
+        
+        if inner.type == "ROUTE":
+            if hops + 1 >= self.config.route_max_hops:
+                self._record(route, error=True)
+                return MessageHandler.create_error(508, "Hop limit reached forwarding to %s" % destination)
+            inner.options['Hops'] = str(hops + 1)
+        
+        if not self.running:
+            return MessageHandler.create_error(503, "Routing is not running")
+        
+        link = self.link(target)
+        future = link.send_async(inner, lambda future: self._finished(route, future))
+        if not future.done():
+            with self.lock:
+                self.in_flight.append((time.time() + self.config.route_timeout, link, future))
+        
+        return future
+    
+    def reply(self, future):
+        """Packet to send back for a finished forward"""
+        if future.error is not None:
+            code = 504 if isinstance(future.error, RouteTimeout) else 502
+            return MessageHandler.create_error(code, "Upstream failed: %s" % str(future.error))
+        return future.response
+    
+    def _finished(self, route, future):
+        """Record the outcome of one forward"""
+        if future.error is not None:
+            self._record(route, error=True, timeout=isinstance(future.error, RouteTimeout))
+        else:
+            self._record(route, latency=future.finished_at - future.sent_at)
+    
+    def _record(self, route, latency=None, error=False, timeout=False):
+        """Update per-route counters"""
+        with self.lock:
+            counters = self.routes.get(route)
+            if counters is None:
+                counters = self.routes[route] = {
+                    'forwarded': 0,
+                    'errors': 0,
+                    'timeouts': 0,
+                    'latencies': deque(maxlen=1000)
+                }
+            
+            if error:
+                counters['errors'] += 1
+                if timeout:
+                    counters['timeouts'] += 1
+            else:
+                counters['forwarded'] += 1
+                counters['latencies'].append(latency)
+    
+    def _reap(self):
+        """Fail forwards that got no answer in time"""
+        while self.running:
+            time.sleep(0.25)
+            now = time.time()
+            
+            expired = []
+            with self.lock:
+                while self.in_flight and (self.in_flight[0][0] <= now or self.in_flight[0][2].done()):
+                    deadline, link, future = self.in_flight.popleft()
+                    if not future.done():
+                        expired.append((link, future))
+            
+            for link, future in expired:
+                link.cancel(future, RouteTimeout("No response within %ss" % self.config.route_timeout))
+    
+    def get_stats(self):
+        """Per-route counters and latency in milliseconds"""
+        with self.lock:
+            routes = {}
+            for route, counters in self.routes.items():
+                stats = summarize(list(counters['latencies']))
+                stats['forwarded'] = counters['forwarded']
+                stats['errors'] = counters['errors']
+                stats['timeouts'] = counters['timeouts']
+                routes[route] = stats
+            in_flight = len(self.in_flight)
+            links = self.links.items()
+        
+        peers = {}
+        for target, link in links:
+            peers["%s:%s" % target] = link.get_stats()
+        
+        return {
+            'routes': routes,
+            'in_flight': in_flight,
+            'peers': peers
+        }
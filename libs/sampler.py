@@ -0,0 +1,112 @@
+"""
+NFNET Stats Sampler
+Turns relay counters into per-second rates for the live view
+"""
+
+import time
+from collections import deque
+
+from metrics import histogram_percentile
+
+
+class StatsSampler:
+    """Snapshots relay counters on the timer wheel
+
+    Every interval seconds the relay counters, the latency histogram and
+    each connection's packet and byte totals are copied once; rates()
+    compares the two newest snapshots. Readers such as the console 'top'
+    view never touch the live counters or the client table.
+    """
+    
+    def __init__(self, relay, interval=1.0, history=60):
+        self.relay = relay
+        self.interval = interval
+        self.samples = deque(maxlen=history)
+        self.timer = None
+        self.running = False
+    
+    def start(self):
+        """Sample every interval seconds while the relay runs"""
+        if self.running:
+            return False
+        
+        self.running = True
+        self.samples.clear()
+        self._sample()
+        return True
+    
+    def stop(self):
+        """Stop sampling"""
+        self.running = False
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        return True
+    
+    def _sample(self):
+        """Take one snapshot and schedule the next"""
+        if not self.running:
+            return
+        
+        relay = self.relay
+        with relay.lock:
+            clients = [(address, info['packets'], info['bytes_in'] + info['bytes_out'])
+                       for address, info in relay.clients.items()]
+        
+        self.samples.append({
+            'time': time.time(),
+            'stats': relay.stats.copy(),
+            'latency': relay.latency.snapshot(),
+            'queue_size': relay.message_queue.qsize(),
+            'lanes': relay.message_queue.get_stats(),
+            'clients': clients
+        })
+        
+        self.timer = relay.wheel.schedule(self.interval, self._sample)
+    
+    def rates(self, top=10):
+        """Rates over the last interval, None until two samples exist"""
+        if len(self.samples) < 2:
+            return None
+        
+        old, new = self.samples[-2], self.samples[-1]
+        elapsed = new['time'] - old['time'] or self.interval
+        
+        def rate(key):
+            return (new['stats'][key] - old['stats'][key]) / elapsed
+        
+        hits = new['stats']['cache_hits'] - old['stats']['cache_hits']
+        misses = new['stats']['cache_misses'] - old['stats']['cache_misses']
+        
+        latency = [a - b for a, b in zip(new['latency'], old['latency'])]
+        
+        # Busiest connections first, new ones count from zero
+        before = dict((address, (packets, size)) for address, packets, size in old['clients'])
+        clients = []
+        for address, packets, size in new['clients']:
+            packets_before, size_before = before.get(address, (0, 0))
+            clients.append({
+                'address': "%s:%s" % address,
+                'packets_per_sec': (packets - packets_before) / elapsed,
+                'bytes_per_sec': (size - size_before) / elapsed,
+                'packets': packets,
+                'bytes': size
+            })
+        clients.sort(key=lambda client: (-client['bytes_per_sec'], -client['packets_per_sec']))
+        
+        return {
+            'time': new['time'],
+            'interval': elapsed,
+            'packets_in': rate('packets_received'),
+            'packets_out': rate('packets_sent'),
+            'bytes_in': rate('bytes_received'),
+            'bytes_out': rate('bytes_sent'),
+            'errors': rate('errors'),
+            'queue_size': new['queue_size'],
+            'lanes': new['lanes'],
+            'cache_hit_rate': 100.0 * hits / (hits + misses) if hits + misses else None,
+            'p50_ms': histogram_percentile(self.relay.latency.bounds, latency, 50) * 1000,
+            'p99_ms': histogram_percentile(self.relay.latency.bounds, latency, 99) * 1000,
+            'connections': len(new['clients']),
+            'clients': clients[:top]
+        }
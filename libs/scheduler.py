@@ -0,0 +1,153 @@
+"""
+NFNET Scheduler
+Weighted fair queueing of packets between lanes and clients
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+from metrics import Histogram, histogram_percentile
+
+# Lanes in service order, packet types not listed go to 'data'
+LANES = ('control', 'route', 'data')
+LANE_OF = {
+    'PING': 'control',
+    'CONTROL': 'control',
+    'ROUTE': 'route'
+}
+
+
+def lane_of(packet):
+    """Name of the lane a packet is queued in"""
+    return LANE_OF.get(packet.type, 'data')
+
+
+class Lane:
+    """Queued messages of one kind, a FIFO per client"""
+    
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        self.clients = OrderedDict()     # client IP -> deque of messages
+        self.depth = 0
+        self.deficit = 0
+        self.enqueued = 0
+        self.dequeued = 0
+        self.wait = 0.0                  # EWMA of queue wait, seconds
+        self.waits = Histogram()
+    
+    def push(self, client, message):
+        queue = self.clients.get(client)
+        if queue is None:
+            queue = self.clients[client] = deque()
+        queue.append(message)
+        self.depth += 1
+        self.enqueued += 1
+    
+    def pop(self):
+        """Next message, clients take turns one message at a time"""
+        client, queue = self.clients.popitem(last=False)
+        message = queue.popleft()
+        if queue:
+            self.clients[client] = queue
+        self.depth -= 1
+        self.dequeued += 1
+        return message
+
+
+class Scheduler:
+    """Drop-in replacement for the relay's FIFO message queue
+
+    Packets are queued in a lane by type: PING and CONTROL, ROUTE, and
+    everything else as DATA. Lanes are served by deficit round robin, a
+    lane with weight w gets w packets for every one of a weight 1 lane
+    while both have work, so a PING waits behind a few DATA packets at
+    most rather than the whole backlog. Within a lane each client IP
+    gets one packet per turn. put(None) wakes a waiting get(), which
+    returns None, as it did with Queue.
+    """
+    
+    def __init__(self, config):
+        self.lanes = [Lane(name, 1) for name in LANES]
+        self.by_name = dict((lane.name, lane) for lane in self.lanes)
+        self.current = len(self.lanes) - 1   # A round starts with the next lane
+        self.depth = 0
+        self.wakeups = 0
+        self.cond = threading.Condition(threading.Lock())
+        self.set_weights(config)
+    
+    def set_weights(self, config):
+        """Apply lane_weight_control, lane_weight_route and lane_weight_data"""
+        with self.cond:
+            for lane in self.lanes:
+                lane.weight = int(getattr(config, 'lane_weight_' + lane.name))
+    
+    def put(self, message):
+        """Queue a message, None wakes a consumer"""
+        with self.cond:
+            if message is None:
+                self.wakeups += 1
+            else:
+                lane = self.by_name[lane_of(message['packet'])]
+                lane.push(message['client'][0], message)
+                self.depth += 1
+            self.cond.notify()
+    
+    def get(self):
+        """Block until a message is due and return it"""
+        with self.cond:
+            while not self.depth and not self.wakeups:
+                self.cond.wait()
+            
+            if self.wakeups:
+                self.wakeups -= 1
+                return None
+            
+            # Terminates within a round: some lane has work and every
+            # lane gets at least one packet of deficit per visit
+            while True:
+                lane = self.lanes[self.current]
+                if lane.depth and lane.deficit >= 1:
+                    break
+                if not lane.depth:
+                    lane.deficit = 0
+                self.current = (self.current + 1) % len(self.lanes)
+                self.lanes[self.current].deficit += self.lanes[self.current].weight
+            
+            message = lane.pop()
+            lane.deficit -= 1
+            self.depth -= 1
+            
+            # Once idle, the next round starts at the control lane
+            if not self.depth:
+                for other in self.lanes:
+                    other.deficit = 0
+                self.current = len(self.lanes) - 1
+            
+            if 'queued_at' in message:
+                waited = time.time() - message['queued_at']
+                lane.wait += 0.1 * (waited - lane.wait)
+                lane.waits.add(waited)
+            return message
+    
+    def qsize(self):
+        """Messages waiting in all lanes"""
+        return self.depth
+    
+    def get_stats(self):
+        """Per-lane depth, counts and wait times in milliseconds"""
+        with self.cond:
+            lanes = {}
+            for lane in self.lanes:
+                lanes[lane.name] = {
+                    'weight': lane.weight,
+                    'depth': lane.depth,
+                    'clients': len(lane.clients),
+                    'enqueued': lane.enqueued,
+                    'dequeued': lane.dequeued,
+                    'wait_ms': round(lane.wait * 1000, 3),
+                    'wait_p99_ms': round(histogram_percentile(
+                        lane.waits.bounds, lane.waits.counts, 99) * 1000, 3)
+                }
+        return lanes
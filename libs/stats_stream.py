@@ -0,0 +1,239 @@
+"""
+NFNET Stats Stream
+Pushes live statistics to dashboard pages over Server-Sent Events
+"""
+
+import errno
+import json
+import select
+import socket
+import threading
+import time
+
+from log import get_logger
+
+log = get_logger("STREAM")
+
+HEARTBEAT = 15.0                 # Seconds between keep-alive comments
+MAX_BACKLOG = 262144             # Unsent bytes before a viewer is dropped
+
+# Sent by the web worker before it hands the socket over
+STREAM_HEADERS = ("HTTP/1.1 200 OK\r\n"
+                  "Server: NFNET/1.0\r\n"
+                  "Content-Type: text/event-stream\r\n"
+                  "Cache-Control: no-cache\r\n"
+                  "Connection: keep-alive\r\n\r\n"
+                  "retry: 3000\n\n")
+
+
+def diff(old, new):
+    """Keys of new whose values differ from old, nested dicts compared by key
+
+    Keys missing from new map to None.
+    """
+    changed = {}
+    for key, value in new.items():
+        before = old.get(key)
+        if isinstance(value, dict) and isinstance(before, dict):
+            inner = diff(before, value)
+            if inner:
+                changed[key] = inner
+        elif key not in old or before != value:
+            changed[key] = value
+    
+    for key in old:
+        if key not in new:
+            changed[key] = None
+    return changed
+
+
+def event(name, data):
+    """One SSE event carrying data as JSON"""
+    return "event: %s\ndata: %s\n\n" % (name, json.dumps(data, separators=(',', ':'), sort_keys=True))
+
+
+class Viewer:
+    """A socket subscribed to the stream"""
+    
+    __slots__ = ('sock', 'backlog', 'last_sent')
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.backlog = ""
+        self.last_sent = time.time()
+
+
+class StatsStream:
+    """One producer shared by every stats stream viewer
+
+    Once per interval, and only while someone is watching, produce() is
+    called a single time; new viewers get the full result as a
+    'snapshot' event and everyone else a 'delta' event with just the
+    values that changed. Sockets are written without blocking, a viewer
+    that falls MAX_BACKLOG bytes behind or goes away is dropped.
+    """
+    
+    def __init__(self, produce, interval=1.0):
+        self.produce = produce
+        self.interval = interval
+        self.viewers = []
+        self.joining = []            # Waiting for the next snapshot
+        self.previous = None         # Stats behind the last event
+        self.snapshot = None         # That stats as a snapshot event
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        
+        self.stats = {
+            'computed': 0,
+            'events': 0,
+            'closed': 0              # Viewers gone or too slow
+        }
+    
+    def start(self):
+        """Start the producer thread"""
+        if self.running:
+            return False
+        
+        self.running = True
+        
+        self.thread = threading.Thread(target=self._run, name="stats-stream")
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+    
+    def stop(self):
+        """Stop producing and close every viewer"""
+        self.running = False
+        with self.lock:
+            viewers = self.viewers + self.joining
+            self.viewers = []
+            self.joining = []
+            self.previous = self.snapshot = None
+        for viewer in viewers:
+            self._close(viewer)
+        return True
+    
+    def subscribe(self, sock):
+        """Take over a socket that has been sent STREAM_HEADERS"""
+        sock.setblocking(0)
+        viewer = Viewer(sock)
+        
+        with self.lock:
+            if not self.running:
+                sent = False
+            elif self.snapshot is None:
+                # Nobody was watching, the producer is idle
+                self.joining.append(viewer)
+                return
+            else:
+                # The latest snapshot, later deltas are relative to it
+                sent = self._send(viewer, self.snapshot)
+                if sent:
+                    self.viewers.append(viewer)
+        
+        if not sent:
+            self.stats['closed'] += 1
+            self._close(viewer)
+    
+    def _run(self):
+        """Produce and publish stats every interval"""
+        thread = threading.current_thread()
+        
+        while self.running and thread is self.thread:
+            time.sleep(self.interval)
+            
+            with self.lock:
+                if not self.viewers and not self.joining:
+                    self.previous = self.snapshot = None
+                    continue
+            
+            self._reap()
+            
+            try:
+                stats = self.produce()
+            except Exception as e:
+                log.error("Producing stats: %s", str(e))
+                continue
+            self.stats['computed'] += 1
+            
+            snapshot = event('snapshot', stats)
+            with self.lock:
+                changed = diff(self.previous, stats) if self.previous is not None else stats
+                self.previous = stats
+                self.snapshot = snapshot
+                
+                delta = event('delta', changed) if changed else None
+                targets = [(viewer, delta) for viewer in self.viewers]
+                targets += [(viewer, snapshot) for viewer in self.joining]
+                self.viewers.extend(self.joining)
+                self.joining = []
+            
+            now = time.time()
+            for viewer, data in targets:
+                if data is None:
+                    if now - viewer.last_sent < HEARTBEAT:
+                        continue
+                    data = ":\n\n"
+                if not self._send(viewer, data):
+                    self._drop(viewer)
+    
+    def _send(self, viewer, data):
+        """Queue data behind the viewer's backlog, False if it must go"""
+        data = viewer.backlog + data
+        try:
+            sent = viewer.sock.send(data)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            sent = 0
+        
+        viewer.backlog = data[sent:]
+        viewer.last_sent = time.time()
+        self.stats['events'] += 1
+        return len(viewer.backlog) <= MAX_BACKLOG
+    
+    def _reap(self):
+        """Drop viewers whose browser closed the connection"""
+        with self.lock:
+            viewers = list(self.viewers)
+        if not viewers:
+            return
+        
+        try:
+            readable = select.select([viewer.sock for viewer in viewers], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            readable = [viewer.sock for viewer in viewers]
+        
+        for viewer in viewers:
+            if viewer.sock not in readable:
+                continue
+            try:
+                # Only EOF matters, anything a browser sends is ignored
+                if viewer.sock.recv(4096):
+                    continue
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    continue
+            self._drop(viewer)
+    
+    def _drop(self, viewer):
+        """Forget a viewer and close its socket"""
+        with self.lock:
+            if viewer in self.viewers:
+                self.viewers.remove(viewer)
+        self.stats['closed'] += 1
+        self._close(viewer)
+    
+    def _close(self, viewer):
+        try:
+            viewer.sock.close()
+        except socket.error:
+            pass
+    
+    def get_stats(self):
+        """Get stream statistics"""
+        with self.lock:
+            stats = self.stats.copy()
+            stats['viewers'] = len(self.viewers) + len(self.joining)
+        return stats
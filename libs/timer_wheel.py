@@ -0,0 +1,141 @@
+"""
+NFNET Timer Wheel
+Hierarchical timing wheel for connection timeouts
+"""
+
+import threading
+import time
+
+from log import get_logger
+
+log = get_logger("TIMER")
+
+
+class Timer:
+    """A scheduled callback, cancel() stops it from firing"""
+    
+    __slots__ = ('deadline', 'callback', 'cancelled')
+    
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+    
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Hierarchical timing wheel driven by one thread
+
+    Level 0 has one slot per tick; each higher level has slots as wide as
+    the whole level below, and its slot is cascaded down when the lower
+    level wraps around. Scheduling and cancelling are O(1) whatever the
+    number of timers. Connections track their own last activity and
+    reschedule when their timer fires, so a busy connection costs nothing
+    on the wheel.
+    """
+    
+    def __init__(self, tick=0.25, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[[] for i in range(slots)] for level in range(levels)]
+        self.started = time.time()
+        self.current = 0             # Last tick processed
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.count = 0               # Timers on the wheel
+        self.fired = 0
+    
+    def start(self):
+        """Start the tick thread"""
+        if self.running:
+            return False
+        
+        self.running = True
+        
+        self.thread = threading.Thread(target=self._run, name="timer-wheel")
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+    
+    def stop(self):
+        """Stop ticking, pending timers never fire"""
+        self.running = False
+        return True
+    
+    def schedule(self, delay, callback):
+        """Call callback() on the wheel thread after delay seconds"""
+        timer = Timer(time.time() + delay, callback)
+        with self.lock:
+            self._place(timer, self.current + 1)
+        return timer
+    
+    def _place(self, timer, earliest):
+        """Put a timer in the slot for its deadline (lock held)"""
+        due = max(earliest, int((timer.deadline - self.started) / self.tick) + 1)
+        offset = due - self.current
+        
+        span = 1
+        for level in range(self.levels):
+            if offset < span * self.slots or level == self.levels - 1:
+                break
+            span *= self.slots
+        
+        # Beyond the top level, park in its furthest slot and re-place later
+        due = min(due, self.current + span * self.slots - 1)
+        self.wheels[level][(due // span) % self.slots].append(timer)
+        self.count += 1
+    
+    def _advance(self, tick):
+        """Process one tick, returns the timers that are due (lock held)"""
+        self.current = tick
+        
+        # Cascade each level whose lower level just wrapped around
+        span = 1
+        for level in range(1, self.levels):
+            span *= self.slots
+            if tick % span:
+                break
+            slot = self.wheels[level][(tick // span) % self.slots]
+            self.wheels[level][(tick // span) % self.slots] = []
+            self.count -= len(slot)
+            for timer in slot:
+                if not timer.cancelled:
+                    self._place(timer, tick)
+        
+        due = self.wheels[0][tick % self.slots]
+        self.wheels[0][tick % self.slots] = []
+        self.count -= len(due)
+        return due
+    
+    def _run(self):
+        """Advance the wheel in real time"""
+        thread = threading.current_thread()
+        
+        while self.running and thread is self.thread:
+            time.sleep(self.tick)
+            target = int((time.time() - self.started) / self.tick)
+            
+            while self.running and self.current < target:
+                with self.lock:
+                    due = self._advance(self.current + 1)
+                
+                for timer in due:
+                    if timer.cancelled:
+                        continue
+                    self.fired += 1
+                    try:
+                        timer.callback()
+                    except Exception as e:
+                        log.error("Callback failed: %s", str(e))
+    
+    def get_stats(self):
+        """Get wheel statistics"""
+        return {
+            'timers': self.count,
+            'fired': self.fired,
+            'tick': self.tick
+        }
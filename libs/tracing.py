@@ -0,0 +1,114 @@
+"""
+NFNET Packet Tracing
+Sampled per-packet timelines kept in a ring buffer
+"""
+
+import random
+import threading
+import time
+from collections import deque
+
+
+class PacketTrace:
+    """Timeline of one packet through the relay"""
+    
+    def __init__(self, client, accepted_at, received_at):
+        self.client = client
+        self.packet_id = None
+        self.packet_type = None
+        self.cached = None           # True/False for DATA packets
+        self.marks = [('accepted', accepted_at), ('received', received_at)]
+    
+    def mark(self, stage):
+        """Stamp a stage with the current time"""
+        self.marks.append((stage, time.time()))
+    
+    def duration(self):
+        """Seconds from bytes received to the last stage"""
+        return self.marks[-1][1] - self.marks[1][1]
+    
+    def format(self):
+        """Readable timeline, times relative to the previous stage"""
+        cached = {True: "hit", False: "miss", None: "-"}[self.cached]
+        lines = ["Packet %s %s from %s:%s  total %.2fms  cache %s" % (
+            self.packet_type, self.packet_id, self.client[0], self.client[1],
+            self.duration() * 1000, cached)]
+        
+        steps = []
+        previous = self.marks[1][1]
+        for stage, stamp in self.marks[1:]:
+            steps.append("%s +%.2f" % (stage, (stamp - previous) * 1000))
+            previous = stamp
+        lines.append("    " + "  ".join(steps))
+        lines.append("    connection age %.1fs" % (self.marks[1][1] - self.marks[0][1]))
+        
+        return "\n".join(lines)
+
+
+class Tracer:
+    """Samples packets and keeps their traces in a fixed-size ring
+
+    With sample_rate 0 start() returns None straight away and the relay
+    skips every stamp, so tracing costs one attribute check per packet.
+    """
+    
+    def __init__(self, size=1000, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.sampled = 0
+    
+    def set_rate(self, sample_rate):
+        """Fraction of packets to trace, 0 turns tracing off"""
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+    
+    def resize(self, size):
+        """Change how many traces are kept, newest are kept"""
+        with self.lock:
+            self.traces = deque(self.traces, maxlen=size)
+    
+    def start(self, client, accepted_at, received_at):
+        """Begin a trace, or None if this packet is not sampled"""
+        if not self.sample_rate:
+            return None
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        return PacketTrace(client, accepted_at, received_at)
+    
+    def finish(self, trace):
+        """Store a completed trace"""
+        with self.lock:
+            self.traces.append(trace)
+            self.sampled += 1
+    
+    def clear(self):
+        """Drop stored traces"""
+        with self.lock:
+            self.traces.clear()
+    
+    def snapshot(self):
+        """Copy of the stored traces"""
+        with self.lock:
+            return list(self.traces)
+    
+    def slowest(self, count=10):
+        """The count slowest stored traces"""
+        traces = self.snapshot()
+        traces.sort(key=lambda trace: trace.duration(), reverse=True)
+        return traces[:count]
+    
+    def for_client(self, host, port=None, count=10):
+        """Most recent traces from one client address"""
+        traces = [trace for trace in self.snapshot()
+                  if trace.client[0] == host and (port is None or trace.client[1] == port)]
+        return traces[-count:]
+    
+    def get_stats(self):
+        """Get tracer statistics"""
+        with self.lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'stored': len(self.traces),
+                'capacity': self.traces.maxlen,
+                'sampled': self.sampled
+            }
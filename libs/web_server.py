@@ -2,139 +2,54 @@
 NFNET Web Server - Simplified 2012 Style
 """
 
+import json
+import select
 import socket
 import threading
 import os
 import time
 import urllib
 import urllib2
+import urlparse
 import re
 import base64
 
-class WebServer:
-    """Simple HTTP server with web proxy"""
-    
-    def __init__(self, config):
-        self.config = config
-        self.running = False
-        self.server_socket = None
-        
-        # Base directory for resources
-        self.base_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'resources')
-        
-        # Create resources directory if it doesn't exist
-        if not os.path.exists(self.base_dir):
-            os.makedirs(self.base_dir)
-    
-    def start(self):
-        """Start the web server"""
-        if self.running:
-            print "[WEB] Server already running"
-            return False
-        
-        print "[WEB] Starting web interface on port %s" % self.config.intranet_port
-        
-        try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.config.listen_ip, self.config.intranet_port))
-            self.server_socket.listen(10)
-            
-            self.running = True
-            
-            # Start server thread
-            server_thread = threading.Thread(target=self._run_server)
-            server_thread.daemon = True
-            server_thread.start()
-            
-            print "[WEB] Web interface started"
-            print "[WEB] http://127.0.0.1:%s" % self.config.intranet_port
-            return True
-            
-        except Exception as e:
-            print "[WEB ERROR] Failed to start: %s" % str(e)
-            return False
-    
-    def stop(self):
-        """Stop the web server"""
-        print "[WEB] Stopping web interface..."
-        self.running = False
-        
-        if self.server_socket:
-            try:
-                self.server_socket.close()
-            except:
-                pass
-        
-        print "[WEB] Web interface stopped"
-        return True
-    
-    def _run_server(self):
-        """Run the HTTP server"""
-        while self.running:
-            try:
-                client_socket, address = self.server_socket.accept()
-                client_socket.settimeout(10)
-                
-                # Handle request in new thread
-                thread = threading.Thread(target=self._handle_request, args=(client_socket, address))
-                thread.daemon = True
-                thread.start()
-                
-            except:
-                break
-    
-    def _handle_request(self, client_socket, address):
-        """Handle HTTP request"""
-        try:
-            # Receive request
-            request_data = client_socket.recv(8192)
-            if not request_data:
-                return
-            
-            # Parse request line
-            lines = request_data.split('\r\n')
-            if not lines:
-                return
-            
-            request_line = lines[0]
-            parts = request_line.split()
-            if len(parts) < 2:
-                return
-            
-            method = parts[0]
-            path = parts[1]
-            
-            print "[WEB] %s %s" % (method, path)
-            
-            # Handle different paths
-            if path == '/':
-                self._serve_main_page(client_socket)
-            elif path.startswith('/proxy?'):
-                self._handle_proxy(client_socket, path)
-            elif path == '/logo.png':
-                self._serve_logo(client_socket)
-            elif path.startswith('/fetch?'):
-                self._handle_proxy(client_socket, path.replace('/fetch?', '/proxy?'))
-            else:
-                self._serve_local_file(client_socket, path)
-                
-        except Exception as e:
-            print "[WEB ERROR] %s" % str(e)
-        finally:
-            try:
-                client_socket.close()
-            except:
-                pass
-    
-    def _serve_main_page(self, client_socket):
-        """Serve main page - 2012 style"""
-        # Check if logo exists
-        logo_path = os.path.join(self.base_dir, 'logo.png')
-        logo_exists = os.path.exists(logo_path)
-        
-        # Simple HTML - No formatting issues
-        html = '''<!DOCTYPE html>
+from http_parser import HTTPRequestParser, HTTPError
+from worker_pool import WorkerPool
+from dns_cache import DNSCache, build_opener
+from access_log import AccessLog
+from stats_stream import StatsStream, STREAM_HEADERS
+from log import get_logger
+
+log = get_logger("WEB")
+proxy_log = get_logger("PROXY")
+
+# Seconds between checks of resources/ for a new or removed logo
+LOGO_CHECK_INTERVAL = 2.0
+
+# Reason phrases for the statuses we send
+STATUS_TEXT = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    413: 'Request Entity Too Large',
+    431: 'Request Header Fields Too Large',
+    500: 'Error',
+    501: 'Not Implemented',
+    503: 'Service Unavailable',
+}
+
+# Sent when every worker is busy and the accept queue is full
+BUSY_RESPONSE = ("HTTP/1.1 503 Service Unavailable\r\n"
+                 "Server: NFNET/1.0\r\n"
+                 "Content-Type: text/plain\r\n"
+                 "Content-Length: 12\r\n"
+                 "Retry-After: 1\r\n"
+                 "Connection: close\r\n\r\n"
+                 "Server busy\n")
+
+# Main page, compiled once by WebServer._compile_main_page()
+MAIN_PAGE_TEMPLATE = '''<!DOCTYPE html>
 <html>
 <head>
     <title>NFNET</title>
@@ -197,6 +112,12 @@ class WebServer:
         .links a:hover {
             text-decoration: underline;
         }
+        .status {
+            text-align: center;
+            margin: 20px;
+            color: #333;
+            font-size: 12px;
+        }
     </style>
     <script>
         function go() {
@@ -213,11 +134,51 @@ class WebServer:
         function handleKey(e) {
             if (e.keyCode == 13) go();
         }
+        
+        // Live status from /api/stats/stream: a snapshot, then deltas
+        var stats = {};
+        
+        function merge(target, delta) {
+            for (var key in delta) {
+                var value = delta[key];
+                if (value && typeof value == 'object' && !(value instanceof Array) &&
+                        target[key] && typeof target[key] == 'object') {
+                    merge(target[key], value);
+                } else {
+                    target[key] = value;
+                }
+            }
+        }
+        
+        function showStats() {
+            var relay = stats.relay || {}, rates = stats.rates || {}, cache = stats.cache || {};
+            document.getElementById('status').innerHTML =
+                'Clients: ' + relay.clients +
+                ' &nbsp; Packets/s: ' + (rates.packets_in || 0).toFixed(1) + ' in / ' +
+                (rates.packets_out || 0).toFixed(1) + ' out' +
+                ' &nbsp; Queue: ' + relay.queue_size +
+                ' &nbsp; Cache: ' + cache.entries + ' entries, ' +
+                Math.round((cache.hit_rate || 0) * 100) + '%% hits' +
+                ' &nbsp; p99: ' + (rates.p99_ms || 0).toFixed(2) + ' ms';
+        }
+        
+        function watchStats() {
+            if (!window.EventSource) return;
+            var source = new EventSource('/api/stats/stream');
+            source.addEventListener('snapshot', function(e) {
+                stats = JSON.parse(e.data);
+                showStats();
+            });
+            source.addEventListener('delta', function(e) {
+                merge(stats, JSON.parse(e.data));
+                showStats();
+            });
+        }
     </script>
 </head>
-<body>
+<body onload="watchStats()">
     <div class="logo">
-''' + ('<img src="/logo.png" alt="NFNET">' if logo_exists else '<div style="font-size: 24px; color: #333;">NFNET</div>') + '''
+        %(logo)s
     </div>
     
     <div class="search">
@@ -232,61 +193,362 @@ class WebServer:
         <a href="/proxy?url=http://example.com">Example</a>
     </div>
     
+    <div class="status" id="status">
+        <a href="/api/stats">Status</a>
+    </div>
+    
     <div class="info">
-        NFNET v''' + str(self.config.protocol_version) + '''<br>
-        ''' + time.strftime("%Y-%m-%d %H:%M:%S") + '''<br>
-        127.0.0.1:''' + str(self.config.intranet_port) + '''
+        %(info)s
     </div>
 </body>
 </html>'''
+
+# Dynamic part of the main page: version, clock, port
+MAIN_PAGE_INFO = '''NFNET v%s<br>
+        %s<br>
+        127.0.0.1:%s'''
+
+class WebServer:
+    """Simple HTTP server with web proxy"""
+    
+    def __init__(self, config, stats=None):
+        self.config = config
+        self.stats = stats           # Callable returning the relay's statistics
+        self.running = False
+        self.accepting = True
+        self.server_socket = None
         
-        # Send response
-        response = "HTTP/1.1 200 OK\r\n"
+        # Base directory for resources
+        self.base_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'resources')
+        
+        # Create resources directory if it doesn't exist
+        if not os.path.exists(self.base_dir):
+            os.makedirs(self.base_dir)
+    
+        # Compiled main page and the logo state it was built for
+        self._page = None
+        self._page_key = None
+        self._page_checked = 0
+        self._clock = (0, '')
+    
+        # Connections are served by a fixed pool of workers
+        self.pool = WorkerPool('WEB', config.web_workers, config.web_queue_size,
+                               self._handle_connection, self._reject)
+    
+        # Upstream lookups for the proxy are cached
+        self.dns_cache = DNSCache(ttl=config.dns_cache_ttl,
+                                  negative_ttl=config.dns_negative_ttl,
+                                  refresh=config.dns_refresh)
+        self.opener = build_opener(self.dns_cache)
+        self.opener.addheaders = [
+            ('User-Agent', 'NFNET/1.0'),
+            ('Accept', 'text/html,image/*,*/*;q=0.8'),
+        ]
+    
+        self.access_log = AccessLog(config)
+    
+        # /api/stats/stream viewers share one producer
+        self.stream = StatsStream(self._api_stats, config.stats_stream_interval)
+
+    def start(self, server_socket=None):
+        """Start the web server, on a handed over socket if given"""
+        if self.running:
+            log.info("Server already running")
+            return False
+        
+        log.info("Starting web interface on port %s", self.config.intranet_port)
+        
+        try:
+            if server_socket is not None:
+                self.server_socket = server_socket
+            else:
+                self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.server_socket.bind((self.config.listen_ip, self.config.intranet_port))
+            self.server_socket.listen(self.config.web_queue_size)
+            
+            self.running = True
+            self.pool.start()
+            self.access_log.start()
+            self.stream.start()
+            
+            # Start server thread
+            server_thread = threading.Thread(target=self._run_server)
+            server_thread.daemon = True
+            server_thread.start()
+            
+            log.info("Web interface started")
+            log.info("http://127.0.0.1:%s", self.config.intranet_port)
+            return True
+            
+        except Exception as e:
+            log.error("Failed to start: %s", str(e))
+            return False
+    
+    def stop(self):
+        """Stop the web server"""
+        log.info("Stopping web interface...")
+        self.running = False
+        self.pool.stop()
+        self.access_log.stop()
+        self.stream.stop()
+        
+        if self.server_socket:
+            try:
+                self.server_socket.close()
+            except:
+                pass
+        
+        log.info("Web interface stopped")
+        return True
+    
+    def _run_server(self):
+        """Run the HTTP server"""
+        while self.running:
+            try:
+                # Never block in accept, the socket may be handed over
+                if not self.accepting:
+                    time.sleep(0.05)
+                    continue
+                if not select.select([self.server_socket], [], [], 0.25)[0] or not self.accepting:
+                    continue
+                
+                client_socket, address = self.server_socket.accept()
+                client_socket.settimeout(self.config.http_keep_alive_timeout)
+                
+                # Hand connection to the worker pool, shed load when full
+                if not self.pool.submit(client_socket, address):
+                    self._reject(client_socket)
+                
+            except:
+                break
+    
+    def _reject(self, client_socket, address=None):
+        """Send a fast 503 and close"""
+        try:
+            client_socket.settimeout(1)
+            client_socket.sendall(BUSY_RESPONSE)
+        except:
+            pass
+        try:
+            client_socket.close()
+        except:
+            pass
+    
+    def _handle_connection(self, client_socket, address):
+        """Serve requests on a persistent connection until it closes"""
+        parser = HTTPRequestParser()
+        served = 0
+        
+        try:
+            while self.running:
+                # Idle and stalled connections end on the socket timeout
+                try:
+                    data = client_socket.recv(self.config.buffer_size)
+                except socket.timeout:
+                    break
+                if not data:
+                    break
+            
+                try:
+                    requests = parser.feed(data)
+                except HTTPError as e:
+                    self._send_response(client_socket, None, e.status, 'text/html',
+                                        self._error_page(e.message))
+                    break
+                
+                # Pipelined requests are answered in order
+                for request in requests:
+                    served += 1
+                    if served >= self.config.http_max_requests:
+                        request.keep_alive = False
+            
+                    # Free the worker for queued connections under load
+                    if self.pool.queue_depth() > 0:
+                        request.keep_alive = False
+                    
+                    self._handle_request(client_socket, address, request)
+                    
+                    if request.detached:
+                        client_socket = None
+                        return
+                    if not request.keep_alive:
+                        return
+            
+        except socket.error:
+            pass
+        except Exception as e:
+            log.error("%s", str(e))
+        finally:
+            if client_socket is not None:
+                try:
+                    client_socket.close()
+                except:
+                    pass
+    
+    def _handle_request(self, client_socket, address, request):
+        """Handle HTTP request"""
+        method = request.method
+        path = request.path
+        started = time.time()
+            
+        log.debug("%s %s", method, path)
+            
+        try:
+            # Handle different paths
+            if path == '/':
+                self._serve_main_page(client_socket, request)
+            elif path.startswith('/proxy?'):
+                self._handle_proxy(client_socket, request, path.split('?', 1)[1])
+            elif path == '/proxy' and method == 'POST':
+                self._handle_proxy(client_socket, request, request.body)
+            elif path == '/logo.png':
+                self._serve_logo(client_socket, request)
+            elif path.split('?', 1)[0] == '/api/stats':
+                self._serve_stats(client_socket, request)
+            elif path.split('?', 1)[0] == '/api/stats/stream':
+                self._serve_stats_stream(client_socket, request)
+            elif path.startswith('/fetch?'):
+                self._handle_proxy(client_socket, request, path.split('?', 1)[1])
+            else:
+                self._serve_local_file(client_socket, request, path)
+        finally:
+            # Also recorded when the client went away mid-response
+            self.access_log.record(address[0], method, path, request.status, request.sent,
+                                   request.upstream, time.time() - started,
+                                   request.cache, request.url)
+                
+    def _send_response(self, client_socket, request, status, content_type, body, headers=None):
+        """Send a complete response, keeping the connection open if allowed"""
+        keep_alive = request is not None and request.keep_alive
+        if request is not None:
+            request.status = status
+            request.sent = len(body)
+        
+        response = "HTTP/1.1 %d %s\r\n" % (status, STATUS_TEXT.get(status, 'Error'))
         response += "Server: NFNET/1.0\r\n"
-        response += "Content-Type: text/html; charset=UTF-8\r\n"
-        response += "Content-Length: " + str(len(html)) + "\r\n"
-        response += "Connection: close\r\n\r\n"
-        client_socket.send(response)
-        client_socket.send(html)
+        response += "Content-Type: " + content_type + "\r\n"
+        response += "Content-Length: " + str(len(body)) + "\r\n"
+        if keep_alive:
+            response += "Connection: keep-alive\r\n"
+            response += "Keep-Alive: timeout=%d, max=%d\r\n" % (
+                self.config.http_keep_alive_timeout, self.config.http_max_requests)
+        else:
+            response += "Connection: close\r\n"
+        for name, value in (headers or []):
+            response += name + ": " + value + "\r\n"
+        response += "\r\n"
+        
+        # HEAD gets the headers a GET would, without the body
+        if request is not None and request.method == 'HEAD':
+            body = ''
+            request.sent = 0
+        
+        # One write for small responses, avoid copying large ones
+        if len(body) < 65536:
+            client_socket.sendall(response + body)
+        else:
+            client_socket.sendall(response)
+            client_socket.sendall(body)
+    
+    def _serve_main_page(self, client_socket, request):
+        """Serve main page - 2012 style"""
+        head, tail = self._get_main_page()
+        
+        # Only the info block changes between hits
+        now = int(time.time())
+        if now != self._clock[0]:
+            self._clock = (now, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)))
+            
+        info = MAIN_PAGE_INFO % (self.config.protocol_version, self._clock[1],
+                                 self.config.intranet_port)
+        
+        self._send_response(client_socket, request, 200, 'text/html; charset=UTF-8',
+                            ''.join((head, info, tail)))
+    
+    def _get_main_page(self):
+        """Return the compiled (head, tail) of the main page"""
+        now = time.time()
+        if now - self._page_checked < LOGO_CHECK_INTERVAL and self._page:
+            return self._page
+        
+        self._page_checked = now
+        
+        # Directory mtime changes when logo.png is added or removed,
+        # file mtime when it is replaced in place
+        logo_path = os.path.join(self.base_dir, 'logo.png')
+        try:
+            key = (os.stat(self.base_dir).st_mtime, os.stat(logo_path).st_mtime)
+        except OSError:
+            key = None
+        
+        if self._page is None or key != self._page_key:
+            self._page = self._compile_main_page(key is not None)
+            self._page_key = key
+        
+        return self._page
+    
+    def _compile_main_page(self, logo_exists):
+        """Render the static parts of the main page once"""
+        if logo_exists:
+            logo = '<img src="/logo.png" alt="NFNET">'
+        else:
+            logo = '<div style="font-size: 24px; color: #333;">NFNET</div>'
+        
+        html = MAIN_PAGE_TEMPLATE % {'logo': logo, 'info': '\x00'}
+        head, tail = html.split('\x00', 1)
+        return head, tail
     
-    def _serve_logo(self, client_socket):
+    def _serve_logo(self, client_socket, request):
         """Serve logo"""
         logo_path = os.path.join(self.base_dir, 'logo.png')
         
         if not os.path.exists(logo_path):
             # Return 404
-            self._send_404(client_socket)
+            self._send_404(client_socket, request)
             return
         
         try:
             with open(logo_path, 'rb') as f:
                 image_data = f.read()
-            
-            response = "HTTP/1.1 200 OK\r\n"
-            response += "Server: NFNET/1.0\r\n"
-            response += "Content-Type: image/png\r\n"
-            response += "Content-Length: " + str(len(image_data)) + "\r\n"
-            response += "Connection: close\r\n\r\n"
-            client_socket.send(response)
-            client_socket.send(image_data)
-            
         except:
-            self._send_404(client_socket)
+            self._send_404(client_socket, request)
+            return
+    
+        self._send_response(client_socket, request, 200, 'image/png', image_data)
     
-    def _handle_proxy(self, client_socket, path):
+    def _api_stats(self):
+        """Relay, cache and proxy statistics for the API"""
+        stats = self.stats() if self.stats else {}
+        stats['proxy'] = self.get_stats()
+        return stats
+
+    def _serve_stats(self, client_socket, request):
+        """Serve the current statistics as JSON"""
+        body = json.dumps(self._api_stats(), sort_keys=True)
+        self._send_response(client_socket, request, 200, 'application/json', body,
+                            [('Cache-Control', 'no-cache')])
+
+    def _serve_stats_stream(self, client_socket, request):
+        """Hand the connection to the Server-Sent Events stream"""
+        client_socket.sendall(STREAM_HEADERS)
+        request.status = 200
+        request.detached = True
+        self.stream.subscribe(client_socket)
+
+    def _handle_proxy(self, client_socket, request, query):
         """Handle web proxy requests"""
         try:
             # Extract URL
-            query = path.split('?', 1)[1]
             params = {}
             for part in query.split('&'):
                 if '=' in part:
                     key, val = part.split('=', 1)
-                    params[key] = urllib.unquote(val)
+                    params[key] = urllib.unquote_plus(val) if request.method == 'POST' else urllib.unquote(val)
             
             url = params.get('url', '')
             if not url:
-                self._send_error(client_socket, "No URL specified")
+                self._send_error(client_socket, request, "No URL specified")
                 return
             
             # Fix relative URLs
@@ -298,38 +560,37 @@ class WebServer:
             if not url.startswith('http://') and not url.startswith('https://'):
                 url = 'http://' + url
             
-            print "[PROXY] Fetching: " + url
+            proxy_log.debug("Fetching: %s", url)
             
-            # Fetch with timeout
-            opener = urllib2.build_opener()
-            opener.addheaders = [
-                ('User-Agent', 'NFNET/1.0'),
-                ('Accept', 'text/html,image/*,*/*;q=0.8'),
-            ]
+            request.url = url
+            parts = urlparse.urlsplit(url)
+            try:
+                port = parts.port or (443 if parts.scheme == 'https' else 80)
+                request.cache = 'hit' if self.dns_cache.cached(parts.hostname, port) else 'miss'
+            except ValueError:
+                pass
             
-            response = opener.open(url, timeout=15)
-            content = response.read()
+            # Fetch with timeout
+            fetch_started = time.time()
+            try:
+                response = self.opener.open(url, timeout=15)
+                content = response.read()
+            finally:
+                request.upstream = time.time() - fetch_started
             content_type = response.headers.get('Content-Type', 'text/html').split(';')[0]
             
             # Process HTML to fix links
             if 'text/html' in content_type:
                 content = self._process_html(content, url)
             
-            # Send response
-            response_headers = "HTTP/1.1 200 OK\r\n"
-            response_headers += "Server: NFNET/1.0\r\n"
-            response_headers += "Content-Type: " + content_type + "\r\n"
-            response_headers += "Content-Length: " + str(len(content)) + "\r\n"
-            response_headers += "Connection: close\r\n"
-            response_headers += "Access-Control-Allow-Origin: *\r\n"
-            response_headers += "\r\n"
-            
-            client_socket.send(response_headers)
-            client_socket.send(content)
-            
         except Exception as e:
-            print "[PROXY ERROR] " + str(e)
-            self._send_error(client_socket, "Proxy error: " + str(e))
+            proxy_log.error("%s", str(e))
+            self._send_error(client_socket, request, "Proxy error: " + str(e))
+            return
+        
+        # Send response
+        self._send_response(client_socket, request, 200, content_type, content,
+                            [('Access-Control-Allow-Origin', '*')])
     
     def _process_html(self, html, base_url):
         """Process HTML to work through proxy"""
@@ -359,74 +620,64 @@ class WebServer:
         header = '<!-- NFNET Proxy: ' + base_url + ' -->\n'
         return header + html
     
-    def _serve_local_file(self, client_socket, path):
+    def _serve_local_file(self, client_socket, request, path):
         """Serve local file"""
         # Security check
         if '..' in path:
-            self._send_404(client_socket)
+            self._send_404(client_socket, request)
             return
         
         # Clean path
-        clean_path = path.lstrip('/')
+        clean_path = path.split('?', 1)[0].lstrip('/')
         file_path = os.path.join(self.base_dir, clean_path)
         
-        if not os.path.exists(file_path):
-            self._send_404(client_socket)
+        if not os.path.isfile(file_path):
+            self._send_404(client_socket, request)
             return
         
         try:
             with open(file_path, 'rb') as f:
                 content = f.read()
+        except:
+            self._send_404(client_socket, request)
+            return
             
-            # Guess content type
-            ext = os.path.splitext(file_path)[1].lower()
-            types = {
-                '.png': 'image/png',
-                '.jpg': 'image/jpeg',
-                '.jpeg': 'image/jpeg',
-                '.gif': 'image/gif',
-                '.html': 'text/html',
-                '.htm': 'text/html',
-                '.txt': 'text/plain',
-                '.css': 'text/css',
-                '.js': 'application/javascript',
-            }
-            content_type = types.get(ext, 'application/octet-stream')
+        # Guess content type
+        ext = os.path.splitext(file_path)[1].lower()
+        types = {
+            '.png': 'image/png',
+            '.jpg': 'image/jpeg',
+            '.jpeg': 'image/jpeg',
+            '.gif': 'image/gif',
+            '.html': 'text/html',
+            '.htm': 'text/html',
+            '.txt': 'text/plain',
+            '.css': 'text/css',
+            '.js': 'application/javascript',
+        }
+        content_type = types.get(ext, 'application/octet-stream')
             
-            response = "HTTP/1.1 200 OK\r\n"
-            response += "Server: NFNET/1.0\r\n"
-            response += "Content-Type: " + content_type + "\r\n"
-            response += "Content-Length: " + str(len(content)) + "\r\n"
-            response += "Connection: close\r\n\r\n"
+        self._send_response(client_socket, request, 200, content_type, content)
             
-            client_socket.send(response)
-            client_socket.send(content)
+    def _error_page(self, message):
+        """Build error page"""
+        return '<html><body style="font-family: Tahoma; padding: 40px;"><h3>Error</h3><p>' + message + '</p><p><a href="/">Back</a></p></body></html>'
             
-        except:
-            self._send_404(client_socket)
-    
-    def _send_error(self, client_socket, message):
+    def _send_error(self, client_socket, request, message):
         """Send error page"""
-        html = '<html><body style="font-family: Tahoma; padding: 40px;"><h3>Error</h3><p>' + message + '</p><p><a href="/">Back</a></p></body></html>'
-        
-        response = "HTTP/1.1 500 Error\r\n"
-        response += "Server: NFNET/1.0\r\n"
-        response += "Content-Type: text/html\r\n"
-        response += "Content-Length: " + str(len(html)) + "\r\n"
-        response += "Connection: close\r\n\r\n"
+        self._send_response(client_socket, request, 500, 'text/html', self._error_page(message))
         
-        client_socket.send(response)
-        client_socket.send(html)
-    
-    def _send_404(self, client_socket):
+    def _send_404(self, client_socket, request):
         """Send 404 page"""
         html = '<html><body style="font-family: Tahoma; padding: 40px;"><h3>404 Not Found</h3><p><a href="/">Back to NFNET</a></p></body></html>'
         
-        response = "HTTP/1.1 404 Not Found\r\n"
-        response += "Server: NFNET/1.0\r\n"
-        response += "Content-Type: text/html\r\n"
-        response += "Content-Length: " + str(len(html)) + "\r\n"
-        response += "Connection: close\r\n\r\n"
-        
-        client_socket.send(response)
-        client_socket.send(html)
\ No newline at end of file
+        self._send_response(client_socket, request, 404, 'text/html', html)
+    
+    def get_stats(self):
+        """Get web server statistics"""
+        return {
+            'workers': self.pool.get_stats(),
+            'dns': self.dns_cache.get_stats(),
+            'access_log': self.access_log.get_stats(),
+            'stream': self.stream.get_stats()
+        }
\ No newline at end of file
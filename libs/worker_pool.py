@@ -0,0 +1,151 @@
+"""
+NFNET Worker Pool
+Fixed number of worker threads fed from a bounded queue
+"""
+
+import threading
+import time
+import Queue
+
+from log import get_logger
+
+
+class WorkerPool:
+    """Run handler(*args) for submitted jobs on a fixed set of threads
+
+    Jobs still queued when the pool stops are passed to discard(*args),
+    if given, so their resources can be released.
+    """
+    
+    def __init__(self, name, workers, queue_size, handler, discard=None):
+        self.name = name
+        self.log = get_logger(name)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.handler = handler
+        self.discard = discard
+        self.queue = Queue.Queue(queue_size)
+        self.running = False
+        self.threads = []
+        self.lock = threading.Lock()
+        
+        # Metrics
+        self.stats = {
+            'submitted': 0,
+            'rejected': 0,
+            'completed': 0,
+            'errors': 0,
+            'busy': 0,
+            'peak_queue': 0,
+            'wait_time': 0.0         # Total seconds jobs spent queued
+        }
+    
+    def start(self):
+        """Start the worker threads"""
+        if self.running:
+            return False
+        
+        self.running = True
+        self.threads = [threading.Thread(target=self._worker, name="%s-%d" % (self.name, i))
+                        for i in range(self.workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        
+        return True
+    
+    def stop(self, timeout=1.0):
+        """Stop the workers once they finish their current job"""
+        self.running = False
+        
+        # Wake up idle workers
+        for thread in self.threads:
+            try:
+                self.queue.put_nowait(None)
+            except Queue.Full:
+                break
+        
+        # Give idle workers a moment to exit before the caller moves on
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(max(0, deadline - time.time()))
+        
+        # Sentinels left by busy workers would stop a restarted pool's
+        # workers, and queued jobs would never run
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if job is not None and self.discard:
+                try:
+                    self.discard(*job[1])
+                except Exception as e:
+                    self.log.error("Discard: %s", str(e))
+        
+        return True
+    
+    def submit(self, *args):
+        """Queue a job, returns False if the queue is full"""
+        try:
+            self.queue.put_nowait((time.time(), args))
+        except Queue.Full:
+            with self.lock:
+                self.stats['rejected'] += 1
+            return False
+        
+        with self.lock:
+            self.stats['submitted'] += 1
+            depth = self.queue.qsize()
+            if depth > self.stats['peak_queue']:
+                self.stats['peak_queue'] = depth
+        
+        return True
+    
+    def queue_depth(self):
+        """Jobs waiting for a worker"""
+        return self.queue.qsize()
+    
+    def _worker(self):
+        """Worker thread main loop"""
+        thread = threading.current_thread()
+        
+        # A worker still busy when the pool was restarted leaves afterwards
+        while self.running and thread in self.threads:
+            job = self.queue.get()
+            if job is None:
+                break
+            
+            queued_at, args = job
+            with self.lock:
+                self.stats['busy'] += 1
+                self.stats['wait_time'] += time.time() - queued_at
+            
+            try:
+                self.handler(*args)
+            except Exception as e:
+                self.log.error("Worker: %s", str(e))
+                with self.lock:
+                    self.stats['errors'] += 1
+            
+            with self.lock:
+                self.stats['busy'] -= 1
+                self.stats['completed'] += 1
+    
+    def get_stats(self):
+        """Get pool statistics"""
+        with self.lock:
+            stats = self.stats.copy()
+        
+        stats['workers'] = self.workers
+        stats['queue_size'] = self.queue_size
+        stats['queue_depth'] = self.queue.qsize()
+        started = stats['completed'] + stats['busy']
+        if started:
+            stats['avg_wait_ms'] = round(stats['wait_time'] * 1000 / started, 2)
+        else:
+            stats['avg_wait_ms'] = 0.0
+        del stats['wait_time']
+        
+        return stats
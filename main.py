@@ -12,6 +12,9 @@ import sys
 import os
 import time
 
+# Launch time, used to report how long startup takes
+STARTED = time.time()
+
 # Add libs to path
 libs_path = os.path.join(os.path.dirname(__file__), 'libs')
 if os.path.exists(libs_path):
@@ -52,8 +55,30 @@ def main_header():
     print "Type 'help' for available commands"
     print ""
 
+def parse_args():
+    """Parse command line options"""
+    from optparse import OptionParser
+    
+    parser = OptionParser(usage="%prog [--headless] [--takeover] [--pidfile FILE]")
+    parser.add_option("--headless", action="store_true", default=False,
+                      help="run the relay as a service without the console")
+    parser.add_option("--takeover", action="store_true", default=False,
+                      help="take the sockets of the running headless relay, which then "
+                           "drains and exits (implies --headless)")
+    parser.add_option("--pidfile", help="write the process id to this file")
+    options, args = parser.parse_args()
+    return options
+
+def run_headless(options):
+    """Run the relay without banner or console"""
+    from daemon import Daemon
+    return Daemon(options.pidfile, STARTED, options.takeover).run()
+
 def main():
     """Main entry point"""
+    options = parse_args()
+    if options.headless or options.takeover:
+        sys.exit(run_headless(options))
     
     # Check Python
     if sys.version_info[0] != 2:
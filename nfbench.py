@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""
+NFNET Benchmark Tools
+Usage: python nfbench.py load|micro|peer|access [options]
+"""
+
+import sys
+import os
+
+# Add libs to path
+libs_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libs')
+sys.path.insert(0, libs_path)
+
+def usage():
+    """Show available tools"""
+    print "Usage: python nfbench.py <tool> [options]"
+    print ""
+    print "Tools:"
+    print "  load     Load test a running relay"
+    print "  micro    Microbenchmark protocol and processing code"
+    print "  peer     Measure forwarding through a second relay"
+    print "  access   Summarise web access logs"
+    print ""
+    print "Run 'python nfbench.py <tool> --help' for tool options"
+
+def main():
+    """Main entry point"""
+    if len(sys.argv) < 2 or sys.argv[1] not in ('load', 'micro', 'peer', 'access'):
+        usage()
+        return 1
+    
+    tool = sys.argv[1]
+    args = sys.argv[2:]
+    
+    if tool == 'load':
+        import loadgen
+        return loadgen.main(args)
+    elif tool == 'micro':
+        import microbench
+        return microbench.main(args)
+    elif tool == 'peer':
+        import peerbench
+        return peerbench.main(args)
+    elif tool == 'access':
+        import access_log
+        return access_log.main(args)
+
+if __name__ == "__main__":
+    sys.exit(main())